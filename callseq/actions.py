@@ -1,12 +1,21 @@
 
 import os
 import re
+import json
+import time
+import shlex
+import hashlib
 import shutil
 import subprocess
 import warnings
 import difflib
+import mmap
+import concurrent.futures
 import callseq.cxx
 import callseq.cxx.clang_ast_dump
+import callseq.cxx.clang_cindex
+import callseq.output
+import callseq.analysis
 
 
 def _flatten(args):
@@ -154,14 +163,23 @@ class Application(Action):
 
 class CallSeq(Action):
 
-    def __init__(self, std='C++', task='apply', try_run=False, show_diff=False, defines=None):
+    def __init__(self, std='C++', task='apply', try_run=False, show_diff=False, defines=None,
+                 compile_commands=None, prelude=None, pch_dir=None, ast_dump_filter=None,
+                 main_file_only=False, backend='auto'):
         self.std = std.lower()
+        if isinstance(compile_commands, str):
+            compile_commands = CompilationDatabase(compile_commands)
+        self.compile_commands = compile_commands
 
         if self.std == 'c++':
-            self.ast_reader = ClangAstReader(defines=defines)
+            self.ast_reader_options = dict(defines=defines, prelude=prelude, pch_dir=pch_dir,
+                                           ast_dump_filter=ast_dump_filter,
+                                           main_file_only=main_file_only, backend=backend)
+            self._ast_reader = None
             self.apply_method = callseq.cxx.insert_signal_code
             self.unapply_method = callseq.cxx.remove_signal_code
             self.ast_cache = {}
+            self.ast_includes = {}  # source -> files found in the AST of source
         else:
             raise NotImplementedError(repr(self.std))
 
@@ -169,36 +187,65 @@ class CallSeq(Action):
         self.try_run = try_run
         self.show_diff = show_diff
 
-    def update_ast_cache(self, ast):
-        pass
+    @property
+    def ast_reader(self):
+        # created on demand as unapply does not need clang
+        if self._ast_reader is None:
+            self._ast_reader = ClangAstReader(**self.ast_reader_options)
+        return self._ast_reader
 
-    def get_ast(self, source):
+    def ast_flags(self, source):
+        """Return the working directory and the flags for reading the AST of a source.
+        """
+        if self.compile_commands is not None:
+            return self.compile_commands.get(source)
+        return None, []
+
+    def update_ast_cache(self, source, ast):
         # Warning: Here we assume that a source file does not define
         # CPP-macros that will affect the result of ast-parsing the
         # header files that the source file includes. Otherwise, we
         # should not cache the ast of a header file obtained from the
         # ast of a source file.
-        if source not in self.ast_cache:
-            ast = self.ast_reader(source)
-            sources = set([source])
+        sources = set([source])
+
+        def process(node):
+            sources.add(node.loc)
+            return True
 
+        list(ast.traverse(process))
+        self.ast_includes[source] = sorted(s for s in sources if s and s != source)
+        for source_ in sources:
             def process(node):
-                sources.add(node.loc)
-                return True
-
-            list(ast.traverse(process))
-            for source_ in sources:
-                def process(node):
-                    if node.key == 'TranslationUnitDecl':
-                        return True
-                    if node.loc == source_:
-                        return True
-                new_ast = ast.filter(process)
-                if new_ast is not None:
-                    # new_ast.loc = source_
-                    self.ast_cache[source_] = new_ast
+                if node.key == 'TranslationUnitDecl':
+                    return True
+                if node.loc == source_:
+                    return True
+            new_ast = ast.filter(process)
+            if new_ast is not None:
+                # new_ast.loc = source_
+                self.ast_cache[source_] = new_ast
+
+    def get_ast(self, source):
+        if source not in self.ast_cache:
+            cwd, flags = self.ast_flags(source)
+            self.update_ast_cache(source, self.ast_reader(source, flags, cwd=cwd))
         return self.ast_cache[source]
 
+    def prefetch(self, sources):
+        """Read the ASTs of sources that are not cached yet.
+
+        Sources with the same flags are read in a single clang call.
+        """
+        groups = {}
+        for source in sources:
+            if source not in self.ast_cache:
+                cwd, flags = self.ast_flags(source)
+                groups.setdefault((cwd, tuple(flags)), []).append(source)
+        for (cwd, flags), group in groups.items():
+            for source, ast in zip(group, self.ast_reader.read_many(group, list(flags), cwd=cwd)):
+                self.update_ast_cache(source, ast)
+
     def __call__(self, source, output=None):
         f = open(source)
         source_string = f.read()
@@ -219,8 +266,12 @@ class CallSeq(Action):
             output = source
         if self.show_diff:
             show_ndiff(source, source_string, output, output_string)
-        if not (source == output and source_string == output_string):
+        same = source == output or (os.path.exists(output) and os.path.samefile(source, output))
+        if not (same and source_string == output_string):
             if not self.try_run:
+                if same and source != output:
+                    # output is a hard link to source
+                    os.remove(output)
                 f = open(output, 'w')
                 f.write(output_string)
                 f.close()
@@ -263,33 +314,794 @@ def show_ndiff(file1, content1, file2, content2):
     print('='*60)
 
 
+class Manifest(Action):
+    """State of applied CallSeq hooks.
+
+    The manifest is a JSON file that holds the content hash, the site
+    ids, and the hashes of included files of each processed file, so
+    that the files that have not changed since the last apply can be
+    skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.files = json.load(f)['files']
+        self.hashes = {}
+
+    def hash(self, path):
+        h = self.hashes.get(path)
+        if h is None:
+            try:
+                with open(path, 'rb') as f:
+                    h = hashlib.sha1(f.read()).hexdigest()
+            except FileNotFoundError:
+                h = ''
+            self.hashes[path] = h
+        return h
+
+    def max_site(self):
+        return max((max(entry['sites'], default=0) for entry in self.files.values()), default=0)
+
+    def changed(self, path):
+        """Check if a file or its included files have changed since recorded.
+        """
+        entry = self.files.get(path)
+        if entry is None or entry['hash'] != self.hash(path):
+            return True
+        return any(self.hash(include) != h for include, h in entry['includes'].items())
+
+    def record(self, path, includes=(), output=None):
+        self.hashes.pop(path, None)
+        with open(output or path) as f:
+            content = f.read()
+        sites = sorted(set(map(int, re.findall(r'CALLSEQ_SIGNAL[(](\d+)[,]', content))))
+        self.files[path] = dict(hash=self.hash(path), sites=sites,
+                                includes={include: self.hash(include) for include in includes})
+
+    def save(self):
+        tmp = f'{self.path}.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump(dict(version=1, files=self.files), f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def mirror_tree(source_root, output_tree):
+    """Mirror source_root to output_tree using hard links.
+
+    Files are hard linked (copied when linking is not possible, e.g.
+    across file systems) and symbolic links are recreated. Existing
+    files in output_tree are replaced only when the corresponding
+    source files are newer, so that previously written files are kept.
+    Returns the number of created links and copies.
+    """
+    source_root = os.path.abspath(source_root)
+    output_tree = os.path.abspath(output_tree)
+    count = 0
+    stack = [(source_root, output_tree)]
+    while stack:
+        src_dir, dst_dir = stack.pop()
+        os.makedirs(dst_dir, exist_ok=True)
+        existing = {}
+        with os.scandir(dst_dir) as entries:
+            for entry in entries:
+                existing[entry.name] = entry
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                dst = os.path.join(dst_dir, entry.name)
+                if entry.path == output_tree:
+                    continue
+                if entry.is_symlink():
+                    if entry.name not in existing:
+                        os.symlink(os.readlink(entry.path), dst)
+                        count += 1
+                    continue
+                if entry.is_dir():
+                    stack.append((entry.path, dst))
+                    continue
+                dst_entry = existing.get(entry.name)
+                if dst_entry is not None:
+                    st, dst_st = entry.stat(), dst_entry.stat(follow_symlinks=False)
+                    if (st.st_ino == dst_st.st_ino and st.st_dev == dst_st.st_dev
+                            or st.st_mtime_ns <= dst_st.st_mtime_ns):
+                        continue
+                    os.remove(dst)
+                try:
+                    os.link(entry.path, dst)
+                except OSError:
+                    shutil.copy2(entry.path, dst)
+                count += 1
+    return count
+
+
+class Unapply(Action):
+    """Removes CallSeq hooks from many files in parallel.
+
+    Files are pre-scanned for hooks using mmap in threads and only the
+    files that contain hooks are read and rewritten, in processes as
+    removing hooks is CPU bound. No ASTs are needed. Returns the list of
+    modified files.
+    """
+
+    def __init__(self, try_run=False, show_diff=False, jobs=None):
+        self.try_run = try_run
+        self.show_diff = show_diff
+        self.jobs = jobs
+
+    @staticmethod
+    def has_hooks(path):
+        with open(path, 'rb') as f:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    return m.find(b'CALLSEQ_SIGNAL(') != -1
+            except ValueError:
+                # empty file cannot be mapped
+                return False
+
+    def unapply(self, path):
+        """Remove hooks from a file.
+
+        Returns None when the file is not modified, otherwise the
+        contents of the file before and after the modification (only
+        when show_diff is True).
+        """
+        with open(path) as f:
+            source_string = f.read()
+        output_string = callseq.cxx.remove_signal_code(source_string)
+        if output_string == source_string:
+            return None
+        if not self.try_run:
+            with open(path, 'w') as f:
+                f.write(output_string)
+        return (source_string, output_string) if self.show_diff else ()
+
+    def __call__(self, sources):
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            paths = [path for path, hooks in zip(sources, executor.map(self.has_hooks, sources))
+                     if hooks]
+        if len(paths) < 2 or self.jobs == 1:
+            results = list(map(self.unapply, paths))
+        else:
+            chunksize = max(1, len(paths) // (4 * (self.jobs or os.cpu_count() or 1)))
+            with concurrent.futures.ProcessPoolExecutor(self.jobs) as executor:
+                results = list(executor.map(self.unapply, paths, chunksize=chunksize))
+        modified = []
+        for path, result in zip(paths, results):
+            if result is None:
+                continue
+            if self.show_diff:
+                show_ndiff(path, result[0], path, result[1])
+            modified.append(path)
+        return modified
+
+
 class MultiCallSeq(Action):
+    """Applies CallSeq to many files.
+
+    When manifest path is specified, only the files that have changed
+    since the last apply, or that include changed files, are processed.
 
-    def __init__(self, std='C++', task='apply', try_run=False, show_diff=False, defines=None):
+    When output_tree is specified, source_root is mirrored to
+    output_tree (see mirror_tree) and the instrumented files are written
+    to output_tree while the files under source_root are not modified.
+    """
+
+    def __init__(self, std='C++', task='apply', try_run=False, show_diff=False, defines=None,
+                 compile_commands=None, source_root=None, batch_size=1, prelude=None,
+                 pch_dir=None, ast_dump_filter=None, main_file_only=False, backend='auto',
+                 manifest=None, output_tree=None, jobs=None):
         self.callseq = CallSeq(std=std, task=task, try_run=try_run,
-                               show_diff=show_diff, defines=defines)
+                               show_diff=show_diff, defines=defines,
+                               compile_commands=compile_commands,
+                               prelude=prelude, pch_dir=pch_dir,
+                               ast_dump_filter=ast_dump_filter, main_file_only=main_file_only,
+                               backend=backend)
+        self.source_root = source_root
+        self.batch_size = batch_size
+        self.prelude = prelude
+        self.manifest = manifest
+        self.output_tree = output_tree
+        self.jobs = jobs
+        if output_tree is not None:
+            assert source_root is not None
+            assert task == 'apply', task
+
+    def auto_prelude(self, sources):
+        """Set the prelude of the AST reader to a header with the common system
+        include directives of sources.
+        """
+        ast_reader = self.callseq.ast_reader
+        includes = common_includes(
+            [s for s in sources
+             if os.path.splitext(s)[1].lower() in Collector.std_extensions['c++']['source']])
+        if not includes:
+            return
+        content = ''.join(f'#include {include}\n' for include in includes)
+        os.makedirs(ast_reader.pch_dir, exist_ok=True)
+        prelude = os.path.join(ast_reader.pch_dir,
+                               hashlib.sha1(content.encode()).hexdigest() + '.hpp')
+        if not os.path.isfile(prelude):
+            with open(prelude, 'w') as f:
+                f.write(content)
+        ast_reader.prelude = prelude
+
+    def headers(self, sources):
+        """Return the project headers found in the ASTs of processed sources.
+
+        Project headers are the headers under source_root.
+        """
+        root = os.path.abspath(self.source_root)
+        extensions = Collector.std_extensions[self.callseq.std]['header']
+        return sorted(path for path in self.callseq.ast_cache
+                      if path not in sources and path.startswith(root)
+                      and os.path.splitext(path)[1].lower() in extensions)
+
+    def output(self, source):
+        """Return the output path of a source.
+        """
+        if self.output_tree is None:
+            return None
+        path = os.path.relpath(os.path.abspath(source), os.path.abspath(self.source_root))
+        assert not path.startswith(os.pardir), (source, self.source_root)
+        return os.path.join(self.output_tree, path)
+
+    def process(self, sources):
+        if self.batch_size <= 1 or self.callseq.task != 'apply':
+            return [self.callseq(source, self.output(source)) for source in sources]
+        outputs = []
+        for i in range(0, len(sources), self.batch_size):
+            batch = sources[i:i + self.batch_size]
+            self.callseq.prefetch(batch)
+            outputs.extend(self.callseq(source, self.output(source)) for source in batch)
+        return outputs
 
     def __call__(self, sources):
-        return list(map(self.callseq, sources))
+        if self.callseq.task == 'unapply':
+            Unapply(try_run=self.callseq.try_run, show_diff=self.callseq.show_diff,
+                    jobs=self.jobs)(sources)
+            if (self.manifest is not None and not self.callseq.try_run
+                    and os.path.isfile(self.manifest)):
+                os.remove(self.manifest)
+            return list(sources)
+        manifest = None
+        if self.manifest is not None:
+            manifest = Manifest(self.manifest)
+            callseq.cxx.COUNTER.update(manifest.max_site())
+            changed = [source for source in sources if manifest.changed(source)]
+        else:
+            changed = list(sources)
+        if self.prelude == 'auto' and self.callseq.task == 'apply' and changed:
+            self.auto_prelude(changed)
+        if self.output_tree is not None and not self.callseq.try_run:
+            mirror_tree(self.source_root, self.output_tree)
+        outputs = dict(zip(changed, self.process(changed)))
+        outputs = [outputs.get(source, self.output(source) or source) for source in sources]
+        if self.callseq.compile_commands is not None and self.source_root is not None:
+            # the database contains only sources, the project headers
+            # are processed using the cached ASTs of the sources
+            headers = self.headers(set(sources))
+            changed.extend(headers)
+            outputs.extend(self.process(headers))
+        if manifest is not None and not self.callseq.try_run:
+            # the hashes of files that were rewritten in this run are outdated
+            for source in changed:
+                manifest.hashes.pop(source, None)
+            for source in changed:
+                manifest.record(source, self.callseq.ast_includes.get(source, ()),
+                                output=self.output(source))
+            manifest.save()
+        return outputs
+
+
+class Watcher(Action):
+    """Re-applies CallSeq hooks to C++ files when these are modified.
+
+    The given CallSeq instance is kept alive, so its AST cache and
+    compile flags are reused. Files under paths are polled for
+    modification times every interval seconds. A modified file is not
+    rewritten when it has been modified again while being processed.
+    """
+
+    def __init__(self, callseq_, paths, recursive=True, interval=0.5):
+        assert callseq_.task == 'apply', callseq_.task
+        self.callseq = callseq_
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.recursive = recursive
+        self.interval = interval
+        collector = Collector(std=callseq_.std)
+        self.extensions = tuple(collector.header_extensions + collector.source_extensions)
+        self.mtimes = self.scan()
+
+    def scan(self):
+        """Return a mapping of C++ files and their modification times.
+        """
+        mtimes = {}
+        stack = []
+        for path in self.paths:
+            if os.path.isdir(path):
+                stack.append(path)
+            elif os.path.isfile(path):
+                mtimes[path] = os.stat(path).st_mtime_ns
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if self.recursive:
+                        stack.append(entry.path)
+                elif entry.name.lower().endswith(self.extensions):
+                    try:
+                        mtimes[entry.path] = entry.stat().st_mtime_ns
+                    except FileNotFoundError:
+                        pass
+        return mtimes
+
+    def apply(self, path):
+        """Apply hooks to a file and return True if the file was rewritten.
+        """
+        mtime = os.stat(path).st_mtime_ns
+        with open(path) as f:
+            source_string = f.read()
+        # the cached AST of the file, possibly obtained from the AST of
+        # a source including it, is outdated
+        self.callseq.ast_cache.pop(path, None)
+        output_string = self.callseq.apply_method(self.callseq.get_ast(path), path,
+                                                  source_string)
+        if output_string == source_string or os.stat(path).st_mtime_ns != mtime:
+            return False
+        if self.callseq.show_diff:
+            show_ndiff(path, source_string, path, output_string)
+        if not self.callseq.try_run:
+            with open(path, 'w') as f:
+                f.write(output_string)
+            self.mtimes[path] = os.stat(path).st_mtime_ns
+        return True
+
+    def step(self):
+        """Apply hooks to modified files and return the list of rewritten files.
+        """
+        mtimes = self.scan()
+        modified = [path for path, mtime in mtimes.items() if self.mtimes.get(path) != mtime]
+        self.mtimes = mtimes
+        rewritten = []
+        for path in sorted(modified):
+            try:
+                if self.apply(path):
+                    rewritten.append(path)
+            except Exception as msg:
+                print(f'Failed to apply CallSeq to {path}: {msg}')
+        return rewritten
+
+    def __call__(self, iterations=None):
+        count = 0
+        while iterations is None or count < iterations:
+            time.sleep(self.interval)
+            for path in self.step():
+                print(f'Applied CallSeq to {path}')
+            count += 1
+
+
+class CompilerLauncher(Action):
+    """Compiler launcher that compiles instrumented copies of C++ sources.
+
+    The sources of a compiler command are instrumented into cache_dir
+    and the command is run with the sources replaced by the instrumented
+    copies, so that the source tree is never modified. The copies start
+    with a `#line` directive referring to the original source, the
+    directory of the original source is added to the quote include
+    path and callseq.hpp is included. The copies are keyed by the hash
+    of the source content and the compile flags, hence unchanged sources
+    are not instrumented again.
+
+    Only C++ sources are instrumented: sources with C++ extensions or
+    the sources following `-x c++`. Commands without C++ sources, for
+    instance, of C sources in mixed projects, are run unchanged.
+
+    Only the functions defined in the sources are instrumented, not the
+    ones defined in the included headers. Since the sources are
+    instrumented in separate processes, site ids are derived from the
+    hash of the source path, see site_counter.
+    """
+
+    callseq_hpp = os.path.join(os.path.dirname(callseq.cxx.__file__), 'include', 'callseq.hpp')
+    # flags with separate arguments that are not sources
+    argument_flags = ('-o', '-MF', '-MT', '-MQ', '-x', '-Xclang', '-Xlinker', '-Xpreprocessor',
+                      '-include', '-imacros', '-I', '-isystem', '-iquote', '-idirafter')
+
+    def __init__(self, cache_dir=None, defines=None, backend='auto'):
+        self.cache_dir = cache_dir or os.path.join(os.path.expanduser('~'), '.cache', 'callseq',
+                                                   'cc')
+        self.defines = defines
+        self.backend = backend
+        self._ast_reader = None
+        c_extensions = Collector.std_extensions['c']['source']
+        self.source_extensions = tuple(e for e in Collector.std_extensions['c++']['source']
+                                       if e not in c_extensions)
+
+    @property
+    def ast_reader(self):
+        if self._ast_reader is None:
+            self._ast_reader = ClangAstReader(defines=self.defines, main_file_only=True,
+                                              backend=self.backend)
+        return self._ast_reader
+
+    @staticmethod
+    def site_counter(source):
+        """Return site id generator of a source.
+
+        Site ids consist of 40 bits of the hash of source path and of
+        a 20-bit counter.
+        """
+        base = int(hashlib.sha1(source.encode()).hexdigest()[:10], 16) << 20
+        count = [0]
+
+        def next_counter():
+            count[0] += 1
+            assert count[0] < (1 << 20)
+            return base + count[0]
+        return next_counter
+
+    def sources(self, command, cwd):
+        """Return the indices of C++ source arguments in a compiler command.
+        """
+        indices = []
+        language = None  # set by -x, None when determined by extension
+        i = 1
+        while i < len(command):
+            a = command[i]
+            if a.startswith('-x') and len(a) > 2:
+                language = a[2:]
+            elif a == '-x' and i + 1 < len(command):
+                language = command[i + 1]
+            if language == 'none':
+                language = None
+            if a in self.argument_flags:
+                i += 2
+                continue
+            if language is None:
+                cxx = a.lower().endswith(self.source_extensions)
+            else:
+                cxx = language == 'c++'
+            if not a.startswith('-') and cxx and os.path.isfile(os.path.join(cwd, a)):
+                indices.append(i)
+            i += 1
+        return indices
+
+    def instrument(self, source, flags, cwd):
+        """Return the path of the instrumented copy of a source.
+        """
+        with open(source) as f:
+            source_string = f.read()
+        h = hashlib.sha1(repr((source, flags, self.defines)).encode())
+        h.update(source_string.encode())
+        digest = h.hexdigest()
+        path = os.path.join(self.cache_dir, digest[:2], digest[2:], os.path.basename(source))
+        if os.path.isfile(path):
+            return path
+        ast = self.ast_reader(source, flags, cwd=cwd)
+        output_string = callseq.cxx.insert_signal_code(ast, source, source_string,
+                                                       next_counter=self.site_counter(source))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            f.write(f'#line 1 "{source}"\n')
+            f.write(output_string)
+        os.replace(tmp, path)
+        return path
+
+    def __call__(self, command, cwd=None):
+        """Run compiler command with instrumented sources and return its exit status.
+
+        When a source cannot be instrumented, the original source is
+        compiled.
+        """
+        cwd = os.path.abspath(cwd or os.getcwd())
+        command = list(command)
+        indices = self.sources(command, cwd)
+        sources = [os.path.normpath(os.path.join(cwd, command[i])) for i in indices]
+        flags = [a for i, a in enumerate(command[1:], 1) if i not in indices]
+        extra = ['-include', self.callseq_hpp]
+        for i, source in zip(indices, sources):
+            try:
+                command[i] = self.instrument(
+                    source, CompilationDatabase.clean(flags, cwd, source), cwd)
+            except Exception as msg:
+                warnings.warn(f'Failed to instrument {source}, compiling the original: {msg}')
+                continue
+            extra += ['-iquote', os.path.dirname(source)]
+        if indices:
+            command[1:1] = extra
+        return subprocess.call(command, cwd=cwd)
 
 
 class ClangAstReader(Action):
     """AST reader of C++ files.
+
+    When prelude header is specified, it is precompiled once per set of
+    flags into pch_dir and the ASTs of C++ files are read using the
+    precompiled header. Since the declarations of the precompiled header
+    are not dumped, the AST of the prelude is read once per set of flags
+    and its nodes are prepended to the ASTs of C++ files.
+
+    The dumps can be narrowed down to the declarations with qualified
+    names matching ast_dump_filter (e.g. a project namespace), or, when
+    main_file_only is True, to the top-level declarations of the C++
+    file itself (its headers must be processed separately).
+
+    When backend is 'libclang', ASTs are read in-process using libclang.
+    Prelude and ast_dump_filter are supported only by the 'subprocess'
+    backend, so 'auto' selects 'libclang' only when libclang Python
+    bindings are available and neither of these options is specified.
+    When prelude is 'auto', the prelude is set later, see
+    MultiCallSeq.auto_prelude. The libclang backend reads the ASTs of
+    several files one by one (see read_many) as there is no process
+    startup cost to amortize.
     """
 
-    def __init__(self, defines=None):
+    def __init__(self, defines=None, prelude=None, pch_dir=None, ast_dump_filter=None,
+                 main_file_only=False, backend='auto'):
+        assert backend in ['auto', 'libclang', 'subprocess'], backend
+        options = dict(prelude=prelude, ast_dump_filter=ast_dump_filter)
+        subprocess_options = [name for name, value in options.items() if value is not None]
+        if backend == 'auto':
+            available = callseq.cxx.clang_cindex.get_index() is not None
+            backend = 'libclang' if available and not subprocess_options else 'subprocess'
+        elif backend == 'libclang' and subprocess_options:
+            warnings.warn(f'{" and ".join(subprocess_options)} not supported by libclang backend,'
+                          ' ignoring')
+        if prelude == 'auto':
+            prelude = None
+        self.backend = backend
         self.clang_exe = shutil.which('clang++')
-        assert self.clang_exe  # make sure that clang++ is installed (e.g. conda install clangxx)
+        if backend == 'subprocess':
+            # make sure that clang++ is installed (e.g. conda install clangxx)
+            assert self.clang_exe
         self.ast_dump_flags = ['-Xclang', '-ast-dump', '-fsyntax-only', '-fno-diagnostics-color']
+        self.defines = []
         if defines is not None:
             assert isinstance(defines, list), defines
             for d in defines:
-                self.ast_dump_flags.append(f'-D{d}')
+                self.defines.append(f'-D{d}')
+        self.ast_dump_filter = ast_dump_filter
+        if ast_dump_filter is not None:
+            self.ast_dump_flags += ['-Xclang', '-ast-dump-filter', '-Xclang', ast_dump_filter]
+        self.main_file_only = main_file_only
+        self.prelude = prelude
+        self.pch_dir = pch_dir or os.path.join(os.path.expanduser('~'), '.cache', 'callseq', 'pch')
+        self.pchs = {}  # (cwd, flags) -> (pch path, prelude ast) or None
+
+    def pch(self, flags, cwd=None):
+        """Return the precompiled prelude header and the AST of the prelude.
+
+        Returns None when prelude is not specified or when it cannot be
+        precompiled.
+        """
+        if self.prelude is None:
+            return None
+        key = cwd, tuple(flags)
+        if key not in self.pchs:
+            prelude = os.path.abspath(self.prelude)
+            with open(prelude, 'rb') as f:
+                content = f.read()
+            h = hashlib.sha1(repr((self.clang_exe, self.defines, key, prelude)).encode())
+            h.update(content)
+            pch = os.path.join(self.pch_dir, h.hexdigest() + '.pch')
+            if not os.path.isfile(pch):
+                os.makedirs(self.pch_dir, exist_ok=True)
+                tmp = f'{pch}.{os.getpid()}'
+                s, out, err = run(self.clang_exe, '-x', 'c++-header', self.defines, flags,
+                                  prelude, '-o', tmp, cwd=cwd)
+                if s != 0:
+                    warnings.warn(f'Failed to precompile {prelude}, not using it:\n{err}')
+                    self.pchs[key] = None
+                    return None
+                os.replace(tmp, pch)
+            s, out, err = run(self.clang_exe, self.ast_dump_flags, '-x', 'c++-header',
+                              self.defines, flags, prelude, cwd=cwd)
+            # filtered dumps of preludes without matching declarations are empty
+            if s != 0 or (not out.strip() and self.ast_dump_filter is None):
+                warnings.warn(f'Failed to read the AST of {prelude}, not using it:\n{err}')
+                self.pchs[key] = None
+                return None
+            if self.ast_dump_filter is not None:
+                out = callseq.cxx.clang_ast_dump.wrap_filtered_ast_dump(out)
+            self.pchs[key] = pch, callseq.cxx.clang_ast_dump.parse_ast_dump(out, prelude)
+        return self.pchs[key]
+
+    def parse(self, ast_dump_output, source, pch):
+        if self.ast_dump_filter is not None:
+            ast_dump_output = callseq.cxx.clang_ast_dump.wrap_filtered_ast_dump(ast_dump_output)
+        elif self.main_file_only:
+            ast_dump_output = callseq.cxx.clang_ast_dump.main_file_ast_dump(
+                ast_dump_output, source)
+        ast = callseq.cxx.clang_ast_dump.parse_ast_dump(ast_dump_output, source)
+        if pch is not None:
+            ast.nodes = pch[1].nodes + ast.nodes
+        return ast
+
+    def __call__(self, source, flags=[], cwd=None):
+        source = os.path.abspath(source)
+        if self.backend == 'libclang':
+            # relative paths in flags are not supported as cwd is ignored
+            return callseq.cxx.clang_cindex.read_ast(source, self.defines + list(flags),
+                                                     main_file_only=self.main_file_only)
+        pch = self.pch(flags, cwd=cwd)
+        pch_flags = [] if pch is None else ['-include-pch', pch[0]]
+        s, out, err = run(self.clang_exe, self.ast_dump_flags, self.defines, pch_flags, flags,
+                          source, cwd=cwd)
+        if pch is not None and not out and 'precompiled header' in err:
+            # a header of the prelude has been modified, precompile again
+            os.remove(pch[0])
+            self.pchs.pop((cwd, tuple(flags)))
+            pch = self.pch(flags, cwd=cwd)
+            pch_flags = [] if pch is None else ['-include-pch', pch[0]]
+            s, out, err = run(self.clang_exe, self.ast_dump_flags, self.defines, pch_flags,
+                              flags, source, cwd=cwd)
+        return self.parse(out, source, pch)
+
+    def read_many(self, sources, flags=[], cwd=None):
+        """Return the ASTs of several sources using a single clang call.
+
+        The combined dump is split at the TranslationUnitDecl lines. If
+        a source does not produce a dump, the sources are read one by
+        one.
+        """
+        sources = [os.path.abspath(source) for source in sources]
+        if len(sources) == 1 or self.ast_dump_filter is not None or self.backend == 'libclang':
+            # filtered dumps have no TranslationUnitDecl lines
+            return [self(source, flags, cwd=cwd) for source in sources]
+        pch = self.pch(flags, cwd=cwd)
+        pch_flags = [] if pch is None else ['-include-pch', pch[0]]
+        s, out, err = run(self.clang_exe, self.ast_dump_flags, self.defines, pch_flags, flags,
+                          sources, cwd=cwd)
+        dumps = callseq.cxx.clang_ast_dump.split_ast_dumps(out)
+        if len(dumps) != len(sources):
+            return [self(source, flags, cwd=cwd) for source in sources]
+        return [self.parse(dump, source, pch) for dump, source in zip(dumps, sources)]
+
+
+def common_includes(sources):
+    """Return the common prefix of the system include directives of sources.
+
+    The leading `#include <...>` lines of each source (comments, empty
+    lines and other directives before the first non-include line are
+    skipped) are compared and the longest common prefix is returned.
+    """
+    include = re.compile(r'\s*#\s*include\s*(<[^>]+>)')
+    common = None
+    for source in sources:
+        includes = []
+        with open(source) as f:
+            for line in f:
+                m = include.match(line)
+                if m is not None:
+                    if m.group(1) not in includes:
+                        includes.append(m.group(1))
+                    continue
+                line = line.strip()
+                if not line or line.startswith(('//', '#')):
+                    continue
+                break
+        if common is None:
+            common = includes
+        else:
+            n = 0
+            while n < min(len(common), len(includes)) and common[n] == includes[n]:
+                n += 1
+            common = common[:n]
+        if not common:
+            break
+    return common or []
+
+
+class CompilationDatabase(Action):
+    """Compile commands of C++ files from compile_commands.json.
+
+    The recorded arguments of a file are used for reading its AST
+    without the compiler executable, the input and output files and
+    the flags that affect only code generation or dependency files.
+    Relative include paths are made absolute so that clang reports
+    absolute paths of headers.
+    """
+
+    # flags to be dropped, with the number of following arguments
+    drop_flags = {'-c': 0, '-o': 1, '-MD': 0, '-MMD': 0, '-MP': 0, '-MF': 1, '-MT': 1,
+                  '-MQ': 1, '-M': 0, '-MM': 0, '-pipe': 0, '-S': 0, '-E': 0}
+    drop_prefices = ('-O', '-g', '-W', '-flto', '-fprofile', '-fdebug-prefix-map',
+                     '-ffile-prefix-map', '-fcoverage', '-fsanitize', '-fstack-protector',
+                     '-fPIC', '-fpic', '-fPIE', '-fpie', '-fcolor-diagnostics',
+                     '-fdiagnostics-color', '-fno-fat-lto-objects')
+    # preprocessor options affect the AST
+    keep_prefices = ('-Wp,',)
+    # flags followed by a path argument
+    path_flags = ('-I', '-isystem', '-iquote', '-idirafter', '-include', '-imacros',
+                  '-include-pch', '-isysroot')
+    # flags that may be joined with a path argument
+    joined_path_flags = ('-I', '-isystem', '--sysroot=')
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(self.path) as f:
+            entries = json.load(f)
+        self.commands = {}  # source -> (directory, flags)
+        for entry in entries:
+            directory = entry['directory']
+            source = os.path.normpath(os.path.join(directory, entry['file']))
+            if 'arguments' in entry:
+                args = list(entry['arguments'])
+            else:
+                args = shlex.split(entry['command'])
+            self.commands[source] = (directory, self.clean(args[1:], directory, source))
 
-    def __call__(self, source, flags=[]):
+    @classmethod
+    def clean(cls, args, directory, source):
+        flags = []
+        i = 0
+        while i < len(args):
+            a = args[i]
+            i += 1
+            if a in cls.drop_flags:
+                i += cls.drop_flags[a]
+                continue
+            if ((a.startswith(cls.drop_prefices) and not a.startswith(cls.keep_prefices))
+                    or a.startswith('-o')):
+                continue
+            if os.path.normpath(os.path.join(directory, a)) == source:
+                continue
+            if a == '-Xclang' and i < len(args):
+                # e.g. -Xclang -include-pch -Xclang <path>
+                flags += [a, args[i]]
+                i += 1
+                if flags[-1] in cls.path_flags and args[i:i + 1] == [a] and i + 1 < len(args):
+                    flags += [a, os.path.join(directory, args[i + 1])]
+                    i += 2
+                continue
+            if a in cls.path_flags and i < len(args):
+                flags.append(a)
+                a = os.path.join(directory, args[i])
+                i += 1
+            else:
+                for p in cls.joined_path_flags:
+                    if a.startswith(p) and len(a) > len(p):
+                        a = p + os.path.join(directory, a[len(p):])
+                        break
+            flags.append(a)
+        return flags
+
+    def sources(self, paths=None):
+        """Return the sorted list of sources, optionally restricted to given
+        files or directories.
+        """
+        sources = sorted(self.commands)
+        if paths:
+            paths = [os.path.abspath(p) for p in paths]
+            sources = [s for s in sources
+                       if any(s == p or s.startswith(p.rstrip(os.sep) + os.sep) for p in paths)]
+        return sources
+
+    def get(self, source):
+        """Return (directory, flags) of a file.
+
+        For files that are not in the database (headers), the command of
+        a representative source is used: the source with the longest
+        common path with the file.
+        """
         source = os.path.abspath(source)
-        s, out, err = run(self.clang_exe, self.ast_dump_flags, flags, source)
-        return callseq.cxx.clang_ast_dump.parse_ast_dump(out, source)
+        command = self.commands.get(source)
+        if command is not None:
+            return command
+        best, best_length = None, -1
+        for source_ in self.commands:
+            length = len(os.path.commonpath([source, source_]))
+            if length > best_length:
+                best, best_length = source_, length
+        if best is None:
+            return None, []
+        return self.commands[best]
 
 
 class Collector(Action):
@@ -336,7 +1148,12 @@ class ShowCallSeqOutput(Action):
 
         tabs = 0
         for line in callseq_output.splitlines():
-            if line[0] == '{':
+            if line[0] == '#':
+                if line[1:2] == '{':
+                    # open call at the start of a segment
+                    tabs += 1
+                continue
+            elif line[0] == '{':
                 print('  ' * tabs + line)
                 tabs += 1
             elif line[0] == '}':
@@ -346,6 +1163,120 @@ class ShowCallSeqOutput(Action):
                 assert 0
 
 
+class ShowCallSeqWindow(Action):
+    """Shows the events of a CallSeq output within a time window.
+
+    The sparse index of the CallSeq output is used for finding the
+    start of the window.
+    """
+
+    def __init__(self, start_time=None, end_time=None):
+        self.start_time = None if start_time is None else int(start_time * 1e9)
+        self.end_time = None if end_time is None else int(end_time * 1e9)
+
+    def __call__(self, trace):
+        index = callseq.output.TraceIndex.get(trace)
+        for event, frame in index.window(start_time=self.start_time, end_time=self.end_time):
+            print('  ' * frame.depth + callseq.output.format_event(event))
+
+
+class ShowSiteLatencies(Action):
+    """Shows latency percentiles of the sites of a CallSeq output.
+
+    When jobs is specified, the CallSeq output is processed in parallel
+    chunks using its sparse index.
+    """
+
+    def __init__(self, top=None, jobs=None, relative_accuracy=0.01):
+        self.top = top
+        self.jobs = jobs
+        self.relative_accuracy = relative_accuracy
+
+    def __call__(self, trace):
+        if self.jobs is None:
+            latencies = callseq.analysis.SiteLatencies(self.relative_accuracy)
+            latencies.update(callseq.output.iter_events(trace))
+        else:
+            callseq.output.TraceIndex.get(trace)
+            latencies = callseq.analysis.parallel_site_latencies(
+                trace + '.idx', jobs=self.jobs, relative_accuracy=self.relative_accuracy)
+        print(latencies.tostring(top=self.top))
+        return latencies
+
+
+class ShowSlowestCalls(Action):
+    """Shows the slowest individual calls of a CallSeq output with their
+    call paths and context events.
+    """
+
+    def __init__(self, k=10, per_site=False, context=5):
+        self.k = k
+        self.per_site = per_site
+        self.context = context
+
+    def __call__(self, trace):
+        slowest = callseq.analysis.SlowestCalls(k=self.k, per_site=self.per_site,
+                                                context=self.context)
+        slowest.update(callseq.output.iter_events(trace))
+        print(slowest.tostring())
+        return slowest
+
+
+class ShowObjectLifetimes(Action):
+    """Shows per-instance statistics of the method calls of a CallSeq output.
+    """
+
+    def __init__(self, top=None, factor=10.0):
+        self.top = top
+        self.factor = factor
+
+    def __call__(self, trace):
+        lifetimes = callseq.analysis.ObjectLifetimes()
+        lifetimes.update(callseq.output.iter_events(trace))
+        print(lifetimes.tostring(top=self.top, factor=self.factor))
+        return lifetimes
+
+
+class ShowConcurrency(Action):
+    """Shows thread concurrency timeline and per-thread utilization of a
+    CallSeq output. When csv_path is specified, the timeline is written
+    also to a CSV file.
+    """
+
+    def __init__(self, buckets=50, csv_path=None):
+        self.buckets = buckets
+        self.csv_path = csv_path
+
+    def __call__(self, trace):
+        concurrency = callseq.analysis.Concurrency()
+        concurrency.update(callseq.output.iter_events(trace))
+        print(concurrency.tostring(buckets=self.buckets))
+        if self.csv_path is not None:
+            with open(self.csv_path, 'w', newline='') as f:
+                concurrency.write_csv(f, buckets=self.buckets)
+        return concurrency
+
+
+class ShowCallingContextTree(Action):
+    """Shows the calling-context tree of a CallSeq output.
+
+    When callers_of site id is specified, shows the inverted tree of
+    the callers of the site instead.
+    """
+
+    def __init__(self, max_depth=None, callers_of=None, min_fraction=0.0):
+        self.max_depth = max_depth
+        self.callers_of = callers_of
+        self.min_fraction = min_fraction
+
+    def __call__(self, trace):
+        cct = callseq.analysis.CallingContextTree()
+        cct.update(callseq.output.iter_events(trace))
+        node = None if self.callers_of is None else cct.callers(self.callers_of)
+        print(cct.tostring(node=node, max_depth=self.max_depth, min_fraction=self.min_fraction))
+        return cct
+
+
 class CMake(Action):
 
     def __init__(self, project_dir, build_dir, **env):
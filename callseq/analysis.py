@@ -0,0 +1,890 @@
+"""
+Analysis of CallSeq outputs.
+"""
+
+import math
+import heapq
+import bisect
+from array import array
+from collections import deque
+from callseq.output import CallStacks, TraceIndex, format_event, function_name
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class CCTNode:
+    """Node of a calling-context tree.
+
+    Node represents a unique call path from the root of the tree. The
+    key of a node is a site id.
+    """
+
+    __slots__ = ('key', 'parent', 'children', 'count', 'inclusive', 'exclusive')
+
+    def __init__(self, key, parent=None):
+        self.key = key
+        self.parent = parent
+        self.children = {}
+        self.count = 0
+        self.inclusive = 0
+        self.exclusive = 0
+
+    def __repr__(self):
+        return (f'{type(self).__name__}({self.key!r}, count={self.count},'
+                f' inclusive={self.inclusive}, exclusive={self.exclusive})')
+
+    def child(self, key):
+        node = self.children.get(key)
+        if node is None:
+            node = self.children[key] = CCTNode(key, self)
+        return node
+
+    def add(self, count, inclusive, exclusive):
+        self.count += count
+        self.inclusive += inclusive
+        self.exclusive += exclusive
+
+    def path(self):
+        """Return the list of keys from the root to this node, root excluded.
+        """
+        keys = []
+        node = self
+        while node.parent is not None:
+            keys.append(node.key)
+            node = node.parent
+        keys.reverse()
+        return keys
+
+    def walk(self):
+        """Iterate over the nodes of the subtree in pre-order.
+        """
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            yield node
+            nodes.extend(node.children.values())
+
+
+class CallingContextTree:
+    """Calling-context tree of a CallSeq output.
+
+    Call paths of all threads are merged into a single tree where
+    each node holds the number of calls and the total inclusive and
+    self (exclusive) time in nanoseconds of a call path. The root node
+    holds the totals of the outermost calls. The memory usage is
+    proportional to the number of distinct call paths.
+
+    When by_thread is True, the children of the root node represent
+    threads and have keys of the form `thread 0x<thread id>`.
+    """
+
+    def __init__(self, by_thread=False):
+        self.by_thread = by_thread
+        self.root = CCTNode(None)
+        self.stacks = CallStacks()
+        self.sites = self.stacks.sites
+
+    def node(self, frame):
+        """Return the tree node of a call stack frame.
+        """
+        if frame.data is None:
+            if frame.parent is not None:
+                parent = self.node(frame.parent)
+            elif self.by_thread:
+                parent = self.root.child(f'thread 0x{frame.thread:x}')
+            else:
+                parent = self.root
+            frame.data = parent.child(frame.site)
+        return frame.data
+
+    def update(self, events):
+        """Update the tree with a stream of events.
+        """
+        root = self.root
+        node = self.node
+        for event, frame in self.stacks(events):
+            if event.kind == '{':
+                node(frame)
+            else:
+                inclusive = frame.end - frame.start
+                node(frame).add(1, inclusive, inclusive - frame.children)
+                if frame.parent is None:
+                    root.add(1, inclusive, 0)
+                    if self.by_thread:
+                        frame.data.parent.add(1, inclusive, 0)
+        return self
+
+    def name(self, key):
+        if isinstance(key, str):
+            return key
+        signature, location = self.sites.get(key, (None, None))
+        if signature is None:
+            return f'<site {key}>'
+        return signature
+
+    def callers(self, site):
+        """Return inverted (bottom-up) tree of the callers of a site.
+
+        The root of the returned tree represents all calls of the site
+        and the children of a node represent the callers of the
+        corresponding call path. All nodes hold the statistics of the
+        site calls. Notice that in the case of recursion the inclusive
+        time of the root includes the nested calls.
+        """
+        inverted = CCTNode(site)
+        for node in self.root.walk():
+            if node.key != site or node is self.root:
+                continue
+            target = inverted
+            target.add(node.count, node.inclusive, node.exclusive)
+            caller = node.parent
+            while caller is not self.root:
+                target = target.child(caller.key)
+                target.add(node.count, node.inclusive, node.exclusive)
+                caller = caller.parent
+        return inverted
+
+    def tostring(self, node=None, max_depth=None, min_fraction=0.0):
+        """Return text rendering of the tree.
+
+        Nodes deeper than max_depth or with inclusive time smaller than
+        min_fraction of the total time are not shown.
+        """
+        if node is None:
+            node = self.root
+        total = node.inclusive or 1
+        lines = [f'{"calls":>10} {"inclusive[s]":>14} {"self[s]":>14}  function']
+
+        def render(node, depth):
+            if node.key is not None:
+                lines.append(f'{node.count:>10} {node.inclusive / 1e9:>14.9f}'
+                             f' {node.exclusive / 1e9:>14.9f}'
+                             f'  {"  " * depth}{self.name(node.key)}')
+                depth += 1
+            children = [child for child in node.children.values()
+                        if child.inclusive >= min_fraction * total]
+            if max_depth is not None and depth >= max_depth:
+                if children:
+                    lines.append(f'{"":>42}{"  " * depth}...')
+                return
+            for child in sorted(children, key=lambda child: -child.inclusive):
+                render(child, depth)
+
+        render(node, 0)
+        return '\n'.join(lines)
+
+
+def name_paths(cct, signatures=False):
+    """Return a mapping of call paths and their [count, inclusive, exclusive] statistics.
+
+    A call path is a tuple of function names (or full signatures when
+    signatures is True), so that the paths of different CallSeq outputs
+    can be compared even when site ids differ.
+    """
+    names = {}
+    paths = {}
+    for node in cct.root.walk():
+        if node is cct.root:
+            continue
+        if node.key not in names:
+            name = cct.name(node.key)
+            names[node.key] = name if signatures or isinstance(node.key, str) else (
+                function_name(name))
+        parent = node.parent
+        path = (paths[parent][0] if parent is not cct.root else ()) + (names[node.key],)
+        paths[node] = (path, node)
+    result = {}
+    for path, node in paths.values():
+        stats = result.get(path)
+        if stats is None:
+            result[path] = [node.count, node.inclusive, node.exclusive]
+        else:
+            stats[0] += node.count
+            stats[1] += node.inclusive
+            stats[2] += node.exclusive
+    return result
+
+
+def diff_trees(a, b, signatures=False):
+    """Compare the calling-context trees of two CallSeq outputs.
+
+    Returns a list of (path, stats_a, stats_b) tuples sorted by the
+    absolute change of inclusive time, where stats is [count,
+    inclusive, exclusive] or None when the path does not exist in the
+    corresponding tree.
+    """
+    paths_a = name_paths(a, signatures=signatures)
+    paths_b = name_paths(b, signatures=signatures)
+    rows = []
+    for path, stats_a in paths_a.items():
+        rows.append((path, stats_a, paths_b.pop(path, None)))
+    for path, stats_b in paths_b.items():
+        rows.append((path, None, stats_b))
+    zero = [0, 0, 0]
+
+    def impact(row):
+        path, stats_a, stats_b = row
+        stats_a, stats_b = stats_a or zero, stats_b or zero
+        return (-abs(stats_b[1] - stats_a[1]), -abs(stats_b[2] - stats_a[2]),
+                -abs(stats_b[0] - stats_a[0]), path)
+
+    rows.sort(key=impact)
+    return rows
+
+
+def diff_table(rows, top=None, min_change=0):
+    """Return a table of calling-context tree differences.
+
+    Rows with absolute change of inclusive time smaller than min_change
+    nanoseconds are not shown.
+    """
+    lines = [f'{"":>7} {"calls":>19} {"inclusive[s]":>25} {"self[s]":>25}  call path',
+             f'{"":>7} {"a":>9} {"b-a":>9} {"a":>12} {"b-a":>12} {"a":>12} {"b-a":>12}']
+    zero = [0, 0, 0]
+    count = 0
+    for path, stats_a, stats_b in rows:
+        if top is not None and count >= top:
+            break
+        status = 'added' if stats_a is None else ('removed' if stats_b is None else '')
+        stats_a, stats_b = stats_a or zero, stats_b or zero
+        if abs(stats_b[1] - stats_a[1]) < min_change:
+            continue
+        if not status and stats_a == stats_b:
+            continue
+        count += 1
+        lines.append(f'{status:>7} {stats_a[0]:>9} {stats_b[0] - stats_a[0]:>+9}'
+                     f' {stats_a[1] / 1e9:>12.6f} {(stats_b[1] - stats_a[1]) / 1e9:>+12.6f}'
+                     f' {stats_a[2] / 1e9:>12.6f} {(stats_b[2] - stats_a[2]) / 1e9:>+12.6f}'
+                     f'  {";".join(path)}')
+    return '\n'.join(lines)
+
+
+class FlatProfile:
+    """Flat profile of sites.
+
+    Holds the number of calls, the total inclusive and self time in
+    nanoseconds of each site. The profile can be updated incrementally.
+    """
+
+    def __init__(self):
+        self.stacks = CallStacks()
+        self.sites = self.stacks.sites
+        self.stats = {}  # site id -> [count, inclusive, exclusive]
+
+    def update(self, events):
+        stats = self.stats
+        for event, frame in self.stacks(events):
+            if event.kind == '}':
+                inclusive = frame.end - frame.start
+                s = stats.get(frame.site)
+                if s is None:
+                    stats[frame.site] = [1, inclusive, inclusive - frame.children]
+                else:
+                    s[0] += 1
+                    s[1] += inclusive
+                    s[2] += inclusive - frame.children
+        return self
+
+    def open_calls(self):
+        return sum(map(len, self.stacks.stacks.values()))
+
+    def tostring(self, top=None, key='exclusive'):
+        """Return a table of sites sorted by total self or inclusive time.
+        """
+        column = dict(count=0, inclusive=1, exclusive=2)[key]
+        lines = [f'{"calls":>10} {"inclusive[s]":>14} {"self[s]":>14}  function']
+        for site, (count, inclusive, exclusive) in sorted(
+                self.stats.items(), key=lambda item: -item[1][column])[:top]:
+            name = self.sites.get(site, (f'<site {site}>',))[0]
+            lines.append(f'{count:>10} {inclusive / 1e9:>14.9f} {exclusive / 1e9:>14.9f}  {name}')
+        return '\n'.join(lines)
+
+
+class SlowCall:
+    """Record of a slow call.
+
+    Holds the call path as a list of site ids, and the events preceding
+    and following the exit event of the call.
+    """
+
+    __slots__ = ('site', 'this', 'thread', 'start', 'end', 'path', 'event', 'before', 'after')
+
+    def __init__(self, frame, event, before):
+        self.site = frame.site
+        self.this = frame.this
+        self.thread = frame.thread
+        self.start = frame.start
+        self.end = frame.end
+        self.path = frame.path()
+        self.event = event
+        self.before = before
+        self.after = []
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class SlowestCalls:
+    """The K longest individual calls of a CallSeq output.
+
+    The calls are kept in bounded min-heaps, either one for all calls
+    or one per site when per_site is True, so that the memory usage does
+    not depend on the length of the trace. With each call, context
+    events before and after its exit event are recorded.
+    """
+
+    def __init__(self, k=10, per_site=False, context=5):
+        self.k = k
+        self.per_site = per_site
+        self.context = context
+        self.stacks = CallStacks()
+        self.sites = self.stacks.sites
+        self.heaps = {}  # site id or None -> [(duration, call id, SlowCall)]
+        self.recent = deque(maxlen=context)
+        self.pending = []  # slow calls waiting for the events after
+
+    def update(self, events):
+        k, recent, heaps = self.k, self.recent, self.heaps
+        for event, frame in self.stacks(events):
+            if self.pending:
+                for call in self.pending:
+                    call.after.append(event)
+                self.pending = [call for call in self.pending
+                                if len(call.after) < self.context]
+            if event.kind == '}':
+                duration = frame.end - frame.start
+                key = frame.site if self.per_site else None
+                heap = heaps.get(key)
+                if heap is None:
+                    heap = heaps[key] = []
+                if len(heap) < k or duration > heap[0][0]:
+                    call = SlowCall(frame, event, list(recent))
+                    item = (duration, frame.call_id, call)
+                    if len(heap) < k:
+                        heapq.heappush(heap, item)
+                    else:
+                        heapq.heapreplace(heap, item)
+                    if self.context:
+                        self.pending.append(call)
+            recent.append(event)
+        return self
+
+    def calls(self, site=None):
+        """Return the slowest calls in decreasing order of duration.
+        """
+        return [call for _, _, call in sorted(self.heaps.get(site, ()), reverse=True)]
+
+    def tostring(self, signatures=False):
+        def name(site):
+            signature = self.sites.get(site, (f'<site {site}>',))[0]
+            return signature if signatures else function_name(signature)
+
+        lines = []
+        for key in sorted(self.heaps, key=lambda key: -max(self.heaps[key])[0]):
+            for call in self.calls(key):
+                lines.append(f'{call.duration / 1e9:.9f}s  thread=0x{call.thread:x}'
+                             f' this=0x{call.this:x} start={call.start / 1e9:.9f}'
+                             f'  {self.sites.get(call.site, (f"<site {call.site}>",))[0]}')
+                lines.append('  path: ' + ' > '.join(map(name, call.path)))
+                for event in call.before:
+                    lines.append('    ' + format_event(event))
+                lines.append('  > ' + format_event(call.event))
+                for event in call.after:
+                    lines.append('    ' + format_event(event))
+        return '\n'.join(lines)
+
+
+def split_scope(name):
+    """Split a qualified function name into its scope and unqualified name.
+
+    For example, `ns::A<T>::bar` gives `('ns::A<T>', 'bar')`.
+    """
+    depth = 0
+    for i in range(len(name) - 1, 0, -1):
+        c = name[i]
+        if c == '>':
+            depth += 1
+        elif c == '<':
+            depth -= 1
+        elif depth == 0 and c == ':' and name[i - 1] == ':':
+            return name[:i - 1], name[i + 1:]
+    return '', name
+
+
+class ObjectStats:
+    """Statistics of the calls of an object.
+    """
+
+    __slots__ = ('cls', 'this', 'generation', 'count', 'inclusive', 'exclusive', 'first',
+                 'last', 'constructed', 'destroyed', 'open', 'constructing')
+
+    def __init__(self, cls, this, generation, start):
+        self.cls = cls
+        self.this = this
+        self.generation = generation
+        self.count = 0
+        self.inclusive = 0  # time of the outermost calls of the object
+        self.exclusive = 0
+        self.first = start
+        self.last = start
+        self.constructed = False
+        self.destroyed = False
+        self.open = 0  # number of open calls of the object
+        self.constructing = 0  # number of open constructor calls
+
+    @property
+    def lifetime(self):
+        return self.last - self.first
+
+
+class ObjectLifetimes:
+    """Per-instance statistics of method calls.
+
+    Calls are aggregated by (class, this) where the class is the scope
+    of the called method. Since addresses are reused after objects are
+    destroyed, a new generation of (class, this) is started when a
+    constructor is entered for an object that has been used already
+    outside of its constructors, or when the object is used after its
+    destructor has returned. Calls with null this are ignored.
+    """
+
+    def __init__(self):
+        self.stacks = CallStacks()
+        self.sites = self.stacks.sites
+        self.kinds = {}  # site id -> (class, kind) where kind is 'ctor', 'dtor' or ''
+        self.current = {}  # (class, this) -> ObjectStats
+        self.objects = []
+
+    def kind(self, site):
+        kind = self.kinds.get(site)
+        if kind is None:
+            cls, name = split_scope(function_name(self.sites[site][0]))
+            base = split_scope(cls)[1]
+            i = base.find('<')
+            if i != -1:
+                base = base[:i]
+            kind = self.kinds[site] = (cls, 'ctor' if name == base else (
+                'dtor' if name == '~' + base else ''))
+        return kind
+
+    def update(self, events):
+        current = self.current
+        for event, frame in self.stacks(events):
+            if frame.this == 0:
+                continue
+            cls, kind = self.kind(frame.site)
+            if not cls:
+                continue
+            key = cls, frame.this
+            stats = current.get(key)
+            if event.kind == '{':
+                if stats is None or stats.destroyed or (
+                        kind == 'ctor' and not stats.constructing and stats.count):
+                    stats = current[key] = ObjectStats(
+                        cls, frame.this, 0 if stats is None else stats.generation + 1,
+                        frame.start)
+                    self.objects.append(stats)
+                stats.open += 1
+                if kind == 'ctor':
+                    stats.constructed = True
+                    stats.constructing += 1
+                frame.data = stats
+                continue
+            stats = frame.data
+            if stats is None:
+                continue
+            stats.count += 1
+            stats.exclusive += frame.end - frame.start - frame.children
+            stats.last = frame.end
+            stats.open -= 1
+            if not stats.open:
+                stats.inclusive += frame.end - frame.start
+            if kind == 'ctor':
+                stats.constructing -= 1
+            elif kind == 'dtor':
+                stats.destroyed = True
+        return self
+
+    def hot_objects(self, factor=10.0):
+        """Return the objects with inclusive time larger than factor times
+        the median inclusive time of the objects of the same class.
+        """
+        classes = {}
+        for stats in self.objects:
+            classes.setdefault(stats.cls, []).append(stats.inclusive)
+        medians = {}
+        for cls, values in classes.items():
+            if len(values) > 1:
+                values.sort()
+                medians[cls] = values[(len(values) - 1) // 2]
+        return [stats for stats in self.objects
+                if stats.cls in medians and stats.inclusive > factor * medians[stats.cls]]
+
+    def tostring(self, top=None, factor=10.0):
+        """Return a table of objects sorted by inclusive time.
+
+        Hot objects are marked with `*`.
+        """
+        hot = set(map(id, self.hot_objects(factor=factor)))
+        lines = [f'  {"calls":>10} {"inclusive[s]":>14} {"self[s]":>14} {"first[s]":>14}'
+                 f' {"lifetime[s]":>14}  object']
+        for stats in sorted(self.objects, key=lambda stats: -stats.inclusive)[:top]:
+            mark = '*' if id(stats) in hot else ' '
+            life = ('c' if stats.constructed else '-') + ('d' if stats.destroyed else '-')
+            lines.append(f'{mark} {stats.count:>10} {stats.inclusive / 1e9:>14.9f}'
+                         f' {stats.exclusive / 1e9:>14.9f} {stats.first / 1e9:>14.9f}'
+                         f' {stats.lifetime / 1e9:>14.9f}  {life} {stats.cls}'
+                         f' 0x{stats.this:x}#{stats.generation}')
+        return '\n'.join(lines)
+
+
+def _coverage(starts, ends, points):
+    # numpy version of coverage, the arguments are int64 arrays
+    start_sums = numpy.concatenate(([0], numpy.cumsum(starts)))
+    end_sums = numpy.concatenate(([0], numpy.cumsum(ends)))
+    n = numpy.searchsorted(starts, points)
+    m = numpy.searchsorted(ends, points)
+    return (n - m) * points - start_sums[n] + end_sums[m]
+
+
+def coverage(starts, ends, points):
+    """Return the total length of intervals [start, end) before each point.
+
+    starts and ends must be sorted. The coverage at x is
+    sum(x - start for start < x) - sum(x - end for end < x) which is
+    evaluated with binary searches over prefix sums.
+    """
+    if numpy is not None:
+        return _coverage(numpy.asarray(starts, dtype=numpy.int64),
+                         numpy.asarray(ends, dtype=numpy.int64),
+                         numpy.asarray(points, dtype=numpy.int64)).tolist()
+    start_sums = [0]
+    for value in starts:
+        start_sums.append(start_sums[-1] + value)
+    end_sums = [0]
+    for value in ends:
+        end_sums.append(end_sums[-1] + value)
+    result = []
+    for x in points:
+        n = bisect.bisect_left(starts, x)
+        m = bisect.bisect_left(ends, x)
+        result.append((n - m) * x - start_sums[n] + end_sums[m])
+    return result
+
+
+class Concurrency:
+    """Thread concurrency of instrumented code.
+
+    A thread is inside instrumented code during its outermost calls.
+    The intervals of outermost calls are collected in columns and the
+    number of concurrent threads over time buckets is computed with
+    interval arithmetic, see coverage.
+    """
+
+    sparks = ' ▁▂▃▄▅▆▇█'
+
+    def __init__(self):
+        self.stacks = CallStacks()
+        self.sites = self.stacks.sites
+        self.starts = array('q')
+        self.ends = array('q')
+        self.call_sites = array('q')
+        self.busy = {}  # thread -> total time in outermost calls
+        self.spans = {}  # thread -> [first, last] timestamp
+        self.first = None
+        self.last = None
+
+    def update(self, events):
+        spans, busy = self.spans, self.busy
+        for event, frame in self.stacks(events):
+            span = spans.get(event.thread)
+            if span is None:
+                spans[event.thread] = [event.timestamp, event.timestamp]
+                busy[event.thread] = 0
+            else:
+                span[1] = event.timestamp
+            if event.kind == '}' and frame.depth == 0:
+                self.starts.append(frame.start)
+                self.ends.append(frame.end)
+                self.call_sites.append(frame.site)
+                busy[event.thread] += frame.end - frame.start
+            if self.first is None:
+                self.first = event.timestamp
+            self.last = event.timestamp
+        return self
+
+    def timeline(self, buckets=50):
+        """Return (edges, concurrency, top_sites) of time buckets.
+
+        concurrency is the average number of threads inside instrumented
+        code in each bucket and top_sites contains the outermost site
+        with the largest time in each bucket (None for idle buckets).
+        """
+        first, last = self.first, self.last
+        if first is None:
+            return [], [], []
+        width = max(1, -(-(last - first) // buckets))
+        edges = [first + i * width for i in range(buckets + 1)]
+        if numpy is not None:
+            return (edges,) + self._timeline_numpy(edges, width)
+        by_site = {}
+        for i, site in enumerate(self.call_sites):
+            by_site.setdefault(site, []).append(i)
+
+        def bucket_times(indices):
+            starts = sorted(self.starts[i] for i in indices)
+            ends = sorted(self.ends[i] for i in indices)
+            c = coverage(starts, ends, edges)
+            return [c[i + 1] - c[i] for i in range(buckets)]
+
+        total = bucket_times(range(len(self.starts)))
+        concurrency = [t / width for t in total]
+        top_sites = [None] * buckets
+        top_times = [0] * buckets
+        for site, indices in by_site.items():
+            for i, t in enumerate(bucket_times(indices)):
+                if t > top_times[i]:
+                    top_times[i] = t
+                    top_sites[i] = site
+        return edges, concurrency, top_sites
+
+    def _timeline_numpy(self, edges, width):
+        starts = numpy.asarray(self.starts, dtype=numpy.int64)
+        ends = numpy.asarray(self.ends, dtype=numpy.int64)
+        sites = numpy.asarray(self.call_sites, dtype=numpy.int64)
+        edges = numpy.asarray(edges, dtype=numpy.int64)
+
+        def bucket_times(starts, ends):
+            return numpy.diff(_coverage(numpy.sort(starts), numpy.sort(ends), edges))
+
+        concurrency = bucket_times(starts, ends) / width
+        # group calls by sites
+        order = numpy.argsort(sites, kind='stable')
+        unique_sites, bounds = numpy.unique(sites[order], return_index=True)
+        bounds = numpy.append(bounds, len(order))
+        times = numpy.zeros((len(unique_sites), len(edges) - 1), dtype=numpy.int64)
+        for k in range(len(unique_sites)):
+            indices = order[bounds[k]:bounds[k + 1]]
+            times[k] = bucket_times(starts[indices], ends[indices])
+        top_sites = [None] * (len(edges) - 1)
+        if len(unique_sites):
+            top = times.argmax(axis=0)
+            busy = times[top, numpy.arange(len(top))] > 0
+            for i in numpy.flatnonzero(busy).tolist():
+                top_sites[i] = int(unique_sites[top[i]])
+        return concurrency.tolist(), top_sites
+
+    def sparkline(self, concurrency, maximum=None):
+        maximum = maximum or max(concurrency, default=0) or 1
+        n = len(self.sparks) - 1
+        return ''.join(self.sparks[min(n, math.ceil(value / maximum * n))]
+                       for value in concurrency)
+
+    def tostring(self, buckets=50, sparkline=True):
+        edges, concurrency, top_sites = self.timeline(buckets=buckets)
+        lines = []
+        if sparkline and concurrency:
+            lines.append(f'threads |{self.sparkline(concurrency, len(self.spans))}|'
+                         f' max={len(self.spans)}')
+        lines.append(f'{"start[s]":>14} {"threads":>8}  top function')
+        for i, value in enumerate(concurrency):
+            site = top_sites[i]
+            name = '' if site is None else function_name(self.sites[site][0])
+            lines.append(f'{edges[i] / 1e9:>14.9f} {value:>8.2f}  {name}')
+        lines.append(f'{"thread":>18} {"busy[s]":>14} {"span[s]":>14} {"busy%":>7}')
+        for thread, (first, last) in sorted(self.spans.items()):
+            busy = self.busy[thread]
+            span = last - first
+            lines.append(f'{"0x%x" % thread:>18} {busy / 1e9:>14.9f} {span / 1e9:>14.9f}'
+                         f' {100 * busy / span if span else 0:>7.1f}')
+        elapsed = (self.last - self.first) if self.first is not None else 0
+        if elapsed and self.spans:
+            efficiency = sum(self.busy.values()) / (elapsed * len(self.spans))
+            lines.append(f'parallel efficiency: {100 * efficiency:.1f}%'
+                         f' of {len(self.spans)} threads')
+        return '\n'.join(lines)
+
+    def write_csv(self, f, buckets=50):
+        """Write the timeline as CSV rows of start, threads and top function.
+        """
+        import csv
+        edges, concurrency, top_sites = self.timeline(buckets=buckets)
+        writer = csv.writer(f)
+        writer.writerow(['start_ns', 'threads', 'top_function'])
+        for i, value in enumerate(concurrency):
+            site = top_sites[i]
+            name = '' if site is None else function_name(self.sites[site][0])
+            writer.writerow([edges[i], f'{value:.6f}', name])
+
+
+class LatencySketch:
+    """Mergeable quantile sketch of latencies.
+
+    Latencies are counted in logarithmically sized buckets (DDSketch)
+    so that the quantile estimates have relative error of at most
+    relative_accuracy. When the number of buckets exceeds max_buckets,
+    the lowest buckets are collapsed, so the memory usage is fixed.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        buckets = self.buckets
+        buckets[key] = buckets.get(key, 0) + 1
+        if len(buckets) > self.max_buckets:
+            self.collapse()
+
+    def collapse(self):
+        keys = sorted(self.buckets)
+        n = len(keys) - self.max_buckets
+        if n <= 0:
+            return
+        count = sum(self.buckets.pop(key) for key in keys[:n])
+        self.buckets[keys[n]] += count
+
+    def merge(self, other):
+        assert self.gamma == other.gamma, (self.gamma, other.gamma)
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        self.collapse()
+        return self
+
+    def quantile(self, q):
+        """Return the estimate of q-quantile, 0 <= q <= 1.
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return 0
+        n = self.zeros
+        for key in sorted(self.buckets):
+            n += self.buckets[key]
+            if n > rank:
+                value = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+
+class SiteLatencies:
+    """Latency distributions of sites.
+
+    Keeps inclusive and self latency sketches for each site id.
+    SiteLatencies of different chunks of a CallSeq output or of
+    different CallSeq outputs can be merged.
+    """
+
+    quantiles = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048, stacks=None):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.stacks = CallStacks() if stacks is None else stacks
+        self.sites = self.stacks.sites
+        self.inclusive = {}
+        self.exclusive = {}
+
+    def sketches(self, site):
+        inclusive = self.inclusive.get(site)
+        if inclusive is None:
+            inclusive = self.inclusive[site] = LatencySketch(self.relative_accuracy,
+                                                             self.max_buckets)
+            self.exclusive[site] = LatencySketch(self.relative_accuracy, self.max_buckets)
+        return inclusive, self.exclusive[site]
+
+    def update(self, events):
+        """Update the sketches with a stream of events.
+        """
+        for event, frame in self.stacks(events):
+            if event.kind == '}':
+                inclusive, exclusive = self.sketches(frame.site)
+                value = frame.end - frame.start
+                inclusive.add(value)
+                exclusive.add(value - frame.children)
+        return self
+
+    def merge(self, other):
+        for site, (signature, location) in other.sites.items():
+            self.sites.setdefault(site, (signature, location))
+        for site in other.inclusive:
+            inclusive, exclusive = self.sketches(site)
+            inclusive.merge(other.inclusive[site])
+            exclusive.merge(other.exclusive[site])
+        return self
+
+    def tostring(self, top=None):
+        """Return a table of latency quantiles in microseconds.
+
+        Sites are sorted by the total inclusive time.
+        """
+        qs = ' '.join(f'{"p" + format(q * 100, "g"):>9}' for q in self.quantiles)
+        lines = [f'{"calls":>10} {qs} | {qs}  function',
+                 f'{"":>10} {"inclusive[us]":^{len(qs)}} | {"self[us]":^{len(qs)}}']
+        sites = sorted(self.inclusive, key=lambda site: -self.inclusive[site].total)
+        for site in sites[:top]:
+            inclusive, exclusive = self.inclusive[site], self.exclusive[site]
+            values = [' '.join(f'{sketch.quantile(q) / 1000:>9.3f}' for q in self.quantiles)
+                      for sketch in (inclusive, exclusive)]
+            name = self.sites.get(site, (f'<site {site}>',))[0]
+            lines.append(f'{inclusive.count:>10} {values[0]} | {values[1]}  {name}')
+        return '\n'.join(lines)
+
+
+def _site_latencies_chunk(args):
+    index_path, i, relative_accuracy, max_buckets = args
+    index = TraceIndex.load(index_path)
+    checkpoint = index.checkpoints[i]
+    count = None
+    if i + 1 < len(index.checkpoints):
+        count = index.checkpoints[i + 1][1] - checkpoint[1]
+    latencies = SiteLatencies(relative_accuracy, max_buckets, stacks=index.restore(checkpoint))
+    latencies.update(index.events(checkpoint, count=count))
+    latencies.stacks.stacks.clear()  # not needed for merging
+    return latencies
+
+
+def parallel_site_latencies(index_path, jobs=None, relative_accuracy=0.01, max_buckets=2048):
+    """Compute SiteLatencies of an indexed CallSeq output using a process pool.
+
+    The chunks between the checkpoints of the index are processed in
+    parallel and the results are merged.
+    """
+    import multiprocessing
+    index = TraceIndex.load(index_path)
+    tasks = [(index_path, i, relative_accuracy, max_buckets)
+             for i in range(len(index.checkpoints))]
+    result = SiteLatencies(relative_accuracy, max_buckets)
+    with multiprocessing.Pool(jobs) as pool:
+        for latencies in pool.imap(_site_latencies_chunk, tasks):
+            result.merge(latencies)
+    return result
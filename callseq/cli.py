@@ -1,15 +1,272 @@
 
 import os
+import re
+import sys
+import time
 import callseq
+import callseq.analysis
+import callseq.compare
+import callseq.counters
+import callseq.export
+import callseq.output
 import argparse
 
 
+def main_cxx_export(argv):
+    parser = argparse.ArgumentParser(
+        prog='callseq++ export',
+        description='Export CallSeq output to the formats of other tools')
+    parser.add_argument('path', type=str, help='Path to CallSeq output file')
+    parser.add_argument('--folded', default=False, action='store_true',
+                        help='Export folded stacks for flame graphs (default: %(default)s)')
+    parser.add_argument('--chrome-trace', default=False, action='store_true',
+                        help='Export Trace Event Format JSON for chrome://tracing and Perfetto'
+                        ' (default: %(default)s)')
+    parser.add_argument('--complete-events', default=False, action='store_true',
+                        help='Write calls as complete (X) events instead of begin/end pairs'
+                        ' (default: %(default)s)')
+    parser.add_argument('--max-size', type=float, default=None,
+                        help='Split Trace Event Format output into files of given size in MB'
+                        ' (default: %(default)s)')
+    parser.add_argument('--sqlite', default=False, action='store_true',
+                        help='Export calls to SQLite database (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=100000,
+                        help='Number of rows per SQLite insert batch (default: %(default)s)')
+    parser.add_argument('--per-thread', default=False, action='store_true',
+                        help='Keep the stacks of threads separate (default: %(default)s)')
+    parser.add_argument('--signatures', default=False, action='store_true',
+                        help='Use full signatures instead of function names'
+                        ' (default: %(default)s)')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Path to output file (default: stdout)')
+
+    args = parser.parse_args(argv)
+    if args.folded:
+        cct = callseq.analysis.CallingContextTree(by_thread=args.per_thread)
+        cct.update(callseq.output.iter_events(args.path))
+        f = sys.stdout if args.output is None else open(args.output, 'w')
+        callseq.export.write_folded(cct, f, signatures=args.signatures)
+        if f is not sys.stdout:
+            f.close()
+    elif args.chrome_trace:
+        output = args.output if args.output is not None else args.path + '.json'
+        max_size = None if args.max_size is None else int(args.max_size * 1024 * 1024)
+        writer = callseq.export.ChromeTraceWriter(
+            output, complete=args.complete_events, max_size=max_size, signatures=args.signatures)
+        for path in writer(callseq.output.iter_events(args.path)):
+            print(f'Wrote {path}')
+    elif args.sqlite:
+        output = args.output if args.output is not None else args.path + '.sqlite'
+        count = callseq.export.write_sqlite(callseq.output.iter_events(args.path), output,
+                                            batch_size=args.batch_size)
+        print(f'Wrote {count} calls to {output}')
+    else:
+        parser.error('no export format specified')
+
+
+def main_cxx_index(argv):
+    parser = argparse.ArgumentParser(
+        prog='callseq++ index',
+        description='Build sparse index of CallSeq output for random access')
+    parser.add_argument('path', type=str, help='Path to CallSeq output file')
+    parser.add_argument('--interval', type=int, default=100000,
+                        help='Number of events between index checkpoints (default: %(default)s)')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Path to index file (default: <path>.idx)')
+
+    args = parser.parse_args(argv)
+    index = callseq.output.TraceIndex.build(args.path, interval=args.interval)
+    print(f'Wrote {index.save(args.output)}')
+
+
+def main_cxx_merge(argv):
+    parser = argparse.ArgumentParser(
+        prog='callseq++ merge',
+        description='Merge CallSeq outputs of several processes by timestamps')
+    parser.add_argument('path', type=str, nargs='+', help='Path to CallSeq output file')
+    parser.add_argument('-o', '--output', type=str, default='callseq.output',
+                        help='Path to merged output file (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    if os.path.abspath(args.output) in map(os.path.abspath, args.path):
+        parser.error(f'output file {args.output} is one of the input files')
+    with open(args.output, 'w') as f:
+        count = callseq.output.merge_traces(args.path, f)
+    print(f'Merged {count} events from {len(args.path)} files to {args.output}')
+
+
+def main_cxx_tail(argv):
+    parser = argparse.ArgumentParser(
+        prog='callseq++ tail',
+        description='Follow growing CallSeq output and show continuously updated profile')
+    parser.add_argument('path', type=str, help='Path to CallSeq output file')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='Refresh interval in seconds (default: %(default)s)')
+    parser.add_argument('--top', type=int, default=20,
+                        help='Number of shown sites (default: %(default)s)')
+    parser.add_argument('--sort', type=str, default='exclusive',
+                        choices=['count', 'inclusive', 'exclusive'],
+                        help='Sort sites by the given column (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=None,
+                        help='Stop after given number of refreshes (default: run forever)')
+
+    args = parser.parse_args(argv)
+    follower = callseq.output.TraceFollower(args.path)
+    profile = callseq.analysis.FlatProfile()
+    iteration = 0
+    try:
+        while args.iterations is None or iteration < args.iterations:
+            events = follower.poll()
+            if follower.restarted:
+                profile = callseq.analysis.FlatProfile()
+            profile.update(events)
+            if sys.stdout.isatty():
+                print('\x1b[H\x1b[2J', end='')
+            print(f'{follower.current or args.path}: {follower.offset} bytes,'
+                  f' {profile.stacks.ncalls} calls,'
+                  f' {profile.open_calls()} open calls')
+            print(profile.tostring(top=args.top, key=args.sort), flush=True)
+            iteration += 1
+            if args.iterations is None or iteration < args.iterations:
+                time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        follower.close()
+
+
+def main_cxx_top(argv):
+    parser = argparse.ArgumentParser(
+        prog='callseq++ top',
+        description='Show the hottest functions from CallSeq shared counters'
+        ' of a running application')
+    parser.add_argument('path', type=str, help='Path to CallSeq counters file')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='Refresh interval in seconds (default: %(default)s)')
+    parser.add_argument('--top', type=int, default=20,
+                        help='Number of shown sites (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=None,
+                        help='Stop after given number of refreshes (default: run forever)')
+
+    args = parser.parse_args(argv)
+    counters = callseq.counters.SharedCounters(args.path)
+    previous = None
+    iteration = 0
+    try:
+        while args.iterations is None or iteration < args.iterations:
+            current = counters.read()
+            if sys.stdout.isatty():
+                print('\x1b[H\x1b[2J', end='')
+            print(f'{args.path}: pid {counters.pid}, {len(current)} sites')
+            print(callseq.counters.counters_table(
+                current, previous, interval=args.interval if previous else None,
+                top=args.top), flush=True)
+            previous = current
+            iteration += 1
+            if args.iterations is None or iteration < args.iterations:
+                time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        counters.close()
+
+
+def main_cxx_diff(argv):
+    parser = argparse.ArgumentParser(
+        prog='callseq++ diff',
+        description='Compare the calling-context trees of two CallSeq outputs')
+    parser.add_argument('a', type=str, help='Path to CallSeq output file (before)')
+    parser.add_argument('b', type=str, help='Path to CallSeq output file (after)')
+    parser.add_argument('--top', type=int, default=50,
+                        help='Number of shown call paths (default: %(default)s)')
+    parser.add_argument('--min-change', type=float, default=0,
+                        help='Minimal change of inclusive time in seconds (default: %(default)s)')
+    parser.add_argument('--signatures', default=False, action='store_true',
+                        help='Use full signatures instead of function names'
+                        ' (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    a = callseq.analysis.CallingContextTree().update(callseq.output.iter_events(args.a))
+    b = callseq.analysis.CallingContextTree().update(callseq.output.iter_events(args.b))
+    rows = callseq.analysis.diff_trees(a, b, signatures=args.signatures)
+    print(callseq.analysis.diff_table(rows, top=args.top, min_change=args.min_change * 1e9))
+
+
+def main_cxx_compare(argv):
+    parser = argparse.ArgumentParser(
+        prog='callseq++ compare',
+        description='Compare site latencies of repeated runs of two variants')
+    parser.add_argument('-a', type=str, nargs='+', required=True,
+                        help='Paths to CallSeq output files of variant a (before)')
+    parser.add_argument('-b', type=str, nargs='+', required=True,
+                        help='Paths to CallSeq output files of variant b (after)')
+    parser.add_argument('--alpha', type=float, default=0.05,
+                        help='Significance level of Holm-corrected p-values'
+                        ' (default: %(default)s)')
+    parser.add_argument('--min-effect', type=float, default=0.05,
+                        help='Minimal relative change of median latency (default: %(default)s)')
+    parser.add_argument('--min-calls', type=int, default=20,
+                        help='Minimal number of calls per variant (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=1000,
+                        help='Number of bootstrap iterations (default: %(default)s)')
+    parser.add_argument('--max-samples', type=int, default=100000,
+                        help='Maximal number of kept durations per site and run'
+                        ' (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of random number generators (default: %(default)s)')
+    parser.add_argument('--top', type=int, default=None,
+                        help='Number of shown sites (default: %(default)s)')
+    parser.add_argument('--all', default=False, action='store_true',
+                        help='Show also the sites without significant changes'
+                        ' (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    a = callseq.compare.load_durations(args.a, max_samples=args.max_samples, seed=args.seed)
+    b = callseq.compare.load_durations(args.b, max_samples=args.max_samples, seed=args.seed)
+    rows = callseq.compare.compare_runs(a, b, alpha=args.alpha, min_effect=args.min_effect,
+                                        min_calls=args.min_calls, iterations=args.iterations,
+                                        seed=args.seed)
+    print(callseq.compare.comparison_table(rows, top=args.top, show_all=args.all))
+
+
+def main_cxx_cc(argv):
+    parser = argparse.ArgumentParser(
+        prog='callseq++ cc',
+        description='Compiler launcher that compiles instrumented copies of C++ sources,'
+        ' e.g. use -DCMAKE_CXX_COMPILER_LAUNCHER="callseq++;cc;--"')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory of instrumented sources'
+                        ' (default: ~/.cache/callseq/cc)')
+    parser.add_argument('--backend', type=str, default='auto',
+                        choices=['auto', 'libclang', 'subprocess'],
+                        help='Method of reading C++ ASTs (default: %(default)s)')
+    parser.add_argument('-D', dest='defines', type=str, action='append', default=None,
+                        help='Defines for reading C++ ASTs (default: %(default)s)')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='Compiler command, e.g. -- g++ -c foo.cpp -o foo.o')
+
+    args = parser.parse_args(argv)
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        parser.error('compiler command is required')
+    launcher = callseq.actions.CompilerLauncher(cache_dir=args.cache_dir, defines=args.defines,
+                                                backend=args.backend)
+    return launcher(command)
+
+
+commands = dict(export=main_cxx_export, index=main_cxx_index, merge=main_cxx_merge,
+                tail=main_cxx_tail, top=main_cxx_top, diff=main_cxx_diff,
+                compare=main_cxx_compare, cc=main_cxx_cc)
+
+
 def main_cxx():
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        return commands[sys.argv[1]](sys.argv[2:])
     std = 'C++'
     parser = argparse.ArgumentParser(
         description='Runtime calling tree generation tool for C++ software')
     parser.add_argument(
-        'path', type=str, nargs='+', help='Path to C++ file (header or source) or directory')
+        'path', type=str, nargs='*', help='Path to C++ file (header or source) or directory')
     parser.add_argument(
         '-r', '--recursive', default=False, action='store_true',
         help='Recursively collect C++ files from specified paths (default: %(default)s)')
@@ -20,6 +277,41 @@ def main_cxx():
     parser.add_argument('-D', dest='defines',
                         type=str, action='append',
                         help='Extra CPP-macro defines for clang command (default: %(default)r)')
+    parser.add_argument('--compile-commands', type=str, default=None,
+                        help='Path to compile_commands.json, the sources and their flags are'
+                        ' taken from the compilation database (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=8,
+                        help='Number of C++ files with the same flags read per clang call'
+                        ' (default: %(default)s)')
+    parser.add_argument('--prelude', type=str, default=None,
+                        help='Header to be precompiled for reading ASTs of C++ files, use'
+                        ' "auto" for the common system includes of sources'
+                        ' (default: %(default)s)')
+    parser.add_argument('--pch-dir', type=str, default=None,
+                        help='Cache directory of precompiled headers'
+                        ' (default: ~/.cache/callseq/pch)')
+    parser.add_argument('--ast-dump-filter', type=str, default=None,
+                        help='Read only the declarations with matching qualified names, for'
+                        ' instance, a project namespace (default: %(default)s)')
+    parser.add_argument('--main-file-only', default=False, action='store_true',
+                        help='Read only the declarations of the processed file, headers must'
+                        ' be processed separately (default: %(default)s)')
+    parser.add_argument('--backend', type=str, default='auto',
+                        choices=['auto', 'libclang', 'subprocess'],
+                        help='Read ASTs using libclang Python bindings or clang++ -ast-dump'
+                        ' (default: %(default)s)')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='Path to manifest file for incremental apply: only the files'
+                        ' changed since the last apply are processed (default: %(default)s)')
+    parser.add_argument('--output-tree', type=str, default=None,
+                        help='Mirror --source-root to given directory using hard links and'
+                        ' write the instrumented files there instead of modifying the'
+                        ' sources (default: %(default)s)')
+    parser.add_argument('--watch', default=False, action='store_true',
+                        help='Keep running and apply callseq hooks to modified C++ files'
+                        ' (default: %(default)s)')
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help='Polling interval of --watch in seconds (default: %(default)s)')
     parser.add_argument('--source-root', type=str, default='',
                         help='Root path of C++ sources (default: %(default)s)')
     parser.add_argument('--try-run', default=False, action='store_true',
@@ -28,30 +320,111 @@ def main_cxx():
                         help='Output  modifications as ndiff (default: %(default)s)')
     parser.add_argument('--verbose', default=False, action='store_true',
                         help='Be verbose (default: %(default)s)')
+    parser.add_argument('--calling-context-tree', default=False, action='store_true',
+                        help='Show calling-context tree of callseq.output (default: %(default)s)')
+    parser.add_argument('--callers-of', type=int, default=None,
+                        help='Show inverted calling-context tree of the callers of a site id'
+                        ' (default: %(default)s)')
+    parser.add_argument('--max-depth', type=int, default=None,
+                        help='Maximal depth of shown calling-context tree (default: %(default)s)')
+    parser.add_argument('--percentiles', default=False, action='store_true',
+                        help='Show latency percentiles of callseq.output sites'
+                        ' (default: %(default)s)')
+    parser.add_argument('--top', type=int, default=None,
+                        help='Show only given number of top entries (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Number of parallel processes of --percentiles or threads of'
+                        ' --unapply (default: %(default)s)')
+    parser.add_argument('--start-time', type=float, default=None,
+                        help='Show callseq.output events starting from given time in seconds,'
+                        ' uses callseq.output.idx index file (default: %(default)s)')
+    parser.add_argument('--end-time', type=float, default=None,
+                        help='Show callseq.output events until given time in seconds'
+                        ' (default: %(default)s)')
+    parser.add_argument('--slowest', type=int, default=None,
+                        help='Show given number of slowest calls of callseq.output'
+                        ' (default: %(default)s)')
+    parser.add_argument('--per-site', default=False, action='store_true',
+                        help='Show slowest calls per site (default: %(default)s)')
+    parser.add_argument('--context', type=int, default=5,
+                        help='Number of events shown before and after slow calls'
+                        ' (default: %(default)s)')
+    parser.add_argument('--objects', default=False, action='store_true',
+                        help='Show per-instance statistics of callseq.output method calls'
+                        ' (default: %(default)s)')
+    parser.add_argument('--hot-factor', type=float, default=10.0,
+                        help='Mark objects with inclusive time larger than given factor times'
+                        ' the median of their class (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='Show thread concurrency of callseq.output in given number of'
+                        ' time buckets (default: %(default)s)')
+    parser.add_argument('--csv', type=str, default=None,
+                        help='Write concurrency timeline to CSV file (default: %(default)s)')
 
     args = parser.parse_args()
     print(args)
+    if args.watch and args.output_tree is not None:
+        parser.error('--watch and --output-tree cannot be used together')
     if args.apply or args.unapply:
-        sources = callseq.actions.Collector(recursive=args.recursive, std=std)(args.path)
+        compile_commands = None
+        if args.compile_commands is not None:
+            compile_commands = callseq.actions.CompilationDatabase(args.compile_commands)
+            sources = compile_commands.sources(args.path)
+        else:
+            sources = callseq.actions.Collector(recursive=args.recursive, std=std)(args.path)
 
         source_root = args.source_root if args.source_root else os.path.commonprefix(sources)
         if os.path.isfile(source_root):
             source_root = os.path.dirname(source_root)
         print(f'{source_root=}')
 
-        print(f'Found {len(sources)} C++ header/source files in {":".join(args.path)}')
+        print(f'Found {len(sources)} C++ header/source files in'
+              f' {":".join(args.path) or args.compile_commands}')
 
         if args.apply:
-            sources = callseq.actions.MultiCallSeq(
+            multi = callseq.actions.MultiCallSeq(
                 std=std, task='apply', try_run=args.try_run, show_diff=args.show_diff,
-                defines=args.defines)(sources)
+                defines=args.defines, compile_commands=compile_commands,
+                source_root=source_root, batch_size=args.batch_size, prelude=args.prelude,
+                pch_dir=args.pch_dir, ast_dump_filter=args.ast_dump_filter,
+                main_file_only=args.main_file_only, backend=args.backend,
+                manifest=args.manifest, output_tree=args.output_tree)
+            sources = multi(sources)
+            if args.watch:
+                paths = args.path or [source_root]
+                print(f'Watching {":".join(paths)} for modifications, press Ctrl-C to stop')
+                try:
+                    callseq.actions.Watcher(multi.callseq, paths, recursive=args.recursive,
+                                            interval=args.interval)()
+                except KeyboardInterrupt:
+                    pass
 
         if args.unapply:
             sources = callseq.actions.MultiCallSeq(
-                std=std, task='unapply', try_run=args.try_run, show_diff=args.show_diff)(sources)
+                std=std, task='unapply', try_run=args.try_run, show_diff=args.show_diff,
+                manifest=args.manifest, jobs=args.jobs)(sources)
     else:
         for path in args.path:
-            if os.path.basename(path) == 'callseq.output':
-                f = open(path)
-                callseq.actions.ShowCallSeqOutput()(f.read())
-                f.close()
+            # callseq.output, the outputs of forked processes or their segments
+            if not re.match(r'callseq([.]\d+)?[.]output([.]\d+)?([.]seg\d+)?\Z',
+                            os.path.basename(path)):
+                continue
+            if args.start_time is not None or args.end_time is not None:
+                callseq.actions.ShowCallSeqWindow(args.start_time, args.end_time)(path)
+            elif args.slowest is not None:
+                callseq.actions.ShowSlowestCalls(
+                    k=args.slowest, per_site=args.per_site, context=args.context)(path)
+            elif args.concurrency is not None:
+                callseq.actions.ShowConcurrency(buckets=args.concurrency, csv_path=args.csv)(path)
+            elif args.objects:
+                callseq.actions.ShowObjectLifetimes(top=args.top, factor=args.hot_factor)(path)
+            elif args.percentiles:
+                callseq.actions.ShowSiteLatencies(top=args.top, jobs=args.jobs)(path)
+            elif args.calling_context_tree or args.callers_of is not None:
+                callseq.actions.ShowCallingContextTree(
+                    max_depth=args.max_depth, callers_of=args.callers_of)(path)
+            else:
+                for segment in callseq.output.trace_segments(path):
+                    f = open(segment)
+                    callseq.actions.ShowCallSeqOutput()(f.read())
+                    f.close()
@@ -0,0 +1,257 @@
+"""
+Statistical comparison of the site latencies of repeated CallSeq runs.
+
+NumPy is used for resampling when available, otherwise the
+computations fall back to pure Python.
+"""
+
+import math
+import random
+from array import array
+from callseq.output import CallStacks, iter_events
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class SiteDurations:
+    """Columnar store of the inclusive durations of calls per site.
+
+    Durations (in nanoseconds) of each site are kept in an
+    `array('q')`. When max_samples is specified, at most max_samples
+    durations per site are kept using reservoir sampling, so the
+    memory usage does not grow with the length of the trace.
+    """
+
+    def __init__(self, max_samples=None, seed=None):
+        self.max_samples = max_samples
+        self.random = random.Random(seed)
+        self.stacks = CallStacks()
+        self.sites = self.stacks.sites
+        self.durations = {}  # site id -> array of durations
+        self.counts = {}  # site id -> number of calls
+
+    def update(self, events):
+        durations, counts, max_samples = self.durations, self.counts, self.max_samples
+        for event, frame in self.stacks(events):
+            if event.kind != '}':
+                continue
+            site = frame.site
+            values = durations.get(site)
+            if values is None:
+                values = durations[site] = array('q')
+            n = counts[site] = counts.get(site, 0) + 1
+            if max_samples is None or n <= max_samples:
+                values.append(frame.end - frame.start)
+            else:
+                i = self.random.randrange(n)
+                if i < max_samples:
+                    values[i] = frame.end - frame.start
+        return self
+
+    def by_signature(self):
+        """Return a mapping of site signatures and durations.
+
+        Site ids may differ between the builds of compared variants,
+        so sites are matched by signatures.
+        """
+        result = {}
+        for site, values in self.durations.items():
+            signature = self.sites.get(site, (f'<site {site}>',))[0]
+            if signature in result:
+                result[signature] = result[signature] + values
+            else:
+                result[signature] = values
+        return result
+
+
+def load_durations(paths, max_samples=None, seed=None):
+    """Return a list of per-run mappings of site signatures and durations.
+    """
+    return [SiteDurations(max_samples=max_samples, seed=seed).update(
+        iter_events(path)).by_signature() for path in paths]
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n == 0:
+        return None
+    return (values[(n - 1) // 2] + values[n // 2]) / 2
+
+
+def mann_whitney_u(a, b):
+    """Two-sided Mann-Whitney U test with normal approximation.
+
+    Returns (U, p) where U is the statistic of sample a. Ties are
+    handled with mid-ranks and the tie correction of variance.
+    """
+    n1, n2 = len(a), len(b)
+    n = n1 + n2
+    if numpy is not None:
+        values = numpy.concatenate((numpy.asarray(a, dtype=numpy.float64),
+                                    numpy.asarray(b, dtype=numpy.float64)))
+        order = numpy.argsort(values, kind='mergesort')
+        unique, first, counts = numpy.unique(values[order], return_index=True,
+                                             return_counts=True)
+        ranks = numpy.empty(n)
+        ranks[order] = numpy.repeat(first + (counts + 1) / 2, counts)
+        rank_sum = float(ranks[:n1].sum())
+        ties = float((counts.astype(numpy.float64) ** 3 - counts).sum())
+    else:
+        items = sorted([(value, 0) for value in a] + [(value, 1) for value in b])
+        rank_sum = 0.0
+        ties = 0.0
+        i = 0
+        while i < n:
+            j = i
+            while j < n and items[j][0] == items[i][0]:
+                j += 1
+            t = j - i
+            ties += t ** 3 - t
+            rank_sum += (i + j + 1) / 2 * sum(1 for item in items[i:j] if item[1] == 0)
+            i = j
+    u = rank_sum - n1 * (n1 + 1) / 2
+    mu = n1 * n2 / 2
+    variance = n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1))) if n > 1 else 0
+    if variance <= 0:
+        return u, 1.0
+    z = (abs(u - mu) - 0.5) / math.sqrt(variance)
+    return u, min(1.0, math.erfc(max(z, 0) / math.sqrt(2)))
+
+
+def bootstrap_median_ratio(runs_a, runs_b, iterations=1000, samples=None,
+                           confidence=0.95, seed=None):
+    """Return the confidence interval of median(b) / median(a).
+
+    The inputs are lists of per-run durations. Resampling is
+    hierarchical: runs are resampled first and then `samples` durations
+    within each resampled run, so that both the run-to-run variability
+    and the variability of calls contribute to the interval. By
+    default, at most 200 durations are drawn per run which makes the
+    interval conservative for long runs.
+    """
+    runs_a = [run for run in runs_a if len(run)]
+    runs_b = [run for run in runs_b if len(run)]
+    if samples is None:
+        samples = min(min(map(len, runs_a)), min(map(len, runs_b)), 200)
+    alpha = (1 - confidence) / 2
+    if numpy is not None:
+        rng = numpy.random.default_rng(seed)
+
+        def medians(runs):
+            data = numpy.concatenate([numpy.asarray(run, dtype=numpy.float64)
+                                      for run in runs])
+            sizes = numpy.array([len(run) for run in runs])
+            offsets = numpy.concatenate(([0], numpy.cumsum(sizes)[:-1]))
+            result = numpy.empty(iterations)
+            # resample in blocks of iterations to bound the memory usage
+            block = max(1, 1000000 // (len(runs) * samples))
+            for start in range(0, iterations, block):
+                n = min(block, iterations - start)
+                picked = rng.integers(0, len(runs), size=(n, len(runs)))
+                within = (rng.random((n, len(runs), samples))
+                          * sizes[picked][:, :, None]).astype(numpy.int64)
+                indices = offsets[picked][:, :, None] + within
+                result[start:start + n] = numpy.median(data[indices].reshape(n, -1), axis=1)
+            return result
+
+        ma, mb = medians(runs_a), medians(runs_b)
+        ratios = numpy.sort(mb / numpy.maximum(ma, 1))
+        return (float(ratios[int(alpha * (iterations - 1))]),
+                float(ratios[int(math.ceil((1 - alpha) * (iterations - 1)))]))
+    rng = random.Random(seed)
+
+    def resample(runs):
+        values = []
+        for run in rng.choices(runs, k=len(runs)):
+            values.extend(rng.choices(run, k=samples))
+        return median(values)
+
+    ratios = sorted(resample(runs_b) / max(resample(runs_a), 1) for _ in range(iterations))
+    return (ratios[int(alpha * (iterations - 1))],
+            ratios[int(math.ceil((1 - alpha) * (iterations - 1)))])
+
+
+def holm(pvalues):
+    """Return Holm-Bonferroni adjusted p-values.
+    """
+    m = len(pvalues)
+    adjusted = [None] * m
+    current = 0
+    for rank, i in enumerate(sorted(range(m), key=lambda i: pvalues[i])):
+        current = max(current, min(1.0, (m - rank) * pvalues[i]))
+        adjusted[i] = current
+    return adjusted
+
+
+def compare_runs(runs_a, runs_b, alpha=0.05, min_effect=0.05, min_calls=20,
+                 iterations=1000, confidence=0.95, seed=None):
+    """Compare site latencies of two variants.
+
+    The inputs are lists of per-run mappings of site signatures and
+    durations, see load_durations. The Mann-Whitney U test is applied
+    to the per-run medians of durations because the calls of the same
+    run are not independent (e.g. run-to-run drift would make any
+    difference of pooled calls significant). Hence, at least four runs
+    per variant are needed for a significant change at alpha=0.05.
+
+    Returns a list of (signature, calls_a, calls_b, median_a, median_b,
+    ci, p, status) tuples sorted by p-values adjusted with Holm's
+    method for the number of compared sites. The status is 'slower' or
+    'faster' when the adjusted p-value is less than alpha and the
+    confidence interval of the ratio of medians excludes changes
+    smaller than min_effect, otherwise ''.
+    """
+    signatures = set().union(*runs_a) & set().union(*runs_b)
+    rows = []
+    for signature in sorted(signatures):
+        per_run_a = [run[signature] for run in runs_a if signature in run]
+        per_run_b = [run[signature] for run in runs_b if signature in run]
+        pooled_a = [value for run in per_run_a for value in run]
+        pooled_b = [value for run in per_run_b for value in run]
+        if len(pooled_a) < min_calls or len(pooled_b) < min_calls:
+            continue
+        u, p = mann_whitney_u([median(run) for run in per_run_a],
+                              [median(run) for run in per_run_b])
+        ci = bootstrap_median_ratio(per_run_a, per_run_b, iterations=iterations,
+                                    confidence=confidence, seed=seed)
+        rows.append([signature, len(pooled_a), len(pooled_b), median(pooled_a),
+                     median(pooled_b), ci, p])
+    for row, p in zip(rows, holm([row[6] for row in rows])):
+        row[6] = p
+        ci = row[5]
+        status = ''
+        if p < alpha:
+            if ci[0] > 1 + min_effect:
+                status = 'slower'
+            elif ci[1] < 1 - min_effect:
+                status = 'faster'
+        row.append(status)
+    rows.sort(key=lambda row: (row[6], -abs(math.log(max(row[4], 1) / max(row[3], 1)))))
+    return [tuple(row) for row in rows]
+
+
+def comparison_table(rows, top=None, show_all=False):
+    """Return a table of site latency changes.
+
+    Unless show_all is True, only the sites with significant changes
+    are shown.
+    """
+    lines = [f'{"":>7} {"calls":>19} {"median[us]":>25} {"b/a":>8} {"ci":>17} {"p":>9}'
+             '  function',
+             f'{"":>7} {"a":>9} {"b":>9} {"a":>12} {"b":>12}']
+    count = 0
+    for signature, calls_a, calls_b, median_a, median_b, ci, p, status in rows:
+        if top is not None and count >= top:
+            break
+        if not (show_all or status):
+            continue
+        count += 1
+        ratio = median_b / max(median_a, 1)
+        lines.append(f'{status:>7} {calls_a:>9} {calls_b:>9} {median_a / 1000:>12.3f}'
+                     f' {median_b / 1000:>12.3f} {ratio:>8.3f} [{ci[0]:>6.3f}, {ci[1]:>6.3f}]'
+                     f' {p:>9.2g}  {signature}')
+    return '\n'.join(lines)
@@ -0,0 +1,70 @@
+"""
+Reading CallSeq shared counters.
+
+When an application is built with `-DCALLSEQ_COUNTERS=<path>`, the
+CallSeq hooks keep per-site counters in a memory-mapped file. The file
+consists of a 64-byte header followed by 256-byte slots, see
+callseq.hpp for the layout.
+"""
+
+import mmap
+import struct
+
+HEADER = struct.Struct('=8sIIQQ32x')
+SLOT = struct.Struct('=QQQq224s')
+MAGIC = b'CALLSEQC'
+
+
+class SharedCounters:
+    """Read-only view of CallSeq shared counters file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version, self.nslots, self.pid, self.start = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            self.mmap.close()
+            raise ValueError(f'{path} is not a CallSeq counters file')
+
+    def read(self):
+        """Return a mapping of site ids and (calls, total_ns, inflight, name) tuples.
+        """
+        counters = {}
+        end = HEADER.size + self.nslots * SLOT.size
+        for key, calls, total, inflight, name in SLOT.iter_unpack(self.mmap[HEADER.size:end]):
+            if key == 0 or key == 0xffffffffffffffff:
+                continue
+            counters[key - 1] = (calls, total, inflight,
+                                 name.split(b'\0', 1)[0].decode(errors='replace'))
+        return counters
+
+    def close(self):
+        self.mmap.close()
+
+
+def counters_table(current, previous=None, interval=None, top=None):
+    """Return a table of the hottest sites.
+
+    When previous counters are specified, the sites are sorted by the
+    time spent in the sites since the previous counters, otherwise by
+    the total time.
+    """
+    previous = previous or {}
+    rows = []
+    for site, (calls, total, inflight, name) in current.items():
+        calls0, total0 = previous.get(site, (0, 0))[:2]
+        rows.append((total - total0, calls - calls0, calls, total, inflight,
+                     name.split('|', 1)[0]))
+    rows.sort(key=lambda row: (-row[0], -row[4]))
+    if interval:
+        calls_label, time_label = 'calls/s', 'time[s]/s'
+    else:
+        calls_label, time_label, interval = 'new calls', 'new[s]', 1
+    lines = [f'{calls_label:>10} {time_label:>10} {"calls":>12} {"total[s]":>12}'
+             f' {"inflight":>8}  function']
+    for delta_total, delta_calls, calls, total, inflight, name in rows[:top]:
+        lines.append(f'{delta_calls / interval:>10.1f} {delta_total / 1e9 / interval:>10.6f}'
+                     f' {calls:>12} {total / 1e9:>12.6f} {inflight:>8}  {name}')
+    return '\n'.join(lines)
@@ -13,8 +13,14 @@ class Counter:
         self._count += 1
         return self._count
 
+    def update(self, count):
+        """Make sure that the next count is larger than the given count.
+        """
+        self._count = max(self._count, count)
 
-NEXT_COUNTER = Counter().next
+
+COUNTER = Counter()
+NEXT_COUNTER = COUNTER.next
 
 
 def rstrip_template_specialization(line):
@@ -22,12 +28,17 @@ def rstrip_template_specialization(line):
     return m.group(1).rstrip() if m else line
 
 
-def insert_signal_code(ast, source, source_string):
+def insert_signal_code(ast, source, source_string, next_counter=None):
     """Insert callseq signal points to a C++ source.
 
     Signal point is a RAII object that emits a signal when entering a
     C++ function/method and when leaving the function/method.
+
+    Site ids are obtained from next_counter, by default, from the
+    global counter NEXT_COUNTER.
     """
+    if next_counter is None:
+        next_counter = NEXT_COUNTER
 
     def select(node):
         if node.key not in ['CXXConstructorDecl', 'CXXMethodDecl', 'FunctionDecl']:
@@ -66,11 +77,11 @@ def insert_signal_code(ast, source, source_string):
         if not line.startswith('CALLSEQ_SIGNAL(', bracket_colno+1):
             if has_this:
                 new_line = (line[:bracket_colno + 1]
-                            + f'CALLSEQ_SIGNAL({NEXT_COUNTER()},this);'
+                            + f'CALLSEQ_SIGNAL({next_counter()},this);'
                             + line[bracket_colno+1:])
             else:
                 new_line = (line[:bracket_colno + 1]
-                            + f'CALLSEQ_SIGNAL({NEXT_COUNTER()},CALLSEQ_DUMMY_THIS);'
+                            + f'CALLSEQ_SIGNAL({next_counter()},CALLSEQ_DUMMY_THIS);'
                             + line[bracket_colno+1:])
             lines[bracket_lineno] = new_line
     output = ''.join(lines)
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 
 
@@ -115,7 +116,8 @@ class Node:
                     or self.value.split(None, 1)[0] in ['new', 'delete', 'new[]', 'delete[]']):
                 return
         nodes = []
-        public = True
+        # members of classes are private by default
+        public = not (self.key == 'CXXRecordDecl' and 'class' in self.prefices)
         for node in self.nodes:
             if node.key == 'AccessSpecDecl':
                 public = dict(private=False, public=True, protected=False)[node.value]
@@ -236,7 +238,7 @@ def parse_ast_line(line, last_location):
             if location is not None:
                 line = ''
                 d.update(location=location)
-    prefices, suffices = [], []
+    prefices = []
     known_prefices = ['implicit', 'used', 'referenced', 'constexpr', 'struct', 'class', 'invalid']
     known_suffices = ['inline', 'default', 'static', 'trivial', 'definition']
     while True:
@@ -249,20 +251,86 @@ def parse_ast_line(line, last_location):
             break
     d.update(prefices=prefices)
 
-    while True:
-        for a in known_suffices:
-            if line.endswith(' ' + a):
-                suffices.append(a)
-                line = line[:-len(a)-1].rstrip()
-                break
-        else:
-            break
+    # suffices follow the name and the type, possibly with other words
+    # such as implicit-inline in `f 'void ()' static implicit-inline`
+    i = line.rfind("'") + 1
+    if i == 0 and line:
+        i = len(line.split(None, 1)[0])
+    words = line[i:].split()
+    suffices = [a for a in words if a in known_suffices]
+    if suffices:
+        line = ' '.join([line[:i]] + [a for a in words if a not in known_suffices]).strip()
     d.update(suffices=suffices)
 
     d.update(rest=line)
     return d
 
 
+def split_ast_dumps(ast_dump_output):
+    """Split clang ast dump output of several translation units.
+    """
+    dumps = []
+    lines = None
+    for line in ast_dump_output.splitlines(keepends=True):
+        if line.startswith('TranslationUnitDecl'):
+            lines = []
+            dumps.append(lines)
+        if lines is not None:
+            lines.append(line)
+    return [''.join(lines) for lines in dumps]
+
+
+def wrap_filtered_ast_dump(ast_dump_output):
+    """Return clang ast dump output with -ast-dump-filter as a dump of a
+    translation unit.
+
+    The filtered output consists of `Dumping <name>:` lines each
+    followed by the dump of a matching declaration. The declarations
+    are made children of a translation unit node.
+    """
+    lines = ['TranslationUnitDecl 0x0 <<invalid sloc>> <invalid sloc>']
+    for line in ast_dump_output.splitlines():
+        if not line or line.startswith('Dumping '):
+            continue
+        if line[0] in '|`' or line[0] == ' ':
+            lines.append('| ' + line)
+        else:
+            lines.append('|-' + line)
+    return '\n'.join(lines) + '\n'
+
+
+_location_path = re.compile(r'(/[^:<>\s]+):\d+:\d+')
+
+
+def main_file_ast_dump(ast_dump_output, path):
+    """Return clang ast dump output with only the top-level declarations of
+    the given file.
+
+    Locations are dumped relative to the previously dumped location, so
+    the current file is tracked over all lines, including the lines of
+    skipped declarations.
+    """
+    lines = []
+    current = None
+    keep = True
+    for line in ast_dump_output.splitlines(keepends=True):
+        if line.startswith(('|-', '`-')):
+            # the file of a top-level declaration is the file of its span start
+            i = line.find(' <')
+            start = line[i + 2:].split(',', 1)[0].split('>', 1)[0] if i != -1 else ''
+            m = _location_path.match(start)
+            if m is not None:
+                keep = m.group(1) == path
+            else:
+                keep = current == path and not start.startswith('<')
+        paths = _location_path.findall(line)
+        if paths:
+            current = paths[-1]
+        if keep or not line.startswith(('|', '`', ' ')):
+            lines.append(line)
+    return ''.join(lines)
+
+
 def parse_ast_dump(ast_dump_output, loc=None):
     """Parse clang ast dump output into a Node tree.
     """
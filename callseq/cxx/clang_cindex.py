@@ -0,0 +1,107 @@
+"""
+Reading C++ ASTs in-process using libclang Python bindings.
+
+The AST is represented as a tree of Node objects (see clang_ast_dump)
+that contains only the function and method definitions with their
+bodies, which is sufficient for insert_signal_code.
+"""
+
+import os
+import sys
+from callseq.cxx.clang_ast_dump import Location, Node
+
+try:
+    import clang.cindex as cindex
+except ImportError:
+    cindex = None
+
+
+_index = []
+
+
+def get_index():
+    """Return libclang index or None when libclang is not available.
+    """
+    if not _index:
+        index = None
+        if cindex is not None:
+            try:
+                index = cindex.Index.create()
+            except Exception:
+                # libclang shared library not found
+                pass
+        _index.append(index)
+    return _index[0]
+
+
+def _location(location):
+    return Location(location.file.name if location.file else '', location.line, location.column)
+
+
+def read_ast(source, flags=[], main_file_only=False):
+    """Return the AST of a C++ file.
+
+    Declarations from system headers and from the std namespace, and
+    non-public class members are skipped similar to Node.cleanup.
+    """
+    index = get_index()
+    assert index is not None  # make sure that libclang is installed (e.g. pip install libclang)
+    source = os.path.abspath(source)
+    header_extensions = ('.h', '.hpp', '.hxx')
+    language = 'c++-header' if source.lower().endswith(header_extensions) else 'c++'
+    tu = index.parse(source, args=['-x', language] + list(flags))
+    kinds = cindex.CursorKind
+    function_kinds = {kinds.FUNCTION_DECL: 'FunctionDecl', kinds.CXX_METHOD: 'CXXMethodDecl',
+                      kinds.CONSTRUCTOR: 'CXXConstructorDecl',
+                      kinds.FUNCTION_TEMPLATE: 'FunctionDecl'}
+    scope_kinds = {kinds.NAMESPACE, kinds.LINKAGE_SPEC}
+    class_kinds = {kinds.CLASS_DECL, kinds.STRUCT_DECL, kinds.UNION_DECL, kinds.CLASS_TEMPLATE,
+                   kinds.CLASS_TEMPLATE_PARTIAL_SPECIALIZATION}
+
+    root_location = Location(source, 1, 1)
+    root = Node(None, '', 'TranslationUnitDecl', '', (root_location, root_location),
+                root_location.copy(), [], [])
+
+    def walk(cursor, in_class):
+        for child in cursor.get_children():
+            kind = child.kind
+            # the access of class members accounts for the default access
+            # of classes and structs, also in class templates
+            if in_class and child.access_specifier != cindex.AccessSpecifier.PUBLIC:
+                continue
+            location = child.location
+            if location.file is None or location.is_in_system_header:
+                continue
+            path = location.file.name
+            if path.startswith(sys.prefix) or (main_file_only and path != source):
+                continue
+            if kind in scope_kinds:
+                if child.spelling == 'std' or child.spelling.startswith('_'):
+                    continue
+                walk(child, False)
+            elif kind in class_kinds:
+                walk(child, True)
+            elif kind in function_kinds and child.is_definition():
+                if child.spelling.startswith('_'):
+                    continue
+                key = function_kinds[kind]
+                if kind == kinds.FUNCTION_TEMPLATE and in_class:
+                    key = 'CXXMethodDecl'
+                body = None
+                for c in child.get_children():
+                    if c.kind == kinds.COMPOUND_STMT:
+                        body = c
+                if body is None:
+                    continue
+                static = key == 'CXXMethodDecl' and child.is_static_method()
+                node = Node(root, '', key, f"{child.spelling} '{child.type.spelling}'",
+                            (_location(child.extent.start), _location(child.extent.end)),
+                            _location(location), [], ['static'] if static else [])
+                node.nodes.append(Node(
+                    node, '', 'CompoundStmt', '',
+                    (_location(body.extent.start), _location(body.extent.end)),
+                    _location(body.extent.start), [], []))
+                root.nodes.append(node)
+
+    walk(tu.cursor, False)
+    return root
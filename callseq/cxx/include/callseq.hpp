@@ -10,6 +10,35 @@ $ export CXXFLAGS="$CXXFLAGS -include /path/to/callseq.hpp
 the output of callseq.output, develop $ callseq++ -r
 /path/to/application/sources --unapply
 
+CALLSEQ_OUTPUT may contain the following templates:
+
+  %p - process id
+  %t - start time of the process in seconds since epoch
+  %% - literal %
+
+When a process forks, the child process writes to a new output file:
+either CALLSEQ_OUTPUT is expanded with the child process id or, when
+CALLSEQ_OUTPUT does not contain %p, the child process id is appended
+as a suffix to the output file name. The file is created on the first
+event of the child process, so children that only exec do not create
+output files. This holds also for processes that fork before their
+first event. Use `callseq++ merge` to merge
+the output files of several processes into a single output.
+
+When CALLSEQ_SEGMENT_SIZE is defined as a positive number of bytes,
+the output is written to numbered segments <output>.seg1,
+<output>.seg2, etc of about the given size. When CALLSEQ_MAX_SEGMENTS is defined as
+a positive number, only the given number of the newest segments are
+retained. The header of each segment records the open call stacks of
+all threads at the start of the segment.
+
+When CALLSEQ_COUNTERS is defined as a file path, per-site counters
+(number of calls, total time in nanoseconds, number of calls in
+flight) are kept in the memory-mapped file that `callseq++ top` can
+monitor while the application runs. The number of counter slots is
+defined by CALLSEQ_COUNTERS_SLOTS (default 4096). Unless CALLSEQ_OUTPUT
+is defined as well, the events are not written to an output file.
+
 Author: Pearu Peterson
 Created: December 2021
 */
@@ -21,18 +50,48 @@ Created: December 2021
 
 #else
 
+#include <fcntl.h>
+#include <pthread.h>
+#include <sys/mman.h>
+#include <unistd.h>
+
+#include <atomic>
 #include <chrono>
+#include <cstdio>
+#include <cstring>
 #include <fstream>
+#include <iomanip>
 #include <iostream>
 #include <memory>
 #include <mutex>
 #include <sstream>
+#include <string>
 #include <thread>
+#include <unordered_map>
+#include <vector>
+
+#if defined(CALLSEQ_COUNTERS) && !defined(CALLSEQ_OUTPUT)
+#define CALLSEQ_LOG 0
+#else
+#define CALLSEQ_LOG 1
+#endif
 
 #ifndef CALLSEQ_OUTPUT
 #define CALLSEQ_OUTPUT "callseq.output"
 #endif
 
+#ifndef CALLSEQ_COUNTERS_SLOTS
+#define CALLSEQ_COUNTERS_SLOTS 4096
+#endif
+
+#ifndef CALLSEQ_SEGMENT_SIZE
+#define CALLSEQ_SEGMENT_SIZE 0
+#endif
+
+#ifndef CALLSEQ_MAX_SEGMENTS
+#define CALLSEQ_MAX_SEGMENTS 0
+#endif
+
 #define CALLSEQ_SIGNAL(CALLING_SITE_ID, THIS)                                  \
   auto callseq_site_point = callseq::SitePoint(                                \
       CALLING_SITE_ID, THIS, __PRETTY_FUNCTION__, __FILE__, __LINE__);
@@ -54,6 +113,38 @@ inline uint64_t thread_id() {
   return std::hash<std::thread::id>()(std::this_thread::get_id()) & 0xffffff;
 }
 
+// epoch_nanos() returns now in nanoseconds since epoch
+inline uint64_t epoch_nanos() {
+  return std::chrono::duration_cast<std::chrono::nanoseconds>(
+             std::chrono::system_clock::now().time_since_epoch())
+      .count();
+}
+
+// output_path(...) returns output path with %p, %t, %% templates expanded
+inline std::string output_path(const std::string &path, uint64_t start_epoch) {
+  std::stringstream stream;
+  for (size_t i = 0; i < path.size(); i++) {
+    if (path[i] == '%' && i + 1 < path.size()) {
+      switch (path[i + 1]) {
+      case 'p':
+        stream << getpid();
+        i++;
+        continue;
+      case 't':
+        stream << start_epoch / 1000000000;
+        i++;
+        continue;
+      case '%':
+        stream << '%';
+        i++;
+        continue;
+      }
+    }
+    stream << path[i];
+  }
+  return stream.str();
+}
+
 class Logger {
 public:
   static Logger &getInstance() {
@@ -63,27 +154,289 @@ public:
   static void write(const std::string message) {
     getInstance().write_worker(message);
   }
+  static void enter(const std::string message) {
+    getInstance().enter_worker(message);
+  }
+  static void exit(const std::string message) {
+    getInstance().exit_worker(message);
+  }
   static uint64_t nanos() { return getInstance().nanos_worker(); }
+  // register_fork_handlers() registers the fork handlers once per process
+  static bool register_fork_handlers() {
+    static const bool registered =
+        pthread_atfork(&Logger::prepare_fork, &Logger::parent_fork,
+                       &Logger::child_fork) == 0;
+    return registered;
+  }
 
 private:
-  Logger() : start_(callseq::nanos()) {
-    std::cout << "callseq logs to " << CALLSEQ_OUTPUT << std::endl;
-    log_.open(CALLSEQ_OUTPUT);
+  Logger() : start_(callseq::nanos()), start_epoch_(callseq::epoch_nanos()) {
+    // a child process that forked before the first event of its parent
+    path_ = (forked_process() ? child_path()
+                              : output_path(CALLSEQ_OUTPUT, start_epoch_));
+    open();
+    std::cout << "callseq logs to " << current_path() << std::endl;
+    instance() = this;
   }
   ~Logger() { log_.close(); }
   Logger(Logger const &) = delete;
   void operator=(Logger const &) = delete;
 
+  static constexpr uint64_t segment_size_ = CALLSEQ_SEGMENT_SIZE;
+  static constexpr uint64_t max_segments_ = CALLSEQ_MAX_SEGMENTS;
+
+  std::string segment_path(uint64_t segment) {
+    return path_ + ".seg" + std::to_string(segment);
+  }
+
+  std::string current_path() {
+    return (segment_size_ > 0 ? segment_path(segment_) : path_);
+  }
+
+  void open() {
+    log_.open(current_path());
+    // <process id>|<start time in nanoseconds since epoch>
+    log_ << "#callseq pid=" << getpid() << " start=" << start_epoch_;
+    if (segment_size_ > 0) {
+      log_ << " segment=" << segment_;
+    }
+    log_ << std::endl;
+    // open call stacks as #-prefixed enter events
+    for (const auto &item : stacks_) {
+      for (const auto &message : item.second) {
+        log_ << "#" << message << std::endl;
+      }
+    }
+    size_ = 0;
+  }
+
+  void rotate() {
+    log_.close();
+    segment_++;
+    if (max_segments_ > 0 && segment_ > max_segments_) {
+      std::remove(segment_path(segment_ - max_segments_).c_str());
+    }
+    open();
+  }
+
+  // instance() is the constructed Logger or nullptr
+  static Logger *&instance() {
+    static Logger *logger = nullptr;
+    return logger;
+  }
+  // forked_process() is true in forked child processes
+  static bool &forked_process() {
+    static bool forked = false;
+    return forked;
+  }
+
+  // the fork handlers do not construct the Logger
+  static void prepare_fork() {
+    Logger *logger = instance();
+    if (logger != nullptr) {
+      logger->write_mutex_.lock();
+      logger->fork_thread_ = thread_id();
+    }
+  }
+  static void parent_fork() {
+    Logger *logger = instance();
+    if (logger != nullptr) {
+      logger->write_mutex_.unlock();
+    }
+  }
+  static void child_fork() {
+    // only async-signal-safe operations are allowed here, the output
+    // of the child process is opened on its first event
+    forked_process() = true;
+    Logger *logger = instance();
+    if (logger != nullptr) {
+      logger->forked_ = true;
+      logger->write_mutex_.unlock();
+    }
+  }
+
+  std::string child_path() {
+    const std::string path = CALLSEQ_OUTPUT;
+    std::string result = output_path(path, start_epoch_);
+    if (path.find("%p") == std::string::npos) {
+      result += "." + std::to_string(getpid());
+    }
+    return result;
+  }
+
+  void reopen_in_child() {
+    forked_ = false;
+    log_.close();
+    path_ = child_path();
+    // only the forking thread exists in the child process
+    auto stack = stacks_.find(fork_thread_);
+    if (stack != stacks_.end()) {
+      auto messages = std::move(stack->second);
+      stacks_.clear();
+      stacks_[fork_thread_] = std::move(messages);
+    } else {
+      stacks_.clear();
+    }
+    segment_ = 1;
+    open();
+    std::cout << "callseq logs to " << current_path() << std::endl;
+  }
+
   std::mutex write_mutex_;
+  void write_message(const std::string &message) {
+    log_ << message << std::endl;
+    if (segment_size_ > 0) {
+      size_ += message.size() + 1;
+      if (size_ >= segment_size_) {
+        rotate();
+      }
+    }
+  }
   void write_worker(const std::string message) {
     std::lock_guard<std::mutex> write_lock(write_mutex_);
-    log_ << message << std::endl;
+    if (forked_) {
+      reopen_in_child();
+    }
+    write_message(message);
+  }
+  void enter_worker(const std::string message) {
+    std::lock_guard<std::mutex> write_lock(write_mutex_);
+    if (forked_) {
+      reopen_in_child();
+    }
+    if (segment_size_ > 0) {
+      stacks_[thread_id()].push_back(message);
+    }
+    write_message(message);
+  }
+  void exit_worker(const std::string message) {
+    std::lock_guard<std::mutex> write_lock(write_mutex_);
+    if (forked_) {
+      reopen_in_child();
+    }
+    if (segment_size_ > 0) {
+      auto &stack = stacks_[thread_id()];
+      if (!stack.empty()) {
+        stack.pop_back();
+      }
+    }
+    write_message(message);
   }
   uint64_t nanos_worker() { return callseq::nanos() - start_; }
   std::ofstream log_;
+  std::string path_;
   uint64_t start_;
+  uint64_t start_epoch_;
+  uint64_t segment_ = 1;
+  uint64_t size_ = 0;
+  bool forked_ = false;      // set in the child process until its output is opened
+  uint64_t fork_thread_ = 0; // id of the forking thread
+  // thread id -> enter events of open calls, used only with segments
+  std::unordered_map<uint64_t, std::vector<std::string>> stacks_;
+};
+
+#if CALLSEQ_LOG
+// The fork handlers are registered at static initialization so that
+// processes that fork before their first event are handled as well.
+static const bool fork_handlers_registered = Logger::register_fork_handlers();
+#endif
+
+#ifdef CALLSEQ_COUNTERS
+
+// Layout of the counters file: a header followed by slots
+struct CountersHeader {
+  char magic[8]; // "CALLSEQC"
+  uint32_t version;
+  uint32_t nslots;
+  uint64_t pid;
+  uint64_t start_epoch;
+  char reserved[32];
+};
+
+struct CounterSlot {
+  std::atomic<uint64_t> key; // site id + 1, 0 when slot is empty
+  std::atomic<uint64_t> calls;
+  std::atomic<uint64_t> total_ns;
+  std::atomic<int64_t> inflight;
+  char name[224]; // <signature>|<file>#<lineno>
 };
 
+static_assert(sizeof(CountersHeader) == 64, "unexpected CountersHeader size");
+static_assert(sizeof(CounterSlot) == 256, "unexpected CounterSlot size");
+
+class Counters {
+public:
+  static CounterSlot *slot(const size_t site_id, const char *signature,
+                           const char *file, const int lineno) {
+    static Counters instance;
+    return instance.slot_worker(site_id, signature, file, lineno);
+  }
+
+private:
+  static constexpr uint64_t claiming_ = ~uint64_t(0);
+
+  Counters() {
+    const uint64_t start_epoch = callseq::epoch_nanos();
+    const std::string path = output_path(CALLSEQ_COUNTERS, start_epoch);
+    const size_t size =
+        sizeof(CountersHeader) + CALLSEQ_COUNTERS_SLOTS * sizeof(CounterSlot);
+    int fd = ::open(path.c_str(), O_RDWR | O_CREAT | O_TRUNC, 0644);
+    if (fd < 0 || ftruncate(fd, size) != 0) {
+      std::cerr << "callseq failed to create " << path << std::endl;
+      return;
+    }
+    void *memory =
+        mmap(nullptr, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    ::close(fd);
+    if (memory == MAP_FAILED) {
+      std::cerr << "callseq failed to map " << path << std::endl;
+      return;
+    }
+    std::cout << "callseq counts to " << path << std::endl;
+    auto header = reinterpret_cast<CountersHeader *>(memory);
+    header->version = 1;
+    header->nslots = CALLSEQ_COUNTERS_SLOTS;
+    header->pid = getpid();
+    header->start_epoch = start_epoch;
+    std::memcpy(header->magic, "CALLSEQC", 8);
+    // the mapping is never unmapped as counters may be updated until
+    // the process exits
+    slots_ = reinterpret_cast<CounterSlot *>(header + 1);
+  }
+
+  CounterSlot *slot_worker(const size_t site_id, const char *signature,
+                           const char *file, const int lineno) {
+    if (slots_ == nullptr) {
+      return nullptr;
+    }
+    const uint64_t key = uint64_t(site_id) + 1;
+    size_t index = (key * 0x9E3779B97F4A7C15ull) % CALLSEQ_COUNTERS_SLOTS;
+    for (size_t i = 0; i < CALLSEQ_COUNTERS_SLOTS; i++) {
+      CounterSlot &slot = slots_[(index + i) % CALLSEQ_COUNTERS_SLOTS];
+      uint64_t current = slot.key.load(std::memory_order_acquire);
+      if (current == 0) {
+        if (slot.key.compare_exchange_strong(current, claiming_)) {
+          std::snprintf(slot.name, sizeof(slot.name), "%s|%s#%d", signature,
+                        file, lineno);
+          slot.key.store(key, std::memory_order_release);
+          return &slot;
+        }
+      }
+      while (current == claiming_) {
+        current = slot.key.load(std::memory_order_acquire);
+      }
+      if (current == key) {
+        return &slot;
+      }
+    }
+    return nullptr; // all slots are in use
+  }
+
+  CounterSlot *slots_ = nullptr;
+};
+
+#endif
+
 template <typename T> class SitePoint {
 
 public:
@@ -92,6 +445,15 @@ public:
             const int lineno)
       : calling_site_id_(calling_site_id),
         this_(reinterpret_cast<std::uintptr_t>((void *)caller_this)) {
+#ifdef CALLSEQ_COUNTERS
+    slot_ = Counters::slot(calling_site_id, caller_signature, caller_file,
+                           lineno);
+    if (slot_ != nullptr) {
+      slot_->inflight.fetch_add(1, std::memory_order_relaxed);
+      counter_start_ = callseq::nanos();
+    }
+#endif
+#if CALLSEQ_LOG
     auto start = Logger::nanos();
     // <>|<site id>|<object this value or 0x0>|<timestamp in seconds with ns
     // resolution>|<thread id hash>|<caller signature>|<caller file
@@ -100,27 +462,43 @@ public:
     stream << "{" << calling_site_id_;
     stream << "|0x" << std::hex << this_;
     stream << "|" << std::dec << start / 1000000000 << "."
-           << start % 1000000000;
+           << std::setw(9) << std::setfill('0') << start % 1000000000;
     stream << "|0x" << std::hex << thread_id();
     stream << "|" << caller_signature;
     stream << "|" << caller_file << "#" << std::dec << lineno;
-    Logger::write(stream.str());
+    Logger::enter(stream.str());
+#endif
   }
 
   ~SitePoint() {
+#ifdef CALLSEQ_COUNTERS
+    if (slot_ != nullptr) {
+      slot_->total_ns.fetch_add(callseq::nanos() - counter_start_,
+                                std::memory_order_relaxed);
+      slot_->calls.fetch_add(1, std::memory_order_relaxed);
+      slot_->inflight.fetch_sub(1, std::memory_order_relaxed);
+    }
+#endif
+#if CALLSEQ_LOG
     auto end = Logger::nanos();
     // <site id>|<instance address>|<timestamp in seconds with ns resolution>
     std::stringstream stream;
     stream << "}" << calling_site_id_;
     stream << "|0x" << std::hex << this_;
-    stream << "|" << std::dec << end / 1000000000 << "." << end % 1000000000;
+    stream << "|" << std::dec << end / 1000000000 << "." << std::setw(9)
+           << std::setfill('0') << end % 1000000000;
     stream << "|0x" << std::hex << thread_id();
-    Logger::write(stream.str());
+    Logger::exit(stream.str());
+#endif
   }
 
 private:
   size_t calling_site_id_;
   uintptr_t this_;
+#ifdef CALLSEQ_COUNTERS
+  CounterSlot *slot_;
+  uint64_t counter_start_;
+#endif
 };
 
 #endif
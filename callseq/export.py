@@ -0,0 +1,216 @@
+"""
+Exporting CallSeq outputs to the formats of other tools.
+"""
+
+import os
+import json
+import sqlite3
+from callseq.output import CallStacks, function_name
+
+
+def folded_stacks(cct, signatures=False):
+    """Return a mapping of folded stacks and their self times in nanoseconds.
+
+    A folded stack is a string of function names of a call path
+    separated with `;`. When signatures is False, qualified function
+    names are used instead of full signatures so that overloads are
+    merged.
+    """
+    names = {}
+
+    def name(key):
+        if key not in names:
+            n = cct.name(key)
+            if not signatures and not isinstance(key, str):
+                n = function_name(n)
+            names[key] = n.replace(';', ':')
+        return names[key]
+
+    stacks = {}
+    for node in cct.root.walk():
+        if node.key is None or isinstance(node.key, str) or node.exclusive <= 0:
+            continue
+        stack = ';'.join(map(name, node.path()))
+        stacks[stack] = stacks.get(stack, 0) + node.exclusive
+    return stacks
+
+
+def write_folded(cct, f, signatures=False):
+    """Write folded stacks in the input format of flame graph tools.
+    """
+    for stack, value in sorted(folded_stacks(cct, signatures=signatures).items()):
+        f.write(f'{stack} {value}\n')
+
+
+class ChromeTraceWriter:
+    """Streaming writer of events in Trace Event Format.
+
+    The output can be opened with chrome://tracing or Perfetto UI.
+    Calls are written as pairs of begin and end events or, when
+    complete is True, as complete events when leaving the call. When
+    max_size (in bytes) is specified, the output is split into files
+    `<path>`, `<base>.1<ext>`, `<base>.2<ext>`, etc so that each file
+    is a valid trace: calls that are open at the end of a file are
+    ended in this file and begun again in the next file.
+    """
+
+    def __init__(self, path, complete=False, max_size=None, signatures=False):
+        self.path = path
+        self.complete = complete
+        self.max_size = max_size
+        self.signatures = signatures
+        self.stacks = CallStacks()
+        self.names = {}
+        self.paths = []
+        self.file = None
+        self.last_timestamp = 0
+
+    def name(self, site):
+        name = self.names.get(site)
+        if name is None:
+            signature = self.stacks.sites[site][0]
+            name = self.names[site] = json.dumps(
+                signature if self.signatures else function_name(signature))
+        return name
+
+    def begin(self, frame):
+        pid, tid = divmod(frame.thread, 1 << 24)
+        self.write(f'{{"name":{self.name(frame.site)},"ph":"B","ts":{frame.start / 1000:.3f},'
+                   f'"pid":{pid},"tid":{tid},"args":{{"this":"0x{frame.this:x}"}}}}')
+
+    def end(self, frame, timestamp):
+        pid, tid = divmod(frame.thread, 1 << 24)
+        self.write(f'{{"ph":"E","ts":{timestamp / 1000:.3f},"pid":{pid},"tid":{tid}}}')
+
+    def complete_call(self, frame):
+        pid, tid = divmod(frame.thread, 1 << 24)
+        self.write(f'{{"name":{self.name(frame.site)},"ph":"X","ts":{frame.start / 1000:.3f},'
+                   f'"dur":{frame.inclusive / 1000:.3f},"pid":{pid},"tid":{tid},'
+                   f'"args":{{"this":"0x{frame.this:x}"}}}}')
+
+    def open(self):
+        path = self.path
+        if self.paths:
+            base, ext = os.path.splitext(path)
+            path = f'{base}.{len(self.paths)}{ext}'
+        self.paths.append(path)
+        self.file = open(path, 'w')
+        self.file.write('{"traceEvents":[\n')
+        self.size = 0
+        self.first = True
+        if not self.complete:
+            for stack in self.stacks.stacks.values():
+                for frame in stack:
+                    self.begin(frame)
+
+    def close(self):
+        if not self.complete:
+            for stack in self.stacks.stacks.values():
+                for frame in reversed(stack):
+                    self.end(frame, self.last_timestamp)
+        self.file.write('\n],"displayTimeUnit":"ns"}\n')
+        self.file.close()
+        self.file = None
+
+    def write(self, line):
+        if self.first:
+            self.first = False
+        else:
+            line = ',\n' + line
+        self.file.write(line)
+        self.size += len(line)
+
+    def __call__(self, events):
+        """Write events and return the list of written files.
+        """
+        self.open()
+        for event, frame in self.stacks(events):
+            rollover = self.max_size is not None and self.size >= self.max_size
+            if rollover and not self.complete:
+                # the stacks have been updated already, so the current
+                # event is written to the file that will contain the
+                # matching begin/end event
+                stack = self.stacks.stacks[frame.thread]
+                if event.kind == '{':
+                    stack.pop()
+                    self.close()
+                    stack.append(frame)
+                    self.open()
+                else:
+                    self.end(frame, event.timestamp)
+                    self.last_timestamp = event.timestamp
+                    self.close()
+                    self.open()
+                self.last_timestamp = event.timestamp
+                continue
+            if rollover:
+                self.close()
+                self.open()
+            self.last_timestamp = event.timestamp
+            if self.complete:
+                if event.kind == '}':
+                    self.complete_call(frame)
+            elif event.kind == '{':
+                self.begin(frame)
+            else:
+                self.end(frame, event.timestamp)
+        self.close()
+        return self.paths
+
+
+def write_sqlite(events, path, batch_size=100000):
+    """Load the calls of CallSeq output events into SQLite database.
+
+    The database will contain tables
+
+      sites(id, name, signature, location)
+      calls(id, parent, site, this, thread, depth, start_ns, end_ns, duration_ns, self_ns)
+
+    where calls.parent is the id of the calling call or NULL for the
+    outermost calls. An existing database file is replaced. Returns the number
+    of loaded calls.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.executescript("""
+PRAGMA journal_mode = OFF;
+PRAGMA synchronous = OFF;
+CREATE TABLE sites (id INTEGER PRIMARY KEY, name TEXT, signature TEXT, location TEXT);
+CREATE TABLE calls (id INTEGER PRIMARY KEY, parent INTEGER, site INTEGER, this INTEGER,
+                    thread INTEGER, depth INTEGER, start_ns INTEGER, end_ns INTEGER,
+                    duration_ns INTEGER, self_ns INTEGER);
+""")
+    insert = 'INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    stacks = CallStacks()
+    rows = []
+    count = 0
+    connection.execute('BEGIN')
+    for event, frame in stacks(events):
+        if event.kind == '{':
+            continue
+        parent = frame.parent
+        inclusive = frame.end - frame.start
+        rows.append((frame.call_id, None if parent is None else parent.call_id, frame.site,
+                     frame.this, frame.thread, frame.depth, frame.start, frame.end,
+                     inclusive, inclusive - frame.children))
+        if len(rows) >= batch_size:
+            connection.executemany(insert, rows)
+            count += len(rows)
+            rows.clear()
+    connection.executemany(insert, rows)
+    count += len(rows)
+    connection.executemany(
+        'INSERT INTO sites VALUES (?, ?, ?, ?)',
+        [(site, function_name(signature), signature, location)
+         for site, (signature, location) in stacks.sites.items()])
+    connection.execute('COMMIT')
+    connection.executescript("""
+CREATE INDEX calls_site ON calls (site);
+CREATE INDEX calls_this ON calls (this);
+CREATE INDEX calls_parent ON calls (parent);
+CREATE INDEX calls_thread_start ON calls (thread, start_ns);
+CREATE INDEX sites_name ON sites (name);
+""")
+    connection.close()
+    return count
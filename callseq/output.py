@@ -0,0 +1,630 @@
+"""
+Reading CallSeq output files.
+
+A CallSeq output file contains one event per line. Entering a
+function/method is recorded as
+
+  {<site id>|<this>|<seconds>.<nanoseconds>|<thread id>|<signature>|<file>#<lineno>
+
+and leaving it as
+
+  }<site id>|<this>|<seconds>.<nanoseconds>|<thread id>
+
+Timestamps are relative to the start of the process that is recorded
+in the header line
+
+  #callseq pid=<process id> start=<nanoseconds since epoch>
+
+In merged outputs of several processes, the process id is stored in
+the bits of thread id above the 24 bits of thread hash.
+
+An output can be split into numbered segments `<output>.seg1`,
+`<output>.seg2`, etc. The header of each segment records the calls that
+are open at the start of the segment as enter events prefixed with
+`#`, so that the call stacks can be reconstructed when older segments
+have been removed.
+"""
+
+import os
+import re
+import bisect
+import collections
+import heapq
+import json
+import mmap
+
+
+Event = collections.namedtuple(
+    'Event', ['kind', 'site', 'this', 'timestamp', 'thread', 'signature', 'location'])
+
+
+def parse_timestamp(word):
+    """Return timestamp in nanoseconds.
+
+    The nanoseconds part may be written without leading zeros, so the
+    timestamp cannot be parsed as a float.
+    """
+    sec, _, nsec = word.partition('.')
+    return int(sec) * 1000000000 + int(nsec or 0)
+
+
+def parse_event(line):
+    """Parse a line of CallSeq output into an Event.
+
+    Returns None for lines that do not represent an event.
+    """
+    kind = line[:1]
+    if kind == '#' and line[1:2] == '{':
+        # enter event of a call that is open at the start of a segment
+        kind = '#{'
+        line = line[1:]
+    if kind == '{' or kind == '#{':
+        site, this, timestamp, thread, rest = line[1:].rstrip('\n').split('|', 4)
+        # signature may contain `|`, e.g. `operator|`
+        signature, location = rest.rsplit('|', 1)
+    elif kind == '}':
+        site, this, timestamp, thread = line[1:].rstrip('\n').split('|', 3)
+        signature = location = None
+    else:
+        return None
+    return Event(kind, int(site), int(this, 16), parse_timestamp(timestamp), int(thread, 16),
+                 signature, location)
+
+
+def parse_header(line):
+    """Parse a header line of CallSeq output into a dictionary.
+
+    Returns None for lines that are not header lines.
+    """
+    if not line.startswith('#callseq '):
+        return None
+    header = {}
+    for item in line.split()[1:]:
+        key, _, value = item.partition('=')
+        header[key] = int(value) if value.isdigit() else value
+    return header
+
+
+def read_header(path):
+    with open(trace_segments(path)[0]) as f:
+        for line in f:
+            header = parse_header(line)
+            if header is not None:
+                return header
+            if line[:1] in '{}':
+                break
+    return {}
+
+
+def format_event(event):
+    """Return a line of CallSeq output representing an event.
+    """
+    sec, nsec = divmod(event.timestamp, 1000000000)
+    line = f'{event.kind}{event.site}|0x{event.this:x}|{sec}.{nsec:09d}|0x{event.thread:x}'
+    if event.kind != '}':
+        line += f'|{event.signature}|{event.location}'
+    return line
+
+
+def function_name(signature):
+    """Return the qualified name of a function from its signature.
+
+    For example, `int A<T>::bar(int) const [with T = int]` gives
+    `A<T>::bar`.
+    """
+    i = signature.find(' [with ')
+    if i != -1:
+        signature = signature[:i]
+    end = signature.rfind(')')
+    if end == -1:
+        return signature
+    depth = 0
+    for i in range(end, -1, -1):
+        c = signature[i]
+        if c == ')':
+            depth += 1
+        elif c == '(':
+            depth -= 1
+            if depth == 0:
+                break
+    name = signature[:i].rstrip()
+    end = name.rfind('operator')
+    end = len(name) if end == -1 else end
+    depth = 0
+    for i in range(end - 1, -1, -1):
+        c = name[i]
+        if c == '>':
+            depth += 1
+        elif c == '<':
+            depth -= 1
+        elif c == ' ' and depth == 0:
+            return name[i + 1:]
+    return name
+
+
+def trace_segments(path):
+    """Return the list of files of a CallSeq output.
+
+    When the path does not exist, the existing segments `<path>.seg<n>`
+    are returned in the order of segment numbers. Note that
+    `<path>.<pid>` are the outputs of forked processes, not segments.
+    """
+    if os.path.isfile(path):
+        return [path]
+    dirname, basename = os.path.split(path)
+    pattern = re.compile(re.escape(basename) + r'[.]seg(\d+)\Z')
+    segments = []
+    for name in os.listdir(dirname or '.'):
+        m = pattern.match(name)
+        if m is not None:
+            segments.append((int(m.group(1)), os.path.join(dirname, name)))
+    if not segments:
+        raise FileNotFoundError(path)
+    return [segment for _, segment in sorted(segments)]
+
+
+def iter_events(trace):
+    """Iterate over the events of a CallSeq output.
+
+    trace is a path to CallSeq output file or segments, or an iterable
+    of lines.
+    """
+    if isinstance(trace, str):
+        for path in trace_segments(trace):
+            with open(path) as f:
+                yield from iter_events(f)
+        return
+    for line in trace:
+        event = parse_event(line)
+        if event is not None:
+            yield event
+
+
+class Frame:
+    """Frame represents a function/method call in a call stack.
+
+    Frame has a link to the frame of the calling function/method so
+    that the full call path is available from any frame. The data
+    attribute can be used by analysis tools to attach their own
+    information to the frame.
+    """
+
+    __slots__ = ('site', 'this', 'thread', 'start', 'end', 'children', 'depth', 'call_id',
+                 'parent', 'data')
+
+    def __init__(self, site, this, thread, start, parent, depth, call_id):
+        self.site = site
+        self.this = this
+        self.thread = thread
+        self.start = start
+        self.end = None
+        self.children = 0  # total inclusive time of called functions
+        self.depth = depth
+        self.call_id = call_id
+        self.parent = parent
+        self.data = None
+
+    def __repr__(self):
+        return (f'{type(self).__name__}({self.site}, 0x{self.this:x}, 0x{self.thread:x},'
+                f' {self.start}, {self.end})')
+
+    @property
+    def inclusive(self):
+        return self.end - self.start
+
+    @property
+    def exclusive(self):
+        return self.end - self.start - self.children
+
+    def path(self):
+        """Return the list of site ids from the outermost call to this call.
+        """
+        sites = []
+        frame = self
+        while frame is not None:
+            sites.append(frame.site)
+            frame = frame.parent
+        sites.reverse()
+        return sites
+
+
+class CallStacks:
+    """Reconstructs per-thread call stacks from a stream of events.
+
+    The state of call stacks is preserved between calls so that events
+    can be fed in several chunks.
+    """
+
+    def __init__(self):
+        self.stacks = {}   # thread id -> list of open frames
+        self.sites = {}    # site id -> (signature, location)
+        self.ncalls = 0
+        self.threads = set()  # threads with events
+
+    def push(self, thread, site, this, start):
+        stack = self.stacks.get(thread)
+        if stack is None:
+            stack = self.stacks[thread] = []
+        frame = Frame(site, this, thread, start, stack[-1] if stack else None,
+                      len(stack), self.ncalls)
+        self.ncalls += 1
+        stack.append(frame)
+        return frame
+
+    def pop(self, thread, site, end):
+        stack = self.stacks.get(thread)
+        if not stack:
+            # the call was entered before the start of the trace
+            return None
+        frame = stack.pop()
+        assert frame.site == site, (frame, site)
+        frame.end = end
+        if frame.parent is not None:
+            frame.parent.children += end - frame.start
+        return frame
+
+    def __call__(self, events):
+        """Generate (event, frame) pairs.
+
+        For enter events, the frame is the new top of the thread
+        stack. For exit events, the frame has been popped from the
+        thread stack and has its end time set. Exit events of calls that
+        were entered before the start of the trace are skipped.
+
+        Open calls recorded in segment headers are pushed to the stack
+        of a thread only if the thread has no events so far.
+        """
+        sites = self.sites
+        threads = self.threads
+        for event in events:
+            if event.kind == '{':
+                if event.site not in sites:
+                    sites[event.site] = (event.signature, event.location)
+                frame = self.push(event.thread, event.site, event.this, event.timestamp)
+                threads.add(event.thread)
+            elif event.kind == '#{':
+                if event.thread not in threads:
+                    if event.site not in sites:
+                        sites[event.site] = (event.signature, event.location)
+                    self.push(event.thread, event.site, event.this, event.timestamp)
+                continue
+            else:
+                threads.add(event.thread)
+                frame = self.pop(event.thread, event.site, event.timestamp)
+                if frame is None:
+                    continue
+            yield event, frame
+
+
+class TraceIndex:
+    """Sparse index of a CallSeq output.
+
+    The index holds a checkpoint after every interval events. A
+    checkpoint records the byte offset of the next event, the number of
+    events and calls read so far, the largest timestamp seen so far,
+    and the open call stacks of all threads. Reading of the output can
+    be started from any checkpoint with correctly reconstructed call
+    stacks, so that the chunks of the output between consecutive
+    checkpoints can be processed in parallel.
+
+    The segments of a segmented output are indexed as a single output:
+    byte offsets are counted in the concatenation of the segments, and
+    the paths and the sizes of the segments are stored in the index.
+    """
+
+    def __init__(self, trace, interval, size, sites, checkpoints, segments=None):
+        self.trace = trace
+        self.interval = interval
+        self.size = size
+        self.sites = sites
+        self.checkpoints = checkpoints
+        self.timestamps = [c[2] for c in checkpoints]
+        self.event_numbers = [c[1] for c in checkpoints]
+        self.segments = segments if segments is not None else [(trace, size)]
+        self.starts = []  # offsets of segments
+        offset = 0
+        for path, segment_size in self.segments:
+            self.starts.append(offset)
+            offset += segment_size
+
+    @staticmethod
+    def current_segments(trace):
+        """Return the list of (path, size) of the segments of a trace.
+        """
+        return [(os.path.abspath(path), os.path.getsize(path)) for path in trace_segments(trace)]
+
+    @classmethod
+    def build(cls, trace, interval=100000):
+        stacks = CallStacks()
+        checkpoints = [(0, 0, 0, 0, {})]
+        segments = []
+        state = dict(offset=0, nevents=0, timestamp=0)
+
+        def events():
+            for path in trace_segments(trace):
+                start = state['offset']
+                with open(path, 'rb') as f:
+                    for line in f:
+                        state['offset'] += len(line)
+                        event = parse_event(line.decode())
+                        if event is None:
+                            continue
+                        state['nevents'] += 1
+                        if event.timestamp > state['timestamp']:
+                            state['timestamp'] = event.timestamp
+                        yield event
+                        # stacks contain all events read so far
+                        if state['nevents'] % interval == 0:
+                            checkpoints.append(
+                                (state['offset'], state['nevents'], state['timestamp'],
+                                 stacks.ncalls,
+                                 {thread: [(fr.site, fr.this, fr.start, fr.call_id, fr.children)
+                                           for fr in stack]
+                                  for thread, stack in stacks.stacks.items() if stack}))
+                segments.append((os.path.abspath(path), state['offset'] - start))
+
+        for event, frame in stacks(events()):
+            pass
+        return cls(trace, interval, state['offset'], stacks.sites, checkpoints,
+                   segments=segments)
+
+    @classmethod
+    def get(cls, trace, interval=100000):
+        """Return the index of a trace.
+
+        The index is loaded from `<trace>.idx` file. The index is built
+        and saved when it does not exist or is out of date.
+        """
+        path = trace + '.idx'
+        if os.path.isfile(path):
+            index = cls.load(path)
+            if index.segments == cls.current_segments(trace):
+                return index
+        index = cls.build(trace, interval=interval)
+        index.save(path)
+        return index
+
+    def save(self, path=None):
+        if path is None:
+            path = self.trace + '.idx'
+        data = dict(trace=os.path.abspath(self.trace), interval=self.interval, size=self.size,
+                    segments=self.segments,
+                    sites={str(k): v for k, v in self.sites.items()},
+                    checkpoints=[c[:4] + ({f'0x{t:x}': s for t, s in c[4].items()},)
+                                 for c in self.checkpoints])
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        sites = {int(k): tuple(v) for k, v in data['sites'].items()}
+        checkpoints = [tuple(c[:4]) + ({int(t, 16): s for t, s in c[4].items()},)
+                       for c in data['checkpoints']]
+        segments = None
+        if 'segments' in data:
+            segments = [tuple(segment) for segment in data['segments']]
+        return cls(data['trace'], data['interval'], data['size'], sites, checkpoints,
+                   segments=segments)
+
+    def checkpoint(self, time=None, event=None):
+        """Return the last checkpoint before the given time (in nanoseconds)
+        or event number.
+        """
+        if time is not None:
+            i = bisect.bisect_right(self.timestamps, time) - 1
+            # events are not strictly ordered by timestamps
+            i = max(i - 1, 0)
+        elif event is not None:
+            i = bisect.bisect_right(self.event_numbers, event) - 1
+        else:
+            i = 0
+        return self.checkpoints[i]
+
+    def restore(self, checkpoint):
+        """Return CallStacks with the state at the checkpoint.
+        """
+        stacks = CallStacks()
+        stacks.sites.update(self.sites)
+        for thread, frames in checkpoint[4].items():
+            for site, this, start, call_id, children in frames:
+                frame = stacks.push(thread, site, this, start)
+                frame.call_id = call_id
+                frame.children = children
+        stacks.ncalls = checkpoint[3]
+        stacks.threads.update(checkpoint[4])
+        return stacks
+
+    def lines(self, offset):
+        """Iterate over the lines of the trace starting from the byte offset.
+        """
+        i = bisect.bisect_right(self.starts, offset) - 1
+        offset -= self.starts[i]
+        for path, size in self.segments[i:]:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size > offset:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                        m.seek(offset)
+                        yield from iter(m.readline, b'')
+            offset = 0
+
+    def events(self, checkpoint, count=None):
+        """Iterate over the events of the trace starting from the checkpoint.
+
+        When count is specified, at most count events are generated.
+        """
+        for line in self.lines(checkpoint[0]):
+            if count is not None and count <= 0:
+                break
+            event = parse_event(line.decode())
+            if event is not None:
+                if count is not None:
+                    count -= 1
+                yield event
+
+    def window(self, start_time=None, end_time=None, start_event=None, end_event=None):
+        """Generate (event, frame) pairs of the events in a time window
+        (in nanoseconds) or in a range of event numbers.
+
+        Events are numbered from zero and end_event is exclusive. All
+        events are numbered, including the ones that do not produce
+        pairs, as in the index.
+        """
+        checkpoint = self.checkpoint(time=start_time, event=start_event)
+        stacks = self.restore(checkpoint)
+        number = [checkpoint[1] - 1]
+
+        def events():
+            for event in self.events(checkpoint):
+                number[0] += 1
+                if end_event is not None and number[0] >= end_event:
+                    break
+                if end_time is not None and event.timestamp > end_time:
+                    break
+                yield event
+
+        for event, frame in stacks(events()):
+            if start_event is not None and number[0] < start_event:
+                continue
+            if start_time is not None and event.timestamp < start_time:
+                continue
+            yield event, frame
+
+
+def merge_traces(paths, f):
+    """Merge the CallSeq outputs of several processes into a single output.
+
+    Events are ordered by timestamps and thread ids are tagged with
+    process ids. The process id of an output is read from its header,
+    from the last number in the file name, or is the index of the path.
+    Returns the number of merged events.
+    """
+    headers = [read_header(path) for path in paths]
+    starts = [header.get('start', 0) for header in headers]
+    start = min(starts) if starts else 0
+    pids = []
+    for i, (path, header) in enumerate(zip(paths, headers)):
+        pid = header.get('pid')
+        if pid is None:
+            numbers = re.findall(r'\d+', os.path.basename(path))
+            pid = int(numbers[-1]) if numbers else i
+        pids.append(pid)
+
+    def events(path, pid, offset):
+        tag = pid << 24
+        for event in iter_events(path):
+            yield event._replace(timestamp=event.timestamp + offset,
+                                 thread=tag | (event.thread & 0xffffff))
+
+    count = 0
+    f.write(f'#callseq start={start} processes={",".join(map(str, pids))}\n')
+    for event in heapq.merge(*[events(path, pid, s - start)
+                               for path, pid, s in zip(paths, pids, starts)],
+                             key=lambda event: event.timestamp):
+        f.write(format_event(event) + '\n')
+        count += 1
+    return count
+
+
+class TraceFollower:
+    """Follows a growing CallSeq output file.
+
+    Each poll reads only the bytes appended since the previous poll.
+    Incomplete last line is kept until it is completed. When the file
+    is truncated or replaced, reading starts again from the beginning.
+    Rewriting of the file is detected by comparing its first bytes.
+
+    For a segmented output, the newest segment is followed and, when
+    the output is rotated, reading continues from the next segment.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.current = None  # path of the followed file
+        self.file = None
+        self.offset = 0
+        self.partial = b''
+        self.head = b''
+        self.restarted = False
+
+    def open(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.current, 'rb', buffering=0)
+        self.offset = 0
+        self.partial = b''
+        self.head = b''
+
+    def rewritten(self):
+        self.file.seek(0)
+        return self.file.read(len(self.head)) != self.head
+
+    def number(self, path):
+        """Return the segment number of a path, 0 for the output path.
+        """
+        return 0 if path == self.path else int(path.rsplit('.seg', 1)[1])
+
+    def read(self):
+        """Return the list of new events of the followed file.
+        """
+        try:
+            stat = os.stat(self.current)
+        except FileNotFoundError:
+            return []
+        if (self.file is None or os.fstat(self.file.fileno()).st_ino != stat.st_ino
+                or stat.st_size < self.offset or self.rewritten()):
+            self.restarted = self.restarted or self.file is not None
+            self.open()
+        if stat.st_size == self.offset:
+            return []
+        self.file.seek(self.offset)
+        data = self.file.read(stat.st_size - self.offset)
+        self.offset += len(data)
+        if len(self.head) < 64:
+            self.head = (self.head + data)[:64]
+        data = self.partial + data
+        i = data.rfind(b'\n') + 1
+        self.partial = data[i:]
+        events = []
+        for line in data[:i].decode().splitlines():
+            event = parse_event(line)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def poll(self):
+        """Return the list of new events.
+        """
+        self.restarted = False
+        try:
+            paths = trace_segments(self.path)
+        except FileNotFoundError:
+            return []
+        if self.current not in paths:
+            if self.current is None:
+                self.current = paths[-1]
+            else:
+                # the followed segment has been removed or the output
+                # has been restarted
+                number = self.number(self.current)
+                newer = [path for path in paths if self.number(path) > number]
+                if not newer:
+                    self.restarted = True
+                self.current = (newer or paths)[0]
+                self.close()
+        events = self.read()
+        i = paths.index(self.current) + 1
+        while i < len(paths):
+            # the output has been rotated, continue from the next segment
+            self.current = paths[i]
+            self.close()
+            events.extend(self.read())
+            i += 1
+        return events
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
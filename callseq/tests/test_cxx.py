@@ -1,8 +1,15 @@
 import os
+import re
+import time
 import shutil
 import tempfile
 import filecmp
 import callseq
+import callseq.analysis
+import callseq.counters
+import callseq.cxx.clang_ast_dump
+import callseq.cxx.clang_cindex
+import callseq.output
 import pytest
 
 
@@ -10,6 +17,52 @@ def get_root_path():
     return os.path.dirname(os.path.dirname(__file__))
 
 
+requires_clang = pytest.mark.skipif(shutil.which('clang++') is None,
+                                    reason='clang++ is not installed')
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def write_file(path, content, mode='w'):
+    with open(path, mode) as f:
+        f.write(content)
+
+
+def compare_applied(apply_a, apply_b, names=None):
+    """Apply callseq hooks to two copies of cxx/src and check that the
+    results are equal up to site ids.
+
+    apply_a and apply_b are called with the list of sources of the
+    respective copy, either the given names or all collected C++ sources.
+    Returns the number of sources and the elapsed times of both calls.
+    """
+    test_src_root = os.path.join(get_root_path(), 'cxx', 'src')
+    with tempfile.TemporaryDirectory() as working_dir:
+        sources = []
+        for copy in ['a', 'b']:
+            root = os.path.join(working_dir, copy)
+            shutil.copytree(test_src_root, root)
+            if names is None:
+                sources.append(callseq.actions.Collector(std='C++', recursive=True)(root))
+            else:
+                sources.append([os.path.join(root, name) for name in names])
+        elapsed = []
+        for apply, sources_ in zip([apply_a, apply_b], sources):
+            start = time.time()
+            apply(sources_)
+            elapsed.append(time.time() - start)
+        for f1, f2 in zip(*sources):
+            # site ids differ
+            content1 = re.sub(r'CALLSEQ_SIGNAL[(]\d+', 'CALLSEQ_SIGNAL(', read_file(f1))
+            content2 = re.sub(r'CALLSEQ_SIGNAL[(]\d+', 'CALLSEQ_SIGNAL(', read_file(f2))
+            assert 'CALLSEQ_SIGNAL(' in content1
+            assert content1 == content2
+        return len(sources[0]), elapsed
+
+
 def test_cxx_build():
     test_src = os.path.join(get_root_path(), 'cxx', 'src', 'test.cpp')
 
@@ -223,3 +276,672 @@ def test_cxx_callseq_fraction(callseq_cmake):
     f = open(callseq_output)
     callseq.actions.ShowCallSeqOutput()(f.read())
     f.close()
+
+
+fork_src = '''\
+#include <sys/wait.h>
+#include <unistd.h>
+#include <iostream>
+
+int work(int n) {CALLSEQ_SIGNAL(1,CALLSEQ_DUMMY_THIS);
+  return n + 1;
+}
+
+int main() {CALLSEQ_SIGNAL(2,CALLSEQ_DUMMY_THIS);
+  pid_t pid = fork();
+  int r = work(pid == 0 ? 1 : 2);
+  if (pid != 0) {
+    waitpid(pid, nullptr, 0);
+    // a child that only execs does not create an output file
+    pid_t exec_pid = fork();
+    if (exec_pid == 0) {
+      execl("/bin/true", "true", (char *)nullptr);
+      _exit(1);
+    }
+    waitpid(exec_pid, nullptr, 0);
+  }
+  std::cout << "r=" << r << std::endl;
+}
+'''
+
+
+early_fork_src = '''\
+#include <sys/wait.h>
+#include <unistd.h>
+
+int work(int n) {CALLSEQ_SIGNAL(1,CALLSEQ_DUMMY_THIS);
+  return n + 1;
+}
+
+int main() {
+  // fork before the first event
+  pid_t pid = fork();
+  work(pid == 0 ? 1 : 2);
+  if (pid != 0) {
+    waitpid(pid, nullptr, 0);
+  }
+}
+'''
+
+
+@pytest.mark.parametrize('template', ['callseq.%p.output', 'callseq.output'])
+def test_cxx_fork_output(template):
+    callseq_hpp = os.path.join(get_root_path(), 'cxx', 'include', 'callseq.hpp')
+
+    with tempfile.TemporaryDirectory() as working_dir:
+        src = os.path.join(working_dir, 'fork.cpp')
+        with open(src, 'w') as f:
+            f.write(fork_src)
+        compiler = callseq.actions.Compiler.get('c++17')
+        app_exe = os.path.join(working_dir, 'app')
+        callseq_output = os.path.join(working_dir, template)
+        s, out, err = compiler(src, app_exe,
+                               flags=['-include', callseq_hpp,
+                                      f'-DCALLSEQ_OUTPUT="{callseq_output}"'],
+                               task='build')
+        assert s == 0
+        s, out, err = callseq.actions.Application(app_exe)()
+        assert s == 0
+        assert sorted(line for line in out.splitlines() if line.startswith('r=')) == ['r=2', 'r=3']
+
+        paths = sorted(os.path.join(working_dir, name) for name in os.listdir(working_dir)
+                       if name.startswith('callseq.'))
+        assert len(paths) == 2
+        pids = [callseq.output.read_header(path)['pid'] for path in paths]
+        assert len(set(pids)) == 2
+        for path, pid in zip(paths, pids):
+            assert str(pid) in os.path.basename(path) or os.path.basename(path) == template
+
+        merged = os.path.join(working_dir, 'merged.output')
+        with open(merged, 'w') as f:
+            assert callseq.output.merge_traces(paths, f) == 7
+        cct = callseq.analysis.CallingContextTree().update(callseq.output.iter_events(merged))
+        # the child process does not see entering main
+        assert cct.root.children[2].count == 1
+        assert cct.root.children[2].children[1].count == 1
+        assert cct.root.children[1].count == 1
+        threads = {thread >> 24 for thread in cct.stacks.stacks}
+        assert threads == set(pids)
+
+
+def test_cxx_early_fork_output():
+    callseq_hpp = os.path.join(get_root_path(), 'cxx', 'include', 'callseq.hpp')
+
+    with tempfile.TemporaryDirectory() as working_dir:
+        src = os.path.join(working_dir, 'fork.cpp')
+        write_file(src, early_fork_src)
+        compiler = callseq.actions.Compiler.get('c++17')
+        app_exe = os.path.join(working_dir, 'app')
+        callseq_output = os.path.join(working_dir, 'callseq.output')
+        s, out, err = compiler(src, app_exe,
+                               flags=['-include', callseq_hpp,
+                                      f'-DCALLSEQ_OUTPUT="{callseq_output}"'],
+                               task='build')
+        assert s == 0
+        s, out, err = callseq.actions.Application(app_exe)()
+        assert s == 0
+
+        paths = sorted(os.path.join(working_dir, name) for name in os.listdir(working_dir)
+                       if name.startswith('callseq.'))
+        assert len(paths) == 2
+        assert len({callseq.output.read_header(path)['pid'] for path in paths}) == 2
+        for path in paths:
+            assert [event.kind for event in callseq.output.iter_events(path)] == ['{', '}']
+
+
+recursion_src = '''\
+#include <iostream>
+
+long fib(long n) {CALLSEQ_SIGNAL(1,CALLSEQ_DUMMY_THIS);
+  return (n < 2 ? n : fib(n - 1) + fib(n - 2));
+}
+
+int main() {CALLSEQ_SIGNAL(2,CALLSEQ_DUMMY_THIS);
+  std::cout << "fib(12)=" << fib(12) << std::endl;
+}
+'''
+
+
+def test_cxx_output_segments():
+    callseq_hpp = os.path.join(get_root_path(), 'cxx', 'include', 'callseq.hpp')
+
+    with tempfile.TemporaryDirectory() as working_dir:
+        src = os.path.join(working_dir, 'fib.cpp')
+        with open(src, 'w') as f:
+            f.write(recursion_src)
+        compiler = callseq.actions.Compiler.get('c++17')
+        app_exe = os.path.join(working_dir, 'app')
+        callseq_output = os.path.join(working_dir, 'callseq.output')
+        s, out, err = compiler(src, app_exe,
+                               flags=['-include', callseq_hpp,
+                                      f'-DCALLSEQ_OUTPUT="{callseq_output}"',
+                                      '-DCALLSEQ_SEGMENT_SIZE=10000',
+                                      '-DCALLSEQ_MAX_SEGMENTS=3'],
+                               task='build')
+        assert s == 0
+        s, out, err = callseq.actions.Application(app_exe)()
+        assert s == 0
+        assert out.strip().endswith('fib(12)=144')
+
+        segments = callseq.output.trace_segments(callseq_output)
+        assert len(segments) == 3
+        assert not os.path.exists(callseq_output + '.seg1')
+        assert callseq.output.read_header(callseq_output)['segment'] == int(
+            segments[0].rsplit('.seg', 1)[-1])
+
+        # the calls entered in removed segments are restored from the header
+        cct = callseq.analysis.CallingContextTree().update(
+            callseq.output.iter_events(callseq_output))
+        assert list(cct.root.children) == [2]
+        main = cct.root.children[2]
+        assert main.count == 1
+        assert main.inclusive == cct.root.inclusive
+        assert main.children[1].count == 1
+
+        # analysis works when more segments are removed
+        events = []
+        for segment in segments[1:]:
+            events.extend(callseq.output.iter_events(segment))
+        cct2 = callseq.analysis.CallingContextTree().update(events)
+        assert cct2.root.children[2].inclusive == main.inclusive
+
+
+def test_cxx_shared_counters():
+    callseq_hpp = os.path.join(get_root_path(), 'cxx', 'include', 'callseq.hpp')
+
+    with tempfile.TemporaryDirectory() as working_dir:
+        src = os.path.join(working_dir, 'fib.cpp')
+        with open(src, 'w') as f:
+            f.write(recursion_src)
+        compiler = callseq.actions.Compiler.get('c++17')
+        app_exe = os.path.join(working_dir, 'app')
+        callseq_counters = os.path.join(working_dir, 'callseq.counters')
+        s, out, err = compiler(src, app_exe,
+                               flags=['-include', callseq_hpp,
+                                      f'-DCALLSEQ_COUNTERS="{callseq_counters}"'],
+                               task='build')
+        assert s == 0
+        s, out, err = callseq.actions.Application(app_exe)(cwd=working_dir)
+        assert s == 0
+        assert out.strip().endswith('fib(12)=144')
+        assert os.listdir(working_dir).count('callseq.output') == 0
+
+        counters = callseq.counters.SharedCounters(callseq_counters)
+        current = counters.read()
+        counters.close()
+        assert set(current) == {1, 2}
+        calls, total, inflight, name = current[1]
+        assert calls == 465
+        assert inflight == 0
+        assert name.startswith('long int fib(long int)|')
+        assert current[2][:3] == (1, current[2][1], 0)
+        table = callseq.counters.counters_table(current, current, interval=1)
+        assert [line.split()[0] for line in table.splitlines()[1:]] == ['0.0', '0.0']
+
+
+def test_cxx_compilation_database():
+    project_home = os.path.join(get_root_path(), 'cxx', 'src')
+    with tempfile.TemporaryDirectory() as working_dir:
+        shutil.copytree(project_home, working_dir, dirs_exist_ok=True)
+        build_dir = os.path.join(working_dir, 'build')
+        cmake = callseq.actions.CMake(working_dir, build_dir)
+        cmake.configure('-DCMAKE_EXPORT_COMPILE_COMMANDS=ON', '-DCMAKE_BUILD_TYPE=Debug')
+        database = callseq.actions.CompilationDatabase(
+            os.path.join(build_dir, 'compile_commands.json'))
+        fraction_cpp = os.path.join(working_dir, 'Symbolic', 'Fraction.cpp')
+        test_cpp = os.path.join(working_dir, 'Tests', 'test_Fraction.cpp')
+        assert database.sources() == [fraction_cpp, test_cpp]
+        assert database.sources([os.path.join(working_dir, 'Tests')]) == [test_cpp]
+        directory, flags = database.get(test_cpp)
+        assert directory.startswith(build_dir)
+        assert '-c' not in flags and '-o' not in flags and '-g' not in flags
+        assert test_cpp not in flags
+        assert f'-I{working_dir}' in flags
+        fraction_hpp = os.path.join(working_dir, 'Symbolic', 'Fraction.hpp')
+        assert database.get(fraction_hpp) == database.get(fraction_cpp)
+
+        flags = database.clean(['-I', 'inc', '-MD', '-MF', 'a.d', '-O2', '-std=c++17',
+                                '-include', 'pre.h', 'a.cpp'], '/build', '/build/a.cpp')
+        assert flags == ['-I', '/build/inc', '-std=c++17', '-include', '/build/pre.h']
+
+
+def test_compilation_database_clean():
+    clean = callseq.actions.CompilationDatabase.clean
+    flags = clean(['-Iinc', '-isystem', 'sys', '-isystemsys2', '--sysroot=root', '-c', 'a.cpp'],
+                  '/build', '/build/a.cpp')
+    assert flags == ['-I/build/inc', '-isystem', '/build/sys', '-isystem/build/sys2',
+                     '--sysroot=/build/root']
+    # CMake precompiled headers with clang
+    flags = clean(['-Xclang', '-include-pch', '-Xclang', 'cmake_pch.hxx.pch',
+                   '-Xclang', '-include', '-Xclang', 'cmake_pch.hxx', '-include-pch', 'b.pch',
+                   'a.cpp'], '/build', '/build/a.cpp')
+    assert flags == ['-Xclang', '-include-pch', '-Xclang', '/build/cmake_pch.hxx.pch',
+                     '-Xclang', '-include', '-Xclang', '/build/cmake_pch.hxx',
+                     '-include-pch', '/build/b.pch']
+    flags = clean(['-Xclang', '-fno-pch-timestamp', '-imacrosfoo.h', 'a.cpp'],
+                  '/build', '/build/a.cpp')
+    assert flags == ['-Xclang', '-fno-pch-timestamp', '-imacrosfoo.h']
+    flags = clean(['-Wall', '-Wl,--as-needed', '-Wp,-DFOO', '-Wp,-include,pre.h', 'a.cpp'],
+                  '/build', '/build/a.cpp')
+    assert flags == ['-Wp,-DFOO', '-Wp,-include,pre.h']
+
+
+def test_cxx_callseq_compile_commands():
+    std = 'C++'
+    project_home = os.path.join(get_root_path(), 'cxx', 'src')
+    with tempfile.TemporaryDirectory() as working_dir:
+        shutil.copytree(project_home, working_dir, dirs_exist_ok=True)
+        build_dir = os.path.join(working_dir, 'build')
+        callseq.actions.CMake(working_dir, build_dir).configure(
+            '-DCMAKE_EXPORT_COMPILE_COMMANDS=ON')
+        database = callseq.actions.CompilationDatabase(
+            os.path.join(build_dir, 'compile_commands.json'))
+        sources = database.sources()
+        modified_sources = callseq.actions.MultiCallSeq(
+            std=std, task='apply', compile_commands=database, source_root=working_dir)(sources)
+        fraction_hpp = os.path.join(working_dir, 'Symbolic', 'Fraction.hpp')
+        assert modified_sources == sources + [fraction_hpp]
+        for source in modified_sources:
+            assert 'CALLSEQ_SIGNAL(' in read_file(source)
+
+
+def test_split_ast_dumps():
+    dump = """\
+TranslationUnitDecl 0x1 <<invalid sloc>> <invalid sloc>
+`-FunctionDecl 0x2 </a.cpp:1:1, col:10> col:5 f 'int ()'
+TranslationUnitDecl 0x3 <<invalid sloc>> <invalid sloc>
+|-FunctionDecl 0x4 </b.cpp:1:1, col:10> col:5 g 'int ()'
+`-FunctionDecl 0x5 <line:2:1, col:10> col:5 h 'int ()'
+"""
+    a, b = callseq.cxx.clang_ast_dump.split_ast_dumps(dump)
+    assert a.splitlines()[1].endswith("f 'int ()'")
+    assert len(b.splitlines()) == 3
+    assert callseq.cxx.clang_ast_dump.split_ast_dumps('') == []
+
+
+def test_ast_dump_static_method():
+    with tempfile.TemporaryDirectory() as working_dir:
+        a = os.path.join(working_dir, 'a.cpp')
+        source = 'struct A {\n  static int f() { return 1; }\n  int g() { return 2; }\n};\n'
+        write_file(a, source)
+        # clang >= 15 dumps implicit-inline after static
+        dump = f"""\
+TranslationUnitDecl 0x1 <<invalid sloc>> <invalid sloc>
+`-CXXRecordDecl 0x2 <{a}:1:1, line:4:1> line:1:8 struct A definition
+  |-CXXRecordDecl 0x3 <col:1, col:8> col:8 implicit struct A
+  |-CXXMethodDecl 0x4 <line:2:3, col:30> col:14 f 'int ()' static implicit-inline
+  | `-CompoundStmt 0x5 <col:18, col:30>
+  `-CXXMethodDecl 0x6 <line:3:3, col:23> col:7 g 'int ()' implicit-inline
+    `-CompoundStmt 0x7 <col:11, col:23>
+"""
+        ast = callseq.cxx.clang_ast_dump.parse_ast_dump(dump, a)
+        output = callseq.cxx.insert_signal_code(ast, a, source, iter(range(1, 3)).__next__)
+        assert 'static int f() {CALLSEQ_SIGNAL(1,CALLSEQ_DUMMY_THIS);' in output
+        assert 'int g() {CALLSEQ_SIGNAL(2,this);' in output
+
+
+@requires_clang
+def test_cxx_multi_callseq_batched():
+    std = 'C++'
+    compare_applied(
+        callseq.actions.MultiCallSeq(std=std, task='apply'),
+        callseq.actions.MultiCallSeq(std=std, task='apply', batch_size=3,
+                                     backend='subprocess'))
+
+
+def test_common_includes():
+    with tempfile.TemporaryDirectory() as working_dir:
+        a = os.path.join(working_dir, 'a.cpp')
+        b = os.path.join(working_dir, 'b.cpp')
+        write_file(a, '// a\n#include <vector>\n\n#include <map>\n#include "a.hpp"\nint a;\n')
+        write_file(b, '#pragma once\n#include <vector>\n#include <map>\n#include <set>\n')
+        assert callseq.actions.common_includes([a, b]) == ['<vector>', '<map>']
+        assert callseq.actions.common_includes([b]) == ['<vector>', '<map>', '<set>']
+        assert callseq.actions.common_includes([]) == []
+
+
+@requires_clang
+def test_cxx_multi_callseq_prelude():
+    std = 'C++'
+    with tempfile.TemporaryDirectory() as pch_dir:
+        multi = callseq.actions.MultiCallSeq(std=std, task='apply', prelude='auto',
+                                             pch_dir=pch_dir, backend='subprocess')
+        # sources that include <iostream>
+        compare_applied(callseq.actions.MultiCallSeq(std=std, task='apply'), multi,
+                        names=['factorial.cpp', 'test.cpp'])
+        assert multi.callseq.ast_reader.prelude is not None
+        assert [f for f in os.listdir(pch_dir) if f.endswith('.pch')]
+
+
+fake_clang = """\
+#!/bin/sh
+# precompiles successfully but fails to dump the AST
+while [ $# -gt 0 ]; do
+    if [ "$1" = -o ]; then : > "$2"; exit 0; fi
+    shift
+done
+echo 'error: cannot dump the AST' >&2
+exit 1
+"""
+
+
+@requires_clang
+def test_cxx_prelude_ast_failure():
+    with tempfile.TemporaryDirectory() as working_dir:
+        prelude = os.path.join(working_dir, 'prelude.hpp')
+        write_file(prelude, '#include <vector>\n')
+        reader = callseq.actions.ClangAstReader(prelude=prelude, backend='subprocess',
+                                                pch_dir=os.path.join(working_dir, 'pch'))
+        reader.clang_exe = os.path.join(working_dir, 'clang++')
+        write_file(reader.clang_exe, fake_clang)
+        os.chmod(reader.clang_exe, 0o755)
+        with pytest.warns(UserWarning, match='Failed to read the AST of'):
+            assert reader.pch([]) is None
+        assert reader.pchs == {(None, ()): None}
+
+
+def test_narrowed_ast_dumps():
+    with tempfile.TemporaryDirectory() as working_dir:
+        a = os.path.join(working_dir, 'a.cpp')
+        b = os.path.join(working_dir, 'b.hpp')
+        write_file(a, '#include "b.hpp"\nint f() { return g(); }\n')
+        write_file(b, 'int g() { return 1; }\nint h();\n')
+        dump = f"""\
+TranslationUnitDecl 0x1 <<invalid sloc>> <invalid sloc>
+|-TypedefDecl 0x2 <<invalid sloc>> <invalid sloc> implicit __int128_t '__int128'
+|-FunctionDecl 0x3 <{b}:1:1, col:21> col:5 used g 'int ()'
+| `-CompoundStmt 0x4 <col:9, col:21>
+|-FunctionDecl 0x5 <line:2:1, col:7> col:5 h 'int ()'
+`-FunctionDecl 0x6 <{a}:2:1, col:23> col:5 f 'int ()'
+  `-CompoundStmt 0x7 <col:9, col:23>
+"""
+        narrowed = callseq.cxx.clang_ast_dump.main_file_ast_dump(dump, a)
+        assert len(narrowed.splitlines()) == 3
+        ast = callseq.cxx.clang_ast_dump.parse_ast_dump(narrowed, a)
+        assert [(node.value.split()[0], node.loc) for node in ast.nodes] == [('f', a)]
+        narrowed = callseq.cxx.clang_ast_dump.main_file_ast_dump(dump, b)
+        assert len(narrowed.splitlines()) == 4
+
+        filtered = f"""\
+Dumping g:
+FunctionDecl 0x3 <{b}:1:1, col:21> col:5 used g 'int ()'
+`-CompoundStmt 0x4 <col:9, col:21>
+Dumping h:
+FunctionDecl 0x5 <{b}:2:1, col:7> col:5 h 'int ()'
+"""
+        ast = callseq.cxx.clang_ast_dump.parse_ast_dump(
+            callseq.cxx.clang_ast_dump.wrap_filtered_ast_dump(filtered), b)
+        assert ast.key == 'TranslationUnitDecl'
+        assert [node.value.split()[0] for node in ast.nodes] == ['g', 'h']
+        assert [node.key for node in ast.nodes[0].nodes] == ['CompoundStmt']
+        assert ast.nodes[1].lineno == 2
+
+
+@requires_clang
+def test_cxx_libclang_backend():
+    std = 'C++'
+    count, (subprocess_time, libclang_time) = compare_applied(
+        callseq.actions.MultiCallSeq(std=std, task='apply', backend='subprocess'),
+        callseq.actions.MultiCallSeq(std=std, task='apply', backend='libclang'))
+    print(f'\napply {count} files: subprocess {subprocess_time:.3f}s,'
+          f' libclang {libclang_time:.3f}s')
+
+
+def test_libclang_backend_options():
+    with pytest.warns(UserWarning, match='prelude and ast_dump_filter not supported'):
+        reader = callseq.actions.ClangAstReader(prelude='prelude.hpp', ast_dump_filter='ns',
+                                                backend='libclang')
+    assert reader.backend == 'libclang'
+
+
+@requires_clang
+def test_cxx_subprocess_backend_options():
+    reader = callseq.actions.ClangAstReader(ast_dump_filter='ns')
+    assert reader.backend == 'subprocess'
+    reader = callseq.actions.ClangAstReader(prelude='auto')
+    assert reader.backend == 'subprocess' and reader.prelude is None
+
+
+access_source = """\
+class A { int f() { return 1; } public: int g() { return 2; } };
+template <typename T> class B { int f() { return 1; } public: int g() { return 2; } };
+template <typename T> struct C { int g() { return 1; } private: int f() { return 2; } };
+struct D { int g() { return 1; } };
+"""
+
+
+def test_ast_dump_default_access():
+    with tempfile.TemporaryDirectory() as working_dir:
+        a = os.path.join(working_dir, 'a.cpp')
+        write_file(a, access_source)
+        dump = f"""\
+TranslationUnitDecl 0x1 <<invalid sloc>> <invalid sloc>
+|-CXXRecordDecl 0x2 <{a}:1:1, col:63> col:7 class A definition
+| |-CXXRecordDecl 0x3 <col:1, col:7> col:7 implicit class A
+| |-CXXMethodDecl 0x4 <col:11, col:31> col:15 f 'int ()'
+| | `-CompoundStmt 0x5 <col:19, col:31>
+| |-AccessSpecDecl 0x6 <col:33, col:39> col:33 public
+| `-CXXMethodDecl 0x7 <col:41, col:61> col:45 g 'int ()'
+|   `-CompoundStmt 0x8 <col:49, col:61>
+`-CXXRecordDecl 0x9 <line:4:1, col:34> col:8 struct D definition
+  `-CXXMethodDecl 0xa <col:12, col:32> col:16 g 'int ()'
+    `-CompoundStmt 0xb <col:20, col:32>
+"""
+        ast = callseq.cxx.clang_ast_dump.parse_ast_dump(dump, a)
+        names = [node.value.split()[0] for node in ast.traverse(
+            lambda node: node.key == 'CXXMethodDecl')]
+        assert names == ['g', 'g']
+
+
+def test_cxx_libclang_default_access():
+    with tempfile.TemporaryDirectory() as working_dir:
+        a = os.path.join(working_dir, 'a.cpp')
+        write_file(a, access_source)
+        ast = callseq.cxx.clang_cindex.read_ast(a)
+        assert [node.value.split()[0] for node in ast.nodes] == ['g', 'g', 'g', 'g']
+
+
+def test_manifest():
+    with tempfile.TemporaryDirectory() as working_dir:
+        a = os.path.join(working_dir, 'a.cpp')
+        b = os.path.join(working_dir, 'b.hpp')
+        write_file(a, 'int f() {CALLSEQ_SIGNAL(3,CALLSEQ_DUMMY_THIS); return 1; }\n')
+        write_file(b, 'int g() {CALLSEQ_SIGNAL(7,CALLSEQ_DUMMY_THIS); return 1; }\n')
+        path = os.path.join(working_dir, 'manifest.json')
+        manifest = callseq.actions.Manifest(path)
+        assert manifest.changed(a)
+        manifest.record(a, [b])
+        manifest.record(b)
+        manifest.save()
+
+        manifest = callseq.actions.Manifest(path)
+        assert manifest.files[a]['sites'] == [3]
+        assert manifest.max_site() == 7
+        assert not manifest.changed(a) and not manifest.changed(b)
+        write_file(b, 'int h() { return 2; }\n', 'a')
+        manifest = callseq.actions.Manifest(path)
+        assert manifest.changed(a) and manifest.changed(b)
+
+
+def test_cxx_multi_callseq_incremental():
+    std = 'C++'
+    test_src_root = os.path.join(get_root_path(), 'cxx', 'src')
+    with tempfile.TemporaryDirectory() as working_dir:
+        shutil.copytree(test_src_root, working_dir, dirs_exist_ok=True)
+        manifest = os.path.join(working_dir, 'callseq.json')
+        sources = callseq.actions.Collector(std=std, recursive=True)(working_dir)
+        multi = callseq.actions.MultiCallSeq(std=std, task='apply', manifest=manifest)
+        multi(sources)
+        max_site = callseq.actions.Manifest(manifest).max_site()
+        assert max_site > 0
+
+        # nothing changed, no ASTs are read
+        multi = callseq.actions.MultiCallSeq(std=std, task='apply', manifest=manifest)
+        assert multi(sources) == sources
+        assert multi.callseq.ast_cache == {}
+
+        test_cpp = os.path.join(working_dir, 'test.cpp')
+        write_file(test_cpp, 'int new_function(int a) { return a; }\n', 'a')
+        multi = callseq.actions.MultiCallSeq(std=std, task='apply', manifest=manifest)
+        multi(sources)
+        assert test_cpp in multi.callseq.ast_cache
+        assert os.path.join(working_dir, 'factorial.cpp') not in multi.callseq.ast_cache
+        # new sites get new ids
+        assert f'int new_function(int a) {{CALLSEQ_SIGNAL({max_site + 1},' in read_file(test_cpp)
+
+        # a modified header is recorded with its instrumented content
+        fraction_hpp = os.path.join(working_dir, 'Symbolic', 'Fraction.hpp')
+        write_file(fraction_hpp, 'inline int new_header_function(int a) { return a; }\n', 'a')
+        multi = callseq.actions.MultiCallSeq(std=std, task='apply', manifest=manifest)
+        multi(sources)
+        assert os.path.join(working_dir, 'Symbolic', 'Fraction.cpp') in multi.callseq.ast_cache
+        assert 'int new_header_function(int a) {CALLSEQ_SIGNAL(' in read_file(fraction_hpp)
+        multi = callseq.actions.MultiCallSeq(std=std, task='apply', manifest=manifest)
+        multi(sources)
+        assert multi.callseq.ast_cache == {}
+
+        callseq.actions.MultiCallSeq(std=std, task='unapply', manifest=manifest)(sources)
+        assert not os.path.exists(manifest)
+
+
+def test_cxx_watcher():
+    std = 'C++'
+    test_src_root = os.path.join(get_root_path(), 'cxx', 'src')
+    with tempfile.TemporaryDirectory() as working_dir:
+        shutil.copytree(test_src_root, working_dir, dirs_exist_ok=True)
+        sources = callseq.actions.Collector(std=std, recursive=True)(working_dir)
+        multi = callseq.actions.MultiCallSeq(std=std, task='apply')
+        multi(sources)
+        watcher = callseq.actions.Watcher(multi.callseq, [working_dir], interval=0.01)
+        assert watcher.step() == []
+
+        test_cpp = os.path.join(working_dir, 'test.cpp')
+        write_file(test_cpp, 'int new_function(int a) { return a; }\n', 'a')
+        st = os.stat(test_cpp)
+        os.utime(test_cpp, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000))
+        start = time.time()
+        assert watcher.step() == [test_cpp]
+        print(f'\nre-apply {test_cpp}: {time.time() - start:.3f}s')
+        assert 'int new_function(int a) {CALLSEQ_SIGNAL(' in read_file(test_cpp)
+        # the watcher does not react to its own modifications
+        assert watcher.step() == []
+
+
+def test_cxx_compiler_launcher():
+    test_src_root = os.path.join(get_root_path(), 'cxx', 'src')
+    with tempfile.TemporaryDirectory() as working_dir:
+        shutil.copytree(test_src_root, os.path.join(working_dir, 'src'))
+        src = os.path.join(working_dir, 'src', 'factorial.cpp')
+        content = read_file(src)
+        cache_dir = os.path.join(working_dir, 'cache')
+        callseq_output = os.path.join(working_dir, 'callseq.output')
+        command = ['g++', '-std=c++17', f'-DCALLSEQ_OUTPUT="{callseq_output}"', '-c',
+                   'src/factorial.cpp', '-o', 'factorial.o']
+        launcher = callseq.actions.CompilerLauncher(cache_dir=cache_dir)
+        assert launcher(command, cwd=working_dir) == 0
+        assert read_file(src) == content
+        copies = [os.path.join(d, f) for d, _, files in os.walk(cache_dir) for f in files]
+        assert len(copies) == 1
+        assert read_file(copies[0]).startswith(f'#line 1 "{src}"\n')
+        mtime = os.stat(copies[0]).st_mtime_ns
+
+        # unchanged source is not instrumented again
+        launcher = callseq.actions.CompilerLauncher(cache_dir=cache_dir)
+        assert launcher(command, cwd=working_dir) == 0
+        assert launcher._ast_reader is None
+        assert os.stat(copies[0]).st_mtime_ns == mtime
+
+        app_exe = os.path.join(working_dir, 'app')
+        assert launcher(['g++', 'factorial.o', '-o', app_exe], cwd=working_dir) == 0
+        s, out, err = callseq.actions.Application(app_exe)()
+        assert s == 0
+        sites = set()
+        for event in callseq.output.iter_events(callseq_output):
+            sites.add(event.site)
+            if event.kind == '{':
+                assert event.location.rsplit('#', 1)[0] == src
+        assert len(sites) > 1 and min(sites) >= 1 << 20
+
+
+def test_compiler_launcher_c_sources():
+    with tempfile.TemporaryDirectory() as working_dir:
+        for name in ['a.c', 'b.cpp', 'c.c', 'd.c']:
+            write_file(os.path.join(working_dir, name), 'int f(void) { return 1; }\n')
+        launcher = callseq.actions.CompilerLauncher(cache_dir=os.path.join(working_dir, 'cache'))
+        command = ['cc', '-c', 'a.c', 'b.cpp', '-x', 'c++', 'c.c', '-x', 'none', 'd.c']
+        assert launcher.sources(command, working_dir) == [3, 6]
+        assert launcher.sources(['cc', '-xc++', 'a.c'], working_dir) == [2]
+        assert launcher.sources(['c++', '-x', 'c', 'b.cpp'], working_dir) == []
+
+        # C sources are compiled unchanged, without callseq.hpp
+        command = ['gcc', '-std=c99', '-c', 'a.c', '-o', 'a.o']
+        assert launcher(command, cwd=working_dir) == 0
+        assert launcher._ast_reader is None
+        assert not os.path.exists(launcher.cache_dir)
+
+
+def test_mirror_tree():
+    with tempfile.TemporaryDirectory() as working_dir:
+        src = os.path.join(working_dir, 'src')
+        os.makedirs(os.path.join(src, 'a', 'b'))
+        write_file(os.path.join(src, 'a', 'b', 'c.cpp'), 'int c() { return 1; }\n')
+        write_file(os.path.join(src, 'd.txt'), 'd\n')
+        os.symlink('d.txt', os.path.join(src, 'e.txt'))
+        dst = os.path.join(working_dir, 'dst')
+        assert callseq.actions.mirror_tree(src, dst) == 3
+        assert os.path.samefile(os.path.join(src, 'a', 'b', 'c.cpp'),
+                                os.path.join(dst, 'a', 'b', 'c.cpp'))
+        assert os.readlink(os.path.join(dst, 'e.txt')) == 'd.txt'
+        assert callseq.actions.mirror_tree(src, dst) == 0
+
+
+def test_cxx_multi_callseq_output_tree():
+    std = 'C++'
+    test_src_root = os.path.join(get_root_path(), 'cxx', 'src')
+    with tempfile.TemporaryDirectory() as working_dir:
+        src = os.path.join(working_dir, 'src')
+        shutil.copytree(test_src_root, src)
+        output_tree = os.path.join(working_dir, 'instrumented')
+        sources = callseq.actions.Collector(std=std, recursive=True)(src)
+        contents = [read_file(source) for source in sources]
+        outputs = callseq.actions.MultiCallSeq(std=std, task='apply', source_root=src,
+                                               output_tree=output_tree)(sources)
+        assert [read_file(source) for source in sources] == contents
+        assert outputs == [os.path.join(output_tree, os.path.relpath(source, src))
+                           for source in sources]
+        instrumented = 0
+        for source, output in zip(sources, outputs):
+            if 'CALLSEQ_SIGNAL(' in read_file(output):
+                assert not os.path.samefile(source, output)
+                instrumented += 1
+            else:
+                assert os.path.samefile(source, output)
+        assert instrumented > 0
+
+
+def test_unapply():
+    with tempfile.TemporaryDirectory() as working_dir:
+        original = 'int f() { return 1; }\nint g() { return 2; }\n'
+        hooked = ('int f() {CALLSEQ_SIGNAL(1,CALLSEQ_DUMMY_THIS); return 1; }\n'
+                  'int g() {CALLSEQ_SIGNAL(2,CALLSEQ_DUMMY_THIS); return 2; }\n')
+        paths = []
+        for i in range(20):
+            path = os.path.join(working_dir, f'f{i}.cpp')
+            write_file(path, hooked if i % 2 else original)
+            paths.append(path)
+        empty = os.path.join(working_dir, 'empty.hpp')
+        write_file(empty, '')
+        paths.append(empty)
+        mtime = os.stat(paths[0]).st_mtime_ns
+
+        assert callseq.actions.Unapply(try_run=True)(paths) == paths[1:20:2]
+        assert read_file(paths[1]) == hooked
+        assert callseq.actions.Unapply(jobs=4)(paths) == paths[1:20:2]
+        assert all(read_file(path) == original for path in paths[:20])
+        assert os.stat(paths[0]).st_mtime_ns == mtime
+
+        # unapply does not need clang
+        write_file(paths[1], hooked)
+        sources = callseq.actions.MultiCallSeq(task='unapply')(paths)
+        assert sources == paths
+        assert read_file(paths[1]) == original
@@ -0,0 +1,575 @@
+import io
+import os
+import json
+import random
+import sqlite3
+import tempfile
+import callseq
+import callseq.output
+import callseq.analysis
+import callseq.compare
+import callseq.export
+import pytest
+
+
+factorial_output = '''\
+{2|0x0|0.10092680|0xe48eb7|int main()|callseq/cxx/src/factorial.cpp#10
+{1|0x0|0.10178666|0xe48eb7|long int factorial(long int)|callseq/cxx/src/factorial.cpp#4
+}1|0x0|0.10191840|0xe48eb7
+{1|0x0|0.10219697|0xe48eb7|long int factorial(long int)|callseq/cxx/src/factorial.cpp#4
+{1|0x0|0.10229763|0xe48eb7|long int factorial(long int)|callseq/cxx/src/factorial.cpp#4
+}1|0x0|0.10238600|0xe48eb7
+}1|0x0|0.10247423|0xe48eb7
+}2|0x0|0.10388553|0xe48eb7
+'''
+
+threads_output = '''\
+{1|0x0|0.100|0xa|void run()|a.cpp#1
+{2|0x10|0.110|0xa|int A::bar(int) const|a.cpp#5
+{1|0x0|0.120|0xb|void run()|a.cpp#1
+{3|0x0|0.130|0xb|bool operator|(A, A)|a.cpp#9
+}2|0x10|0.140|0xa
+{2|0x20|0.150|0xb|int A::bar(int) const|a.cpp#5
+}2|0x20|0.170|0xb
+}3|0x0|0.180|0xb
+}1|0x0|0.200|0xa
+}1|0x0|0.220|0xb
+'''
+
+
+def test_parse_event():
+    enter, exit = map(callseq.output.parse_event, threads_output.splitlines()[3:5])
+    assert enter.kind == '{'
+    assert enter.site == 3
+    assert enter.signature == 'bool operator|(A, A)'
+    assert enter.location == 'a.cpp#9'
+    assert exit.kind == '}'
+    assert exit.this == 0x10
+    assert exit.timestamp == 140
+    assert exit.thread == 0xa
+    assert callseq.output.parse_timestamp('1.5') == 1000000005
+
+
+def test_call_stacks():
+    stacks = callseq.output.CallStacks()
+    frames = [frame for event, frame in stacks(
+        callseq.output.iter_events(threads_output.splitlines())) if event.kind == '}']
+    assert [f.site for f in frames] == [2, 2, 3, 1, 1]
+    assert frames[2].path() == [1, 3]
+    assert frames[2].inclusive == 50
+    assert frames[2].exclusive == 30
+    assert frames[4].exclusive == 100 - 50
+    assert stacks.stacks == {0xa: [], 0xb: []}
+    assert stacks.sites[3] == ('bool operator|(A, A)', 'a.cpp#9')
+
+
+def test_calling_context_tree():
+    cct = callseq.analysis.CallingContextTree()
+    cct.update(callseq.output.iter_events(factorial_output.splitlines()))
+    main = cct.root.children[2]
+    assert main.count == 1
+    assert set(main.children) == {1}
+    factorial = main.children[1]
+    assert factorial.count == 2
+    assert factorial.children[1].count == 1
+    assert main.inclusive == 10388553 - 10092680
+    assert main.exclusive == main.inclusive - factorial.inclusive
+    assert cct.root.inclusive == main.inclusive
+
+    text = cct.tostring(max_depth=2)
+    assert 'int main()' in text
+    assert text.splitlines()[-1].strip() == '...'
+
+
+def test_calling_context_tree_callers():
+    cct = callseq.analysis.CallingContextTree()
+    cct.update(callseq.output.iter_events(threads_output.splitlines()))
+    assert cct.root.count == 2
+    callers = cct.callers(2)
+    assert callers.count == 2
+    assert callers.inclusive == 30 + 20
+    assert set(callers.children) == {1, 3}
+    assert callers.children[3].children[1].count == 1
+    assert callers.children[1].children == {}
+
+
+def test_function_name():
+    function_name = callseq.output.function_name
+    assert function_name('int main()') == 'main'
+    assert function_name('int A::bar(int) const') == 'A::bar'
+    assert function_name('Fraction<T> Fraction<T>::operator+(T) [with T = int]') \
+        == 'Fraction<T>::operator+'
+    assert function_name('std::ostream& operator<<(std::ostream&, const Fraction<T>&)'
+                         ' [with T = int; std::ostream = std::basic_ostream<char>]') \
+        == 'operator<<'
+    assert function_name('bool operator|(A, A)') == 'operator|'
+    assert function_name('A::operator int() const') == 'A::operator int'
+
+
+def test_folded_stacks():
+    cct = callseq.analysis.CallingContextTree()
+    cct.update(callseq.output.iter_events(threads_output.splitlines()))
+    assert callseq.export.folded_stacks(cct) == {
+        'run': 100 - 30 + 100 - 50,
+        'run;A::bar': 30,
+        'run;operator|': 50 - 20,
+        'run;operator|;A::bar': 20}
+
+    cct = callseq.analysis.CallingContextTree(by_thread=True)
+    cct.update(callseq.output.iter_events(threads_output.splitlines()))
+    stacks = callseq.export.folded_stacks(cct)
+    assert stacks['thread 0xa;run'] == 70
+    assert stacks['thread 0xb;run;operator|'] == 30
+
+
+def test_chrome_trace_writer():
+    with tempfile.TemporaryDirectory() as working_dir:
+        path = os.path.join(working_dir, 'trace.json')
+        writer = callseq.export.ChromeTraceWriter(path)
+        paths = writer(callseq.output.iter_events(threads_output.splitlines()))
+        assert paths == [path]
+        events = json.load(open(path))['traceEvents']
+        assert len(events) == 10
+        assert events[0] == dict(name='run', ph='B', ts=0.1, pid=0, tid=0xa,
+                                 args=dict(this='0x0'))
+        assert events[4] == dict(ph='E', ts=0.14, pid=0, tid=0xa)
+
+        writer = callseq.export.ChromeTraceWriter(path, complete=True)
+        writer(callseq.output.iter_events(threads_output.splitlines()))
+        events = json.load(open(path))['traceEvents']
+        assert [e['ph'] for e in events] == ['X'] * 5
+        assert events[0]['dur'] == 0.03
+
+        writer = callseq.export.ChromeTraceWriter(path, max_size=200)
+        paths = writer(callseq.output.iter_events(threads_output.splitlines()))
+        assert len(paths) > 2
+        for path in paths:
+            events = json.load(open(path))['traceEvents']
+            depth = {}
+            for e in events:
+                depth[e['tid']] = depth.get(e['tid'], 0) + (1 if e['ph'] == 'B' else -1)
+                assert depth[e['tid']] >= 0
+            assert set(depth.values()) == {0}
+
+
+def test_format_event():
+    for line in factorial_output.splitlines():
+        event = callseq.output.parse_event(line)
+        assert callseq.output.parse_event(callseq.output.format_event(event)) == event
+    line = '}1|0x0|1.000000001|0xa'
+    assert callseq.output.format_event(callseq.output.parse_event(line)) == line
+
+
+def test_trace_index():
+    with tempfile.TemporaryDirectory() as working_dir:
+        trace = os.path.join(working_dir, 'callseq.output')
+        with open(trace, 'w') as f:
+            f.write(threads_output)
+        index = callseq.output.TraceIndex.build(trace, interval=3)
+        assert len(index.checkpoints) == 4
+        index = callseq.output.TraceIndex.load(index.save())
+        assert index.size == len(threads_output)
+
+        offset, nevents, timestamp, ncalls, stacks = index.checkpoint(event=6)
+        assert nevents == 6
+        assert threads_output[offset:].startswith('}2|0x20|0.170|0xb')
+        assert {t: len(s) for t, s in stacks.items()} == {0xa: 1, 0xb: 3}
+
+        window = list(index.window(start_time=150, end_time=190))
+        assert [event.timestamp for event, frame in window] == [150, 170, 180]
+        assert [frame.depth for event, frame in window] == [2, 2, 1]
+        assert window[2][1].inclusive == 50
+
+        window = list(index.window(start_event=6, end_event=8))
+        assert [event.timestamp for event, frame in window] == [170, 180]
+
+
+def test_trace_segments():
+    with tempfile.TemporaryDirectory() as working_dir:
+        trace = os.path.join(working_dir, 'callseq.output')
+        # outputs of forked processes and their segments
+        for suffix in ['.101', '.102', '.101.seg1', '.101.seg2']:
+            with open(trace + suffix, 'w') as f:
+                f.write(factorial_output)
+        with pytest.raises(FileNotFoundError):
+            callseq.output.trace_segments(trace)
+        assert callseq.output.trace_segments(trace + '.101') == [trace + '.101']
+        os.remove(trace + '.101')
+        assert callseq.output.trace_segments(trace + '.101') == [trace + '.101.seg1',
+                                                                 trace + '.101.seg2']
+
+
+def test_trace_index_segments():
+    lines = threads_output.splitlines(keepends=True)
+    header = ('#callseq pid=1 start=0\n'
+              '#{1|0x0|0.100|0xa|void run()|a.cpp#1\n'
+              '#{1|0x0|0.120|0xb|void run()|a.cpp#1\n'
+              '#{3|0x0|0.130|0xb|bool operator|(A, A)|a.cpp#9\n')
+    with tempfile.TemporaryDirectory() as working_dir:
+        trace = os.path.join(working_dir, 'callseq.output')
+        with open(trace + '.seg1', 'w') as f:
+            f.write(''.join(lines[:5]))
+        with open(trace + '.seg2', 'w') as f:
+            f.write(header + ''.join(lines[5:]))
+        index = callseq.output.TraceIndex.get(trace, interval=3)
+        assert len(index.segments) == 2
+        assert index.size == len(threads_output) + len(header)
+        loaded = callseq.output.TraceIndex.get(trace)
+        assert [c[:4] for c in loaded.checkpoints] == [c[:4] for c in index.checkpoints]
+
+        window = list(index.window(start_time=150, end_time=190))
+        assert [event.timestamp for event, frame in window] == [150, 170, 180]
+        assert [frame.depth for event, frame in window] == [2, 2, 1]
+
+        # segment header events are numbered, too
+        assert [c[1] for c in index.checkpoints] == [0, 3, 6, 9, 12]
+        window = list(index.window(start_event=9, end_event=11))
+        assert [event.timestamp for event, frame in window] == [170, 180]
+
+        latencies = callseq.analysis.SiteLatencies().update(callseq.output.iter_events(trace))
+        parallel = callseq.analysis.parallel_site_latencies(trace + '.idx', jobs=2)
+        for site in latencies.inclusive:
+            assert parallel.inclusive[site].buckets == latencies.inclusive[site].buckets
+
+
+def test_write_sqlite():
+    with tempfile.TemporaryDirectory() as working_dir:
+        path = os.path.join(working_dir, 'callseq.sqlite')
+        count = callseq.export.write_sqlite(
+            callseq.output.iter_events(threads_output.splitlines()), path, batch_size=2)
+        assert count == 5
+        connection = sqlite3.connect(path)
+        rows = connection.execute(
+            'SELECT calls.id, parent, thread, depth, duration_ns, self_ns FROM calls'
+            ' JOIN sites ON calls.site = sites.id'
+            ' WHERE sites.name = "A::bar" AND this = 0x20').fetchall()
+        assert rows == [(4, 3, 0xb, 2, 20, 20)]
+        rows = connection.execute(
+            'SELECT name, count(*), sum(self_ns) FROM calls JOIN sites ON calls.site = sites.id'
+            ' GROUP BY name ORDER BY name').fetchall()
+        assert rows == [('A::bar', 2, 50), ('operator|', 1, 30), ('run', 2, 120)]
+        connection.close()
+
+
+def test_latency_sketch():
+    values = list(range(1, 100001))
+    random.Random(0).shuffle(values)
+    sketch = callseq.analysis.LatencySketch(relative_accuracy=0.01)
+    for v in values:
+        sketch.add(v)
+    for q in [0, 0.5, 0.9, 0.99, 0.999, 1]:
+        exact = 1 + q * (len(values) - 1)
+        assert abs(sketch.quantile(q) - exact) <= 0.01 * exact + 1
+    assert len(sketch.buckets) < 1000
+
+    sketch1 = callseq.analysis.LatencySketch(relative_accuracy=0.01)
+    sketch2 = callseq.analysis.LatencySketch(relative_accuracy=0.01)
+    for v in values[:50000]:
+        sketch1.add(v)
+    for v in values[50000:]:
+        sketch2.add(v)
+    sketch1.merge(sketch2)
+    assert sketch1.buckets == sketch.buckets
+    assert sketch1.quantile(0.99) == sketch.quantile(0.99)
+
+    small = callseq.analysis.LatencySketch(max_buckets=10)
+    for v in values:
+        small.add(v)
+    assert len(small.buckets) == 10
+    assert abs(small.quantile(0.999) - 99901) <= 0.01 * 99901
+
+
+def test_site_latencies():
+    events = list(callseq.output.iter_events(threads_output.splitlines()))
+    latencies = callseq.analysis.SiteLatencies().update(events)
+    assert latencies.inclusive[1].count == 2
+    assert abs(latencies.inclusive[1].quantile(1) - 100) <= 1
+    assert abs(latencies.exclusive[1].quantile(0) - 50) <= 1
+    assert 'operator|' in latencies.tostring()
+
+    merged = callseq.analysis.SiteLatencies()
+    merged.update(events[:5]).merge(callseq.analysis.SiteLatencies().update(events))
+    assert merged.inclusive[2].count == 2 + 1
+
+    with tempfile.TemporaryDirectory() as working_dir:
+        trace = os.path.join(working_dir, 'callseq.output')
+        with open(trace, 'w') as f:
+            f.write(threads_output)
+        index_path = callseq.output.TraceIndex.build(trace, interval=3).save()
+        parallel = callseq.analysis.parallel_site_latencies(index_path, jobs=2)
+        for site in latencies.inclusive:
+            assert parallel.inclusive[site].buckets == latencies.inclusive[site].buckets
+            assert parallel.exclusive[site].buckets == latencies.exclusive[site].buckets
+
+
+def test_merge_traces():
+    with tempfile.TemporaryDirectory() as working_dir:
+        path1 = os.path.join(working_dir, 'callseq.101.output')
+        path2 = os.path.join(working_dir, 'callseq.output.102')
+        with open(path1, 'w') as f:
+            f.write('#callseq pid=101 start=1000\n' + threads_output)
+        with open(path2, 'w') as f:
+            f.write(factorial_output.replace('0xe48eb7', '0xa'))
+        assert callseq.output.read_header(path1) == dict(pid=101, start=1000)
+        assert callseq.output.read_header(path2) == {}
+
+        f = io.StringIO()
+        assert callseq.output.merge_traces([path1, path2], f) == 10 + 8
+        lines = f.getvalue().splitlines()
+        assert callseq.output.parse_header(lines[0]) == dict(start=0, processes='101,102')
+        events = list(callseq.output.iter_events(lines))
+        timestamps = [event.timestamp for event in events]
+        assert timestamps == sorted(timestamps)
+        assert events[0].timestamp == 1100
+        assert {event.thread for event in events} == {101 << 24 | 0xa, 101 << 24 | 0xb,
+                                                      102 << 24 | 0xa}
+        cct = callseq.analysis.CallingContextTree().update(events)
+        assert cct.root.count == 3
+
+
+def test_trace_follower():
+    with tempfile.TemporaryDirectory() as working_dir:
+        trace = os.path.join(working_dir, 'callseq.output')
+        follower = callseq.output.TraceFollower(trace)
+        assert follower.poll() == []
+        profile = callseq.analysis.FlatProfile()
+        with open(trace, 'w') as f:
+            f.write(threads_output[:20])
+            f.flush()
+            assert follower.poll() == []
+            f.write(threads_output[20:100])
+            f.flush()
+            profile.update(follower.poll())
+            assert profile.stacks.ncalls == 2
+            assert profile.open_calls() == 2
+            assert profile.stats == {}
+            f.write(threads_output[100:])
+            f.flush()
+            profile.update(follower.poll())
+            assert profile.open_calls() == 0
+            assert profile.stats == {1: [2, 200, 120], 2: [2, 50, 50], 3: [1, 50, 30]}
+            assert follower.poll() == []
+        text = profile.tostring(top=2, key='exclusive')
+        assert 'A::bar' in text and 'operator|' not in text
+        with open(trace, 'w') as f:
+            f.write(factorial_output)
+        assert len(follower.poll()) == 8
+        assert follower.restarted
+        follower.close()
+
+
+def test_trace_follower_segments():
+    lines = threads_output.splitlines(keepends=True)
+    with tempfile.TemporaryDirectory() as working_dir:
+        trace = os.path.join(working_dir, 'callseq.output')
+        follower = callseq.output.TraceFollower(trace)
+        with open(trace + '.seg1', 'w') as f:
+            f.write(''.join(lines[:2]))
+        with open(trace + '.seg2', 'w') as f:
+            f.write(''.join(lines[2:4]))
+        # following starts from the newest segment
+        assert [event.timestamp for event in follower.poll()] == [120, 130]
+        with open(trace + '.seg2', 'a') as f:
+            f.write(lines[4])
+        with open(trace + '.seg3', 'w') as f:
+            f.write('#callseq pid=1 start=0 segment=3\n' + ''.join(lines[5:7]))
+        events = follower.poll()
+        assert [event.timestamp for event in events] == [140, 150, 170]
+        assert not follower.restarted
+        os.remove(trace + '.seg1')
+        os.remove(trace + '.seg2')
+        with open(trace + '.seg4', 'w') as f:
+            f.write(''.join(lines[7:]))
+        assert [event.timestamp for event in follower.poll()] == [180, 200, 220]
+        assert follower.poll() == []
+        follower.close()
+
+
+def test_diff_trees():
+    a = callseq.analysis.CallingContextTree()
+    a.update(callseq.output.iter_events(threads_output.splitlines()))
+    # site ids differ, A::bar is not called from operator|, run is slower
+    b_output = '''\
+{7|0x0|0.100|0xa|void run()|a.cpp#1
+{8|0x10|0.110|0xa|int A::bar(int) const|a.cpp#5
+}8|0x10|0.140|0xa
+{9|0x0|0.150|0xa|bool operator|(A, A)|a.cpp#9
+}9|0x0|0.160|0xa
+}7|0x0|0.300|0xa
+'''
+    b = callseq.analysis.CallingContextTree()
+    b.update(callseq.output.iter_events(b_output.splitlines()))
+    paths = callseq.analysis.name_paths(a)
+    assert paths[('run',)] == [2, 200, 120]
+    assert paths[('run', 'operator|', 'A::bar')] == [1, 20, 20]
+
+    rows = callseq.analysis.diff_trees(a, b)
+    assert rows[0] == (('run', 'operator|'), [1, 50, 30], [1, 10, 10])
+    assert rows[1] == (('run', 'operator|', 'A::bar'), [1, 20, 20], None)
+    assert (('run',), [2, 200, 120], [1, 200, 160]) in rows
+    table = callseq.analysis.diff_table(rows)
+    assert len(table.splitlines()) == 2 + 3
+    assert 'removed' in table
+    assert len(callseq.analysis.diff_table(rows, min_change=30).splitlines()) == 2 + 1
+
+
+def _latency_trace(rng, scales):
+    lines = []
+    t = 0
+    for i in range(200):
+        for site, (name, scale) in enumerate(scales, 1):
+            lines.append(f'{{{site}|0x0|0.{t}|0x1|void {name}()|a.cpp#{site}')
+            t += int(rng.expovariate(1 / scale)) + 1
+            lines.append(f'}}{site}|0x0|0.{t}|0x1')
+    return lines
+
+
+def test_compare_runs():
+    rng = random.Random(1)
+    runs_a = [_latency_trace(rng, [('f', 100), ('g', 100)]) for i in range(5)]
+    runs_b = [_latency_trace(rng, [('g', 100), ('f', 200)]) for i in range(5)]
+    a = callseq.compare.load_durations(runs_a)
+    b = callseq.compare.load_durations(runs_b, max_samples=50, seed=2)
+    assert len(a[0]['void f()']) == 200
+    assert len(b[0]['void f()']) == 50
+
+    rows = callseq.compare.compare_runs(a, b, iterations=200, seed=3)
+    assert [row[0] for row in rows] == ['void f()', 'void g()']
+    f, g = rows
+    assert f[7] == 'slower'
+    assert f[1:3] == (1000, 250)
+    assert 1.2 < f[5][0] < f[4] / f[3] < f[5][1] < 4
+    assert g[7] == ''
+    assert g[5][0] < 1 < g[5][1]
+
+    table = callseq.compare.comparison_table(rows)
+    assert len(table.splitlines()) == 2 + 1
+    assert 'void f()' in table.splitlines()[-1]
+    assert len(callseq.compare.comparison_table(rows, show_all=True).splitlines()) == 2 + 2
+
+    # run-to-run drift of many calls is not significant
+    runs_a = [_latency_trace(rng, [('f', scale)]) for scale in (100, 150)]
+    runs_b = [_latency_trace(rng, [('f', scale)]) for scale in (120, 180)]
+    rows = callseq.compare.compare_runs(callseq.compare.load_durations(runs_a),
+                                        callseq.compare.load_durations(runs_b),
+                                        iterations=200, seed=3)
+    assert rows[0][6] > 0.05 and rows[0][7] == ''
+
+
+def test_mann_whitney_u():
+    u, p = callseq.compare.mann_whitney_u([1, 2, 3, 4], [5, 6, 7, 8])
+    assert u == 0
+    assert p < 0.05
+    u, p = callseq.compare.mann_whitney_u([1, 2, 2, 3], [1, 2, 2, 3])
+    assert u == 8
+    assert p == 1.0
+    assert callseq.compare.holm([0.01, 0.04, 0.03]) == [0.03, 0.06, 0.06]
+
+
+def test_slowest_calls():
+    events = list(callseq.output.iter_events(threads_output.splitlines()))
+    slowest = callseq.analysis.SlowestCalls(k=2, context=2).update(events)
+    first, second = slowest.calls()
+    assert (first.site, first.thread, first.duration) == (1, 0xb, 100)
+    assert (second.site, second.thread, second.duration) == (1, 0xa, 100)
+    assert second.path == [1]
+    assert second.before == events[6:8]
+    assert second.after == [events[9]]
+    assert first.after == []
+
+    slowest = callseq.analysis.SlowestCalls(k=1, per_site=True, context=1).update(events)
+    call, = slowest.calls(2)
+    assert (call.this, call.duration, call.path) == (0x10, 30, [1, 2])
+    assert call.before == [events[3]]
+    assert call.after == [events[5]]
+    assert slowest.calls(3)[0].path == [1, 3]
+    text = slowest.tostring()
+    assert '  path: run > A::bar' in text
+    assert '  > }2|0x10|0.000000140|0xa' in text
+
+
+objects_output = '''\
+{1|0x0|0.100|0xa|int main()|m.cpp#1
+{2|0x10|0.110|0xa|A::A(int)|a.cpp#1
+{2|0x10|0.112|0xa|A::A(int)|a.cpp#1
+}2|0x10|0.114|0xa
+}2|0x10|0.120|0xa
+{3|0x10|0.130|0xa|int A::get() const|a.cpp#5
+{3|0x10|0.135|0xa|int A::get() const|a.cpp#5
+}3|0x10|0.140|0xa
+}3|0x10|0.150|0xa
+{4|0x10|0.160|0xa|A::~A()|a.cpp#9
+}4|0x10|0.170|0xa
+{2|0x10|0.180|0xa|A::A(int)|a.cpp#1
+}2|0x10|0.190|0xa
+{3|0x10|0.200|0xa|int A::get() const|a.cpp#5
+}3|0x10|0.400|0xa
+{5|0x20|0.410|0xa|ns::B<T>::B() [with T = int]|b.cpp#1
+}5|0x20|0.420|0xa
+{2|0x30|0.430|0xa|A::A(int)|a.cpp#1
+}2|0x30|0.440|0xa
+{3|0x10|0.450|0xa|int A::get() const|a.cpp#5
+}3|0x10|0.460|0xa
+{2|0x10|0.470|0xa|A::A(int)|a.cpp#1
+}2|0x10|0.480|0xa
+}1|0x0|0.500|0xa
+'''
+
+
+def test_object_lifetimes():
+    assert callseq.analysis.split_scope('ns::B<T>::B') == ('ns::B<T>', 'B')
+    assert callseq.analysis.split_scope('A<B::C>::f') == ('A<B::C>', 'f')
+    assert callseq.analysis.split_scope('main') == ('', 'main')
+
+    lifetimes = callseq.analysis.ObjectLifetimes()
+    lifetimes.update(callseq.output.iter_events(objects_output.splitlines()))
+    assert lifetimes.kind(2) == ('A', 'ctor')
+    assert lifetimes.kind(4) == ('A', 'dtor')
+    assert lifetimes.kind(5) == ('ns::B<T>', 'ctor')
+    keys = [(s.cls, s.this, s.generation) for s in lifetimes.objects]
+    assert keys == [('A', 0x10, 0), ('A', 0x10, 1), ('ns::B<T>', 0x20, 0), ('A', 0x30, 0),
+                    ('A', 0x10, 2)]
+    a0, a1, b, a3, a2 = lifetimes.objects
+    assert (a0.count, a0.inclusive, a0.exclusive) == (5, 10 + 20 + 10, 8 + 2 + 15 + 5 + 10)
+    assert (a0.first, a0.last, a0.lifetime) == (110, 170, 60)
+    assert a0.constructed and a0.destroyed
+    assert (a1.count, a1.inclusive, a1.lifetime) == (3, 10 + 200 + 10, 280)
+    assert a1.constructed and not a1.destroyed
+    assert (a2.count, a2.inclusive) == (1, 10)
+    assert lifetimes.hot_objects(factor=5) == [a1]
+    lines = lifetimes.tostring(top=2).splitlines()
+    assert len(lines) == 3
+    assert lines[1].startswith('*') and lines[1].endswith('  c- A 0x10#1')
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_coverage(use_numpy, monkeypatch):
+    if not use_numpy:
+        monkeypatch.setattr(callseq.analysis, 'numpy', None)
+    starts, ends, points = [0, 5, 20], [8, 10, 30], [0, 5, 10, 25, 40]
+    assert callseq.analysis.coverage(starts, ends, points) == [0, 5, 13, 18, 23]
+    # nested intervals: the ends in the order of starts are not sorted
+    intervals = [(0, 30), (5, 8), (10, 12), (15, 40)]
+    points = [0, 5, 9, 11, 20, 35, 50]
+    expected = [sum(max(0, min(x, end) - start) for start, end in intervals) for x in points]
+    assert expected == [0, 5, 12, 15, 30, 55, 60]
+    starts = sorted(start for start, _ in intervals)
+    ends = sorted(end for _, end in intervals)
+    assert callseq.analysis.coverage(starts, ends, points) == expected
+
+
+def test_concurrency():
+    concurrency = callseq.analysis.Concurrency()
+    concurrency.update(callseq.output.iter_events(threads_output.splitlines()))
+    edges, threads, top_sites = concurrency.timeline(buckets=4)
+    assert edges == [100, 130, 160, 190, 220]
+    assert [round(value, 3) for value in threads] == [1.333, 2, 2, 1.333]
+    assert top_sites == [1, 1, 1, 1]
+    assert concurrency.busy == {0xa: 100, 0xb: 100}
+    assert concurrency.sparkline(threads, 2) == '▆██▆'
+    text = concurrency.tostring(buckets=4)
+    assert text.splitlines()[0] == 'threads |▆██▆| max=2'
+    assert text.splitlines()[-1] == 'parallel efficiency: 83.3% of 2 threads'
+    f = io.StringIO()
+    concurrency.write_csv(f, buckets=4)
+    assert f.getvalue().splitlines()[1] == '100,1.333333,run'